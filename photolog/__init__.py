@@ -6,6 +6,7 @@ queue_logger = logging.getLogger('QUEUE')
 api_logger = logging.getLogger('API')
 web_logger = logging.getLogger('WEB')
 cli_logger = logging.getLogger('CLI')
+db_logger = logging.getLogger('DB')
 
 logging.basicConfig(
     stream=sys.stdout,
@@ -7,6 +7,7 @@ from datetime import datetime
 from flask import Flask, request, jsonify
 from werkzeug.utils import secure_filename
 
+from photolog import profiling
 from photolog.db import DB
 from photolog.squeue import SqliteQueue
 from photolog.settings import Settings
@@ -15,11 +16,13 @@ from photolog.services.base import random_string, start_batch, end_batch, \
     slugify
 
 settings = Settings.load(settings_file)
+profiling.configure(settings)
 queue = SqliteQueue(settings.DB_FILE)
-db = DB(settings.DB_FILE)
+db = DB(settings.DB_FILE, settings.DB_PRAGMAS, settings.DB_READERS)
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024  # 64MB  # Raw files
+profiling.init_app(app)
 
 
 def allowed_file(filename):
@@ -0,0 +1,171 @@
+"""
+Online backups of the catalog.
+
+Snapshots are taken with SQLite's backup API. In WAL mode, what the catalog
+uses, the whole file is copied in one step: the copy reads a single snapshot
+and writers carry on meanwhile, so the queue worker's constant commits can't
+make it start over. Other journal modes copy a few pages at a time, sleeping
+between steps so writers get the lock, and SQLite restarts the copy if the
+database changes mid way.
+
+`photolog_backup` keeps a directory of compressed snapshots, taking a new one
+only when the catalog changed since the previous one:
+
+    SETTINGS=settings.yaml photolog_backup --folder /backups --every 3600
+"""
+
+import os
+import zlib
+import sqlite3
+import argparse
+import tempfile
+from time import sleep
+from datetime import datetime
+
+from photolog import cli_logger as log, settings_file
+from photolog.settings import Settings
+
+# Outside WAL mode, where a reader would block writers for the whole copy
+PAGES_PER_STEP = 256
+STEP_SLEEP = 0.05  # Seconds between steps, writers get the lock meanwhile
+CHUNK_SIZE = 64 * 1024
+PREFIX = 'photolog-'
+SUFFIX = '.db.gz'
+
+
+def snapshot(source, target, pages=PAGES_PER_STEP, step_sleep=STEP_SLEEP):
+    """
+    Copies the `source` connection (or database file) into the `target` file
+    """
+    own_source = not isinstance(source, sqlite3.Connection)
+    if own_source:
+        source = sqlite3.connect(source)
+    dest = sqlite3.connect(target)
+    try:
+        mode = source.execute('PRAGMA journal_mode').fetchone()[0]
+        if mode.lower() == 'wal':
+            source.backup(dest)
+        else:
+            source.backup(dest, pages=pages, sleep=step_sleep)
+        # The copy is a single file, it must not expect a -wal next to it
+        dest.execute('PRAGMA journal_mode = DELETE').fetchall()
+    finally:
+        dest.close()
+        if own_source:
+            source.close()
+
+
+def gzip_chunks(filename, remove=False):
+    """
+    Yields the gzip compressed contents of `filename`
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        with open(filename, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+        yield compressor.flush()
+    finally:
+        if remove:
+            os.remove(filename)
+
+
+def stream_snapshot(db_file):
+    """
+    Takes a snapshot of `db_file` and returns a generator streaming it
+    compressed, the snapshot is deleted once streamed.
+    """
+    fd, filename = tempfile.mkstemp(suffix='.db',
+        dir=os.path.dirname(os.path.abspath(db_file)))
+    os.close(fd)
+    try:
+        snapshot(db_file, filename)
+    except Exception:
+        os.remove(filename)
+        raise
+    return gzip_chunks(filename, remove=True)
+
+
+class Scheduler(object):
+    """
+    Keeps `keep` compressed snapshots of `db_file` in `folder`
+    """
+    def __init__(self, db_file, folder, keep):
+        self.source = sqlite3.connect(db_file)
+        self.folder = folder
+        self.keep = keep
+        self.version = None
+
+    def data_version(self):
+        # Changes whenever another connection commits to the database
+        return self.source.execute('PRAGMA data_version').fetchone()[0]
+
+    def backups(self):
+        return sorted(f for f in os.listdir(self.folder)
+                      if f.startswith(PREFIX) and f.endswith(SUFFIX))
+
+    def run_once(self):
+        """
+        Takes a snapshot if the catalog changed since the last one, returns
+        its file name or None.
+        """
+        version = self.data_version()
+        if version == self.version and self.backups():
+            return None
+        base = os.path.join(self.folder,
+            PREFIX + datetime.now().strftime('%Y%m%d-%H%M%S'))
+        filename, raw = base + SUFFIX, base + '.db.tmp'
+        snapshot(self.source, raw)
+        with open(filename + '.part', 'wb') as fh:
+            for chunk in gzip_chunks(raw, remove=True):
+                fh.write(chunk)
+        os.rename(filename + '.part', filename)
+        self.version = version
+        self.prune()
+        return filename
+
+    def prune(self):
+        backups = self.backups()
+        for name in backups[:max(0, len(backups) - self.keep)]:
+            os.remove(os.path.join(self.folder, name))
+
+    def close(self):
+        self.source.close()
+
+
+def run():
+    settings = Settings.load(settings_file)
+    parser = argparse.ArgumentParser(
+        description="Keep compressed snapshots of the Photolog catalog"
+    )
+    parser.add_argument('--folder', type=str, default=settings.BACKUP_FOLDER,
+        help="Directory for the snapshots")
+    parser.add_argument('--every', type=int, default=settings.BACKUP_INTERVAL,
+        help="Seconds between checks, 0 to take a single snapshot")
+    parser.add_argument('--keep', type=int, default=settings.BACKUP_KEEP,
+        help="Snapshots to keep")
+    parsed = parser.parse_args()
+    if not parsed.folder:
+        parser.error('No backup folder, set BACKUP_FOLDER or pass --folder')
+    if not os.path.exists(parsed.folder):
+        os.makedirs(parsed.folder)
+
+    scheduler = Scheduler(settings.DB_FILE, parsed.folder, parsed.keep)
+    try:
+        while True:
+            filename = scheduler.run_once()
+            if filename:
+                log.info('Backup written to %s' % filename)
+            else:
+                log.info('No changes since the last backup')
+            if not parsed.every:
+                break
+            sleep(parsed.every)
+    finally:
+        scheduler.close()
+
+
+if __name__ == '__main__':
+    run()
@@ -1,79 +1,248 @@
 import os
+import math
 import sqlite3
+import threading
 from time import time
+from itertools import groupby
+from queue import Queue, Empty
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
-try:
-    from _thread import get_ident
-except ImportError:
-    from _dummy_thread import get_ident
+from photolog import profiling
 
+# Applied to every connection, BaseDB takes overrides. journal_mode is
+# persistent and only set by the writer.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # Safe with WAL, only the last commits may be lost
+    'cache_size': -16000,  # In KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
 
-# http://stackoverflow.com/a/3300514/43490
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+
+# Keys bound per statement on `key IN (...)` queries
+KEYS_CHUNK = 500
+
+
+def chunks(items, size=KEYS_CHUNK):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class Record(sqlite3.Row):
+    """
+    Read only dict-like row, built in C without copying the values into a
+    dict per row. Use dict(record) when a real dict is needed.
+    """
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except IndexError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+
+def select_columns(columns, table=''):
+    prefix = '%s.' % table if table else ''
+    if not columns:
+        return prefix + '*'
+    return ', '.join(prefix + c for c in columns)
+
+
+class LockedConnection(object):
+    """
+    The writer connection, shared by all threads. Using it in a `with` block
+    holds its lock, so transactions from different threads don't mix.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            return self._conn.__enter__()
+        except Exception:
+            self._lock.release()
+            raise
+
+    def __exit__(self, *exc_info):
+        try:
+            return self._conn.__exit__(*exc_info)
+        finally:
+            self._lock.release()
+
+
+class ConnectionManager(object):
+    """
+    One writer connection plus a bounded pool of read only connections.
+    With `readers=0` reads go through the writer too, which is what the
+    queue worker wants.
+    """
+    def __init__(self, path, pragmas=None, readers=0):
+        self.path = path
+        self.pragmas = dict(PRAGMAS, **(pragmas or {}))
+        self.readers = readers
+        self._pool = Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._writer = LockedConnection(self._connect(self.path))
+
+    def _connect(self, target, readonly=False):
+        # Readers stay in autocommit, an implicit transaction left open would
+        # pin them to an old snapshot.
+        conn = profiling.connect(self.path, target, timeout=60, uri=readonly,
+            check_same_thread=False, isolation_level=None if readonly else '')
+        conn.row_factory = Record
+        for name, value in self.pragmas.items():
+            if readonly and name == 'journal_mode':
+                continue
+            conn.execute('PRAGMA %s = %s' % (name, value)).fetchall()
+        return conn
+
+    def writer(self):
+        return self._writer
+
+    def _take_reader(self):
+        try:
+            return self._pool.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            create = self._created < self.readers
+            if create:
+                self._created += 1
+        if not create:
+            return self._pool.get()
+        uri = 'file:%s?mode=ro' % pathname2url(self.path)
+        return self._connect(uri, readonly=True)
+
+    @contextmanager
+    def reader(self):
+        if not self.readers:
+            with self._writer as conn:
+                yield conn
+            return
+        conn = self._take_reader()
+        try:
+            yield conn
+        finally:
+            if self._closed:
+                conn.close()
+            else:
+                self._pool.put(conn)
+
+    def close(self):
+        self._closed = True
+        self._writer.close()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                break
 
 
 class BaseDB(object):
     _create = []
 
-    def __init__(self, path):
+    def __init__(self, path, pragmas=None, readers=0):
         self.path = os.path.abspath(path)
-        self._connection_cache = {}
+        self._connections = ConnectionManager(self.path, pragmas, readers)
         with self._get_conn() as conn:
             for table in self._create:
                 conn.execute(table)
 
     def _get_conn(self):
-        _id = get_ident()
-        if _id not in self._connection_cache:
-            conn = sqlite3.Connection(self.path, timeout=60)
-            conn.row_factory = dict_factory
-            self._connection_cache[_id] = conn
-        return self._connection_cache[_id]
+        """
+        The writer connection, `with` it for each transaction
+        """
+        return self._connections.writer()
+
+    def _read_conn(self):
+        """
+        Context manager lending a connection for reads. Results must be
+        fetched before the block ends, the connection goes back to the pool.
+        """
+        return self._connections.reader()
+
+    def close(self):
+        self._connections.close()
 
 
 class TagManager:
-    _tag_picture = 'INSERT INTO tagged_pics (tag_id, picture_id) VALUES (?, ?)'
-    _get_tag = 'SELECT id, name FROM tags WHERE name=?'
-    _add_tag = 'INSERT INTO tags (name) VALUES (?)'
+    ALL, ANY = 'all', 'any'
+    _tag_picture = ('INSERT OR IGNORE INTO tagged_pics (tag_id, picture_id) '
+                    'VALUES (?, ?)')
+    _add_tag = 'INSERT OR IGNORE INTO tags (name) VALUES (?)'
     _clear_picture_tags = 'DELETE FROM tagged_pics WHERE picture_id=?'
+    _clear_tags_where = ('DELETE FROM tagged_pics WHERE picture_id IN '
+                         '(SELECT id FROM pictures WHERE %s)')
+    _tag_pictures_where = ('INSERT OR IGNORE INTO tagged_pics '
+                           '(tag_id, picture_id) '
+                           'SELECT ?, id FROM pictures WHERE %s')
     _pic_tags = ('SELECT name FROM tags WHERE id in '
                  '(SELECT tag_id from tagged_pics WHERE picture_id = ?)')
-    _get_tags = 'SELECT name FROM tags'
+    _get_tags = 'SELECT id, name FROM tags'
+    _get_tags_by_name = 'SELECT id, name FROM tags WHERE name IN (%s)'
     _tagged_pics = ('SELECT * from pictures where id in '
                     '(SELECT picture_id FROM tagged_pics WHERE tag_id = ?)')
-    _get_tags_by_name = 'SELECT id, name FROM tags WHERE name in (?)'
-    _get_tagged_pictures = ('SELECT * FROM pictures WHERE id in '
-                            '(SELECT picture_id FROM tagged_pics WHERE tag_id in (?))'
-                            ' ORDER BY taken_time DESC LIMIT ? OFFSET ?')
-    _total_for_tags = 'SELECT COUNT(*) as count FROM tagged_pics WHERE tag_id in (?)'
+    # Pictures having at least `?` of the given tags, one row per tag link
+    # thanks to the unique index on tagged_pics.
+    _tag_matches = ('SELECT tp.picture_id FROM tagged_pics tp '
+                    'JOIN tags t ON t.id = tp.tag_id WHERE t.name IN (%s) '
+                    'GROUP BY tp.picture_id HAVING COUNT(*) >= ?')
+    _total_for_tags = 'SELECT COUNT(*) as count FROM (%s)'
+    _total_for_tag = ("SELECT c.total count FROM tags t "
+                      "JOIN picture_counts c ON c.kind = 'tag' AND "
+                      "c.k1 = t.id AND c.k2 = 0 AND c.k3 = 0 WHERE t.name = ?")
 
     def __init__(self, db):
         self.db = db
+        # Tags are never renamed, so their ids can live for the whole process
+        self._ids = {}
 
     def add(self, name):
         with self.db._get_conn() as conn:
             conn.execute(self._add_tag, [name.lower()])
 
+    def ids(self, names):
+        """
+        Returns {name: id} for the given tag names, creating the missing ones
+        """
+        names = {n.strip().lower() for n in names} - {''}
+        missing = [n for n in names if n not in self._ids]
+        if missing:
+            with self.db._get_conn() as conn:
+                conn.executemany(self._add_tag, [[n] for n in missing])
+                query = self._get_tags_by_name % ', '.join('?' * len(missing))
+                for row in conn.execute(query, missing):
+                    self._ids[row['name']] = row['id']
+        return {n: self._ids[n] for n in names}
+
     def get(self, name):
-        with self.db._get_conn() as conn:
-            matches = list(conn.execute(self._get_tag, [name.lower()]))
-            if not matches:
-                self.add(name)
-                matches = list(conn.execute(self._get_tag, [name.lower()]))
-            return matches[0]
+        name = name.strip().lower()
+        return {'id': self.ids([name])[name], 'name': name}
+
+    def _build_all(self, conn):
+        rows = conn.execute(self._get_tags).fetchall()
+        self._ids.update((r['name'], r['id']) for r in rows)
+        return sorted(r['name'] for r in rows)
 
     def all(self):
-        with self.db._get_conn() as conn:
-            return sorted({r['name'] for r in conn.execute(self._get_tags)})
+        return list(self.db.cached('tags', self._build_all))
 
     def pictures_for_tag(self, name):
         tag = self.get(name)
         t_id = tag['id']
-        with self.db._get_conn() as conn:
+        with self.db._read_conn() as conn:
             return [r for r in conn.execute(self._tagged_pics, [t_id])]
 
     def change_for_picture(self, picture_id, tags):
@@ -81,50 +250,107 @@ class TagManager:
             conn.execute(self._clear_picture_tags, [picture_id])
         self.tag_picture(picture_id, tags)
 
-    def for_picture(self, picture_id):
+    def _change_where(self, conn, where, params, tag_ids):
+        conn.execute(self._clear_tags_where % where, params)
+        conn.executemany(self._tag_pictures_where % where,
+            [[t_id] + params for t_id in tag_ids])
+
+    def change_for_day(self, year, month, day, tags):
+        """
+        Replaces the tags of every picture taken on the given day
+        """
+        tag_ids = self.ids(tags).values()
+        with self.db._get_conn() as conn:
+            self._change_where(conn, 'year = ? AND month = ? AND day = ?',
+                [year, month, day], tag_ids)
+
+    def change_for_keys(self, keys, tags):
+        """
+        Replaces the tags of the pictures with the given keys
+        """
+        tag_ids = self.ids(tags).values()
         with self.db._get_conn() as conn:
+            for chunk in chunks(keys):
+                where = 'key IN (%s)' % ', '.join('?' * len(chunk))
+                self._change_where(conn, where, chunk, tag_ids)
+
+    def for_picture(self, picture_id):
+        with self.db._read_conn() as conn:
             return [t['name'] for t in conn.execute(self._pic_tags, [picture_id])]
 
     def tag_picture(self, picture_id, tags):
+        tag_ids = self.ids(tags).values()
         with self.db._get_conn() as conn:
-            for tag in tags:
-                tag = tag.strip()
-                if not tag:
-                    continue
-                t = self.get(tag)
-                t_id = t['id']
-                conn.execute(self._tag_picture, [t_id, picture_id])
-
-    def tagged_pictures(self, tags, limit, offset):
-        with self.db._get_conn() as conn:
-            tag_ids = [str(t['id'])
-                       # This usage of IN statement is wrong, look at by_keys()
-                       for t in conn.execute(self._get_tags_by_name, [', '.join(tags)])]
-            return conn.execute(self._get_tagged_pictures,
-                (', '.join(tag_ids), limit, offset))
+            conn.executemany(self._tag_picture,
+                [[t_id, picture_id] for t_id in tag_ids])
 
-    def total_for_tags(self, tags):
-        with self.db._get_conn() as conn:
-            tag_ids = [str(t['id'])
-                       # This usage of IN statement is wrong, look at by_keys()
-                       for t in conn.execute(self._get_tags_by_name, [', '.join(tags)])]
-            return conn.execute(self._total_for_tags, [', '.join(tag_ids)]).fetchone()['count']
+    def _matches(self, tags, mode):
+        tags = sorted({t.strip().lower() for t in tags if t.strip()})
+        needed = len(tags) if mode == self.ALL else 1
+        query = self._tag_matches % ', '.join('?' * len(tags))
+        return query, tags + [needed]
+
+    def tagged_pictures(self, tags, limit, offset=0, mode=ALL, before=None,
+                        after=None, columns=None):
+        """
+        Pictures with all (or any, depending on `mode`) of `tags`, newest
+        first. See PictureManager.page() for the cursors.
+        """
+        matches, params = self._matches(tags, mode)
+        return self.db.pictures.page('id IN (%s)' % matches, params, limit,
+            offset, before, after, columns)
+
+    def total_for_tags(self, tags, mode=ALL):
+        matches, params = self._matches(tags, mode)
+        # params are the unique tag names followed by the HAVING count
+        if len(params) == 2:
+            query, params = self._total_for_tag, params[:1]
+        else:
+            query = self._total_for_tags % matches
+        with self.db._read_conn() as conn:
+            row = conn.execute(query, params).fetchone()
+            return row['count'] if row else 0
 
 
 class PictureManager:
     _by_keys = 'SELECT * FROM pictures WHERE key IN (%s)'
+    _by_ids = 'SELECT %s FROM pictures WHERE id IN (%s)'
     _change_date = 'UPDATE pictures SET year=?, month=?, day=?, taken_time=?,' \
-                   ' date_taken=? WHERE key =?'
+                   ' date_taken=? WHERE %s'
     _change_attr = 'UPDATE pictures SET %s=? WHERE key=?'
-    _get_recent = 'SELECT * FROM pictures ORDER BY id DESC LIMIT ? OFFSET ?'
-    _get_pictures = 'SELECT * FROM pictures ORDER BY taken_time DESC LIMIT ? ' \
-                    'OFFSET ?'
+    _get_recent = 'SELECT %s FROM pictures ORDER BY id DESC LIMIT ? OFFSET ?'
+    _page = 'SELECT %s FROM pictures WHERE %s ORDER BY taken_time %s, id %s ' \
+            'LIMIT ? OFFSET ?'
+    # What the thumbnail grids render, listings can fetch just these
+    THUMB_COLUMNS = ('id', 'key', 'name', 'thumb', 'format', 'taken_time')
+    _before_cursor = '(taken_time, id) < (?, ?)'
+    _after_cursor = '(taken_time, id) > (?, ?)'
+    _dated = 'taken_time IS NOT NULL'
+    _undated = 'taken_time IS NULL'
+    _undated_cursor = {'DESC': 'taken_time IS NULL AND id < ?',
+                       'ASC': 'taken_time IS NULL AND id > ?'}
     _get_picture = 'SELECT * FROM pictures WHERE key = ?'
     _find_picture = 'SELECT * FROM pictures WHERE %s'
-    _find_pictures = 'SELECT * FROM pictures WHERE %s ORDER BY taken_time ' \
-                     'DESC'
     _count_pictures = 'SELECT COUNT(*) count FROM pictures WHERE %s'
+    # Date filters that can be answered from picture_counts
+    _date_counts = {
+        ('year',): 'year',
+        ('month', 'year'): 'month',
+        ('day', 'month', 'year'): 'day',
+    }
     _update_picture = 'UPDATE pictures SET %s = ? WHERE key = ?'
+    # The raw service response and what the pages need from it
+    SERVICES = ('flickr', 'gphotos')
+    _set_service = 'UPDATE pictures SET {0} = ?, {0}_id = ?, {0}_url = ? ' \
+                   'WHERE key = ?'
+    # Matches on name and filename weigh more than on notes or tags
+    _search = ('SELECT %s FROM pictures_fts '
+               'JOIN pictures p ON p.id = pictures_fts.rowid '
+               'WHERE pictures_fts MATCH ? '
+               'ORDER BY bm25(pictures_fts, 10.0, 10.0, 2.0, 1.0, 5.0) '
+               'LIMIT ? OFFSET ?')
+    _count_search = ('SELECT COUNT(*) count FROM pictures_fts '
+                     'WHERE pictures_fts MATCH ?')
     _prev_pic = "SELECT key FROM pictures WHERE taken_time < ? ORDER BY " \
                 "taken_time DESC LIMIT 1"
     _next_pic = "SELECT key FROM pictures WHERE taken_time > ? ORDER BY " \
@@ -134,71 +360,461 @@ class PictureManager:
         self.db = db
 
     def by_keys(self, keys):
-        with self.db._get_conn() as conn:
+        with self.db._read_conn() as conn:
             return conn.execute(self._by_keys % ','.join('?' * len(keys)),
-                keys)
+                keys).fetchall()
+
+    def by_ids(self, ids, columns=None):
+        """
+        Pictures with the given ids, in the same order. `columns` must
+        include id when given.
+        """
+        found = {}
+        with self.db._read_conn() as conn:
+            for chunk in chunks(ids):
+                query = self._by_ids % (select_columns(columns),
+                                        ', '.join('?' * len(chunk)))
+                found.update((r['id'], r) for r in conn.execute(query, chunk))
+        return [found[i] for i in ids if i in found]
+
+    def _date_values(self, date_struct):
+        return [date_struct['year'], date_struct['month'], date_struct['day'],
+                date_struct['taken_time'], date_struct['date_taken']]
 
     def change_date(self, picture_key, date_struct):
+        self.change_dates([([picture_key], date_struct)])
+
+    def change_dates(self, changes):
+        """
+        Applies a list of (keys, date_struct) changes in one transaction
+        """
         with self.db._get_conn() as conn:
-            conn.execute(self._change_date, [date_struct['year'],
-                                             date_struct['month'],
-                                             date_struct['day'],
-                                             date_struct['taken_time'],
-                                             date_struct['date_taken'],
-                                             picture_key])
+            for keys, date_struct in changes:
+                values = self._date_values(date_struct)
+                for chunk in chunks(keys):
+                    where = 'key IN (%s)' % ', '.join('?' * len(chunk))
+                    conn.execute(self._change_date % where, values + chunk)
+
+    def change_day(self, year, month, day, date_struct):
+        """
+        Moves every picture taken on the given day to `date_struct`
+        """
+        with self.db._get_conn() as conn:
+            conn.execute(self._change_date % 'year = ? AND month = ? AND day = ?',
+                self._date_values(date_struct) + [year, month, day])
 
     def edit_attribute(self, picture_key, attr, value):
         with self.db._get_conn() as conn:
             return conn.execute(self._change_attr % attr, (value, picture_key))
 
-    def recent(self, limit, offset):
-        with self.db._get_conn() as conn:
-            return conn.execute(self._get_recent, (limit, offset))
+    def recent(self, limit, offset, columns=None):
+        with self.db._read_conn() as conn:
+            return conn.execute(self._get_recent % select_columns(columns),
+                (limit, offset)).fetchall()
 
     def by_key(self, key):
-        with self.db._get_conn() as conn:
+        with self.db._read_conn() as conn:
             return conn.execute(self._get_picture, [key]).fetchone()
 
-    def get_all(self, limit, offset):
-        with self.db._get_conn() as conn:
-            return conn.execute(self._get_pictures, (limit, offset))
+    def page(self, where, params, limit, offset=0, before=None, after=None,
+             columns=None):
+        """
+        Pictures matching `where`, newest first. `before` and `after` are
+        (taken_time, id) cursors taken from the last and first pictures of
+        the current page, seeking to the next and previous pages costs the
+        same no matter how deep they are. `columns` restricts the fetched
+        columns, all of them by default.
+        """
+        conditions = [where] if where else []
+        params = list(params)
+        if not (before or after):
+            return self._select(conditions, params, 'DESC', limit, offset,
+                columns)
+        # Undated pictures come after the dated ones and row values never
+        # match a NULL taken_time, so the cursor seeks within its own part
+        # and the next part tops the page up.
+        taken_time, picture_id = before or after
+        order = 'DESC' if before else 'ASC'
+        if taken_time is None:
+            parts = [(self._undated_cursor[order], [picture_id])]
+            if order == 'ASC':
+                parts.append((self._dated, []))
+        else:
+            cursor = self._before_cursor if before else self._after_cursor
+            parts = [(cursor, [taken_time, picture_id])]
+            if order == 'DESC':
+                parts.append((self._undated, []))
+        wanted = offset + limit if limit >= 0 else -1
+        rows = []
+        for condition, values in parts:
+            rows.extend(self._select(conditions + [condition],
+                params + values, order,
+                wanted - len(rows) if wanted >= 0 else -1, 0, columns))
+            if 0 <= wanted <= len(rows):
+                break
+        rows = rows[offset:]
+        if order == 'ASC':
+            # Walked up from the cursor, flip the rows
+            rows.reverse()
+        return rows
+
+    def _select(self, conditions, params, order, limit, offset, columns):
+        query = self._page % (select_columns(columns),
+                              ' AND '.join(conditions) or '1', order, order)
+        with self.db._read_conn() as conn:
+            return conn.execute(query, params + [limit, offset]).fetchall()
+
+    def get_all(self, limit, offset, before=None, after=None, columns=None):
+        return self.page(None, [], limit, offset, before, after, columns)
 
     def find_one(self, params):
-        with self.db._get_conn() as conn:
+        with self.db._read_conn() as conn:
             fields, values = zip(*params.items())
             query = self._find_picture % ' AND '.join('%s = ?' % f for f in fields)
             return conn.execute(query, values).fetchone()
 
-    def find(self, params, limit=None, offset=None):
-        with self.db._get_conn() as conn:
-            fields, values = zip(*params.items())
-            query = self._find_pictures % ' AND '.join('%s = ?' % f for f in fields)
-            params = []
-            if limit:
-                query += ' LIMIT ?'
-                params.append(limit)
-            if offset:
-                query += ' OFFSET ?'
-                params.append(offset)
-            return conn.execute(query, list(values) + params)
+    def find(self, params, limit=None, offset=None, before=None, after=None,
+             columns=None):
+        fields, values = zip(*params.items())
+        where = ' AND '.join('%s = ?' % f for f in fields)
+        # A negative LIMIT means no limit for SQLite
+        return self.page(where, values, limit or -1, offset or 0, before,
+            after, columns)
 
     def count(self, params):
-        with self.db._get_conn() as conn:
+        kind = self._date_counts.get(tuple(sorted(params)))
+        if kind:
+            return self.db.count_for(kind, params['year'],
+                params.get('month', 0), params.get('day', 0))
+        with self.db._read_conn() as conn:
             fields, values = zip(*params.items())
             query = self._count_pictures % ' AND '.join('%s = ?' % f for f in fields)
             return conn.execute(query, values).fetchone()['count']
 
+    def search(self, text, limit, offset=0, columns=None):
+        """
+        Best matches for `text` on names, file names, notes, cameras and tags
+        """
+        query = fts_query(text)
+        if not query:
+            return []
+        search = self._search % select_columns(columns, 'p')
+        with self.db._read_conn() as conn:
+            return conn.execute(search, [query, limit, offset]).fetchall()
+
+    def count_search(self, text):
+        query = fts_query(text)
+        if not query:
+            return 0
+        with self.db._read_conn() as conn:
+            return conn.execute(self._count_search, [query]).fetchone()['count']
+
     def update(self, key, attr, value):
         with self.db._get_conn() as conn:
             return conn.execute(self._update_picture % attr, [value, key])
 
-    def nav(self, picture_time):
+    def set_service(self, key, service, data, service_id, url):
+        """
+        Stores the `data` a service returned for the picture along with the
+        id and url parsed out of it, so pages don't have to parse it again.
+        """
+        if service not in self.SERVICES:
+            raise ValueError('Unknown service %s' % service)
         with self.db._get_conn() as conn:
+            return conn.execute(self._set_service.format(service),
+                [data, service_id, url, key])
+
+    def nav(self, picture_time):
+        with self.db._read_conn() as conn:
             prev_key = conn.execute(self._prev_pic, [picture_time]).fetchone() or {}
             next_key = conn.execute(self._next_pic, [picture_time]).fetchone() or {}
         return prev_key.get('key'), next_key.get('key')
 
 
+class FacetManager:
+    """
+    Camera, format, orientation and month range filters for the listings.
+    Totals per facet value and month are kept in picture_counts by triggers,
+    so listing the values never groups the pictures table.
+    """
+    FACETS = ('camera', 'format', 'orientation')
+    _counts = ('SELECT k1 value, SUM(total) total FROM picture_counts '
+               'WHERE kind = ? AND (k2, k3) BETWEEN (?, ?) AND (?, ?) '
+               'GROUP BY k1 HAVING SUM(total) > 0 ORDER BY 2 DESC, 1')
+    _value_total = ('SELECT IFNULL(SUM(total), 0) count FROM picture_counts '
+                    'WHERE kind = ? AND k1 = ? AND (k2, k3) BETWEEN (?, ?) '
+                    'AND (?, ?)')
+    _months_total = ('SELECT IFNULL(SUM(total), 0) count FROM picture_counts '
+                     "WHERE kind = 'month' AND (k1, k2) BETWEEN (?, ?) "
+                     'AND (?, ?)')
+    _month_range = '(year, month) BETWEEN (?, ?) AND (?, ?)'
+    _count_pictures = 'SELECT COUNT(*) count FROM pictures WHERE %s'
+
+    def __init__(self, db):
+        self.db = db
+
+    def _months(self, filters):
+        start, end = filters.get('start'), filters.get('end')
+        if not start and not end:
+            # Pictures without a date are counted as (0, 0)
+            return [0, 0, 9999, 12]
+        return list(start or (1, 1)) + list(end or (9999, 12))
+
+    def counts(self, facet, start=None, end=None):
+        """
+        [(value, total)] of `facet` for the pictures taken between the
+        (year, month) `start` and `end`, most common first.
+        """
+        params = [facet] + self._months({'start': start, 'end': end})
+
+        def build(conn):
+            return [(r['value'], r['total'])
+                    for r in conn.execute(self._counts, params)]
+        return self.db.cached('facets:%s' % params, build)
+
+    def _where(self, filters, tags=(), mode=TagManager.ALL):
+        conditions, params = [], []
+        for facet in self.FACETS:
+            value = filters.get(facet)
+            if value is None:
+                continue
+            column = _orientation() if facet == 'orientation' else facet
+            if value == '' and facet != 'orientation':
+                conditions.append("(%s IS NULL OR %s = '')" % (column, column))
+            else:
+                conditions.append('%s = ?' % column)
+                params.append(value)
+        if filters.get('start') or filters.get('end'):
+            conditions.append(self._month_range)
+            params.extend(self._months(filters))
+        if tags:
+            matches, tag_params = self.db.tags._matches(tags, mode)
+            conditions.append('id IN (%s)' % matches)
+            params.extend(tag_params)
+        return ' AND '.join(conditions), params
+
+    def pictures(self, filters, limit, offset=0, tags=(), mode=TagManager.ALL,
+                 before=None, after=None, columns=None):
+        """
+        Pictures matching the facet `filters` and `tags`, newest first.
+        `filters` takes the FACETS values and (year, month) `start`/`end`.
+        """
+        where, params = self._where(filters, tags, mode)
+        return self.db.pictures.page(where, params, limit, offset, before,
+            after, columns)
+
+    def total(self, filters, tags=(), mode=TagManager.ALL):
+        used = [f for f in self.FACETS if filters.get(f) is not None]
+        months = self._months(filters)
+        if tags or len(used) > 1:
+            query, params = self._where(filters, tags, mode)
+            query = self._count_pictures % query
+        elif used:
+            query = self._value_total
+            params = [used[0], filters[used[0]]] + months
+        elif filters.get('start') or filters.get('end'):
+            query, params = self._months_total, months
+        else:
+            return self.db.total_pictures()
+        with self.db._read_conn() as conn:
+            return conn.execute(query, params).fetchone()['count']
+
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180  # Along a meridian
+NEAREST_SPAN = 0.01  # Degrees around the point first looked at by nearest()
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance between two points
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) *
+         math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+
+def _lng_ranges(west, east):
+    """
+    Splits a west to east longitude span crossing the antimeridian in two
+    """
+    if east - west >= 360:
+        return [(-180, 180)]
+    west = (west + 180) % 360 - 180
+    east = (east + 180) % 360 - 180
+    if west <= east:
+        return [(west, east)]
+    return [(west, 180), (-180, east)]
+
+
+class PlaceManager:
+    """
+    Where pictures were taken. Lives in the pictures_geo R*Tree, so box and
+    nearest queries only visit the nodes around the area asked for.
+    """
+    _locate = ('INSERT OR REPLACE INTO pictures_geo (id, min_lat, max_lat, '
+               'min_lng, max_lng, latitude, longitude, altitude) '
+               'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+    _for_picture = ('SELECT latitude, longitude, altitude FROM pictures_geo '
+                    'WHERE id = ?')
+    _box = 'max_lat >= ? AND min_lat <= ? AND max_lng >= ? AND min_lng <= ?'
+    _in_box = ('SELECT %s, g.latitude, g.longitude, g.altitude '
+               'FROM pictures_geo g JOIN pictures p ON p.id = g.id '
+               'WHERE g.' + _box.replace(' AND ', ' AND g.') +
+               ' ORDER BY p.taken_time DESC LIMIT ?')
+    _points_in_box = 'SELECT id, latitude, longitude FROM pictures_geo WHERE ' + _box
+    _by_ids = ('SELECT %s, g.latitude, g.longitude, g.altitude '
+               'FROM pictures_geo g JOIN pictures p ON p.id = g.id '
+               'WHERE g.id IN (%s)')
+
+    def __init__(self, db):
+        self.db = db
+
+    def locate(self, picture_id, latitude, longitude, altitude=None):
+        self.locate_many([(picture_id, latitude, longitude, altitude)])
+
+    def locate_many(self, places):
+        """
+        Stores (picture_id, latitude, longitude, altitude) rows
+        """
+        with self.db._get_conn() as conn:
+            conn.executemany(self._locate, [
+                (picture_id, lat, lat, lng, lng, lat, lng, alt)
+                for picture_id, lat, lng, alt in places])
+            # R*Tree tables can't have triggers, pages show the places
+            conn.execute(_BUMP_VERSION)
+
+    def for_picture(self, picture_id):
+        with self.db._read_conn() as conn:
+            return conn.execute(self._for_picture, [picture_id]).fetchone()
+
+    def in_box(self, south, west, north, east, limit, columns=None):
+        """
+        Newest pictures taken inside the box, `west` greater than `east`
+        means the box crosses the antimeridian.
+        """
+        query = self._in_box % select_columns(columns, 'p')
+        rows = []
+        with self.db._read_conn() as conn:
+            for low, high in _lng_ranges(west, east):
+                rows.extend(conn.execute(query,
+                    [south, north, low, high, limit]).fetchall())
+        if len(rows) > limit:
+            rows.sort(key=lambda r: r['taken_time'] or 0, reverse=True)
+        return rows[:limit]
+
+    def _points_near(self, conn, latitude, longitude, span):
+        # Wide enough in longitude to hold the circle at its poleward edge
+        far_lat = min(abs(latitude) + span, 89.9)
+        lng_span = span / math.cos(math.radians(far_lat))
+        south, north = max(latitude - span, -90), min(latitude + span, 90)
+        points = []
+        for low, high in _lng_ranges(longitude - lng_span, longitude + lng_span):
+            points.extend(conn.execute(self._points_in_box,
+                [south, north, low, high]).fetchall())
+        return points
+
+    def nearest(self, latitude, longitude, limit, columns=None):
+        """
+        The `limit` pictures closest to the point as (km, row) pairs. Boxes
+        around it grow until they hold enough pictures within the circle
+        inscribed in them, anything outside could be beaten by an unseen one.
+        """
+        span = NEAREST_SPAN
+        with self.db._read_conn() as conn:
+            while True:
+                points = sorted(
+                    (distance_km(latitude, longitude, p['latitude'],
+                                 p['longitude']), p['id'])
+                    for p in self._points_near(conn, latitude, longitude, span))
+                radius = span * KM_PER_DEGREE
+                if span >= 180 or sum(1 for d, _ in points if d <= radius) >= limit:
+                    break
+                if len(points) >= limit:
+                    # None can be further than the limit-th seen so far, a
+                    # box holding that circle is the last one needed.
+                    span = points[limit - 1][0] / KM_PER_DEGREE * 1.001
+                else:
+                    span *= 2
+            points = points[:limit]
+            if not points:
+                return []
+            if columns and 'id' not in columns:
+                columns = tuple(columns) + ('id',)
+            query = self._by_ids % (select_columns(columns, 'p'),
+                                    ', '.join('?' * len(points)))
+            rows = {r['id']: r for r in
+                    conn.execute(query, [i for _, i in points]).fetchall()}
+        return [(d, rows[i]) for d, i in points if i in rows]
+
+
+def _count_values(row, amount):
+    """
+    Rows of picture_counts touched by picture `row` (NEW or OLD in triggers)
+    """
+    values = [
+        "('year', IFNULL({0}.year, 0), 0, 0, {1})",
+        "('month', IFNULL({0}.year, 0), IFNULL({0}.month, 0), 0, {1})",
+        "('day', IFNULL({0}.year, 0), IFNULL({0}.month, 0), "
+        "IFNULL({0}.day, 0), {1})",
+    ]
+    return ', '.join(v.format(row, amount) for v in values)
+
+
+def fts_query(text):
+    """
+    Turns user input into an FTS5 query where every word must match as a
+    prefix, quoting them so punctuation can't break the query syntax.
+    """
+    return ' '.join('"%s"*' % word.replace('"', '""') for word in text.split())
+
+
+def _orientation(row=''):
+    """
+    Orientation of picture `row` out of its dimensions. Queries must use the
+    same expression as the pictures_orientation index for it to be used.
+    """
+    prefix = '%s.' % row if row else ''
+    return ("CASE WHEN {0}width > {0}height THEN 'landscape' "
+            "WHEN {0}width < {0}height THEN 'portrait' "
+            "WHEN {0}width = {0}height THEN 'square' ELSE '' END").format(prefix)
+
+
+def _facet_values(row, amount):
+    """
+    Facet rows of picture_counts touched by picture `row`, per value and month
+    """
+    values = [
+        ('camera', "IFNULL({0}.camera, '')".format(row)),
+        ('format', "IFNULL({0}.format, '')".format(row)),
+        ('orientation', _orientation(row)),
+    ]
+    return ', '.join(
+        "('{0}', {1}, IFNULL({2}.year, 0), IFNULL({2}.month, 0), {3})".format(
+            facet, value, row, amount) for facet, value in values)
+
+
+# Tag names of a picture, as indexed in pictures_fts
+_PICTURE_TAGS = ('(SELECT group_concat(t.name, \' \') FROM tagged_pics tp '
+                 'JOIN tags t ON t.id = tp.tag_id WHERE tp.picture_id = %s)')
+
+
+# How many picture_changes entries are kept at least, and how often the
+# older ones are deleted
+CHANGES_KEPT = 10000
+CHANGES_TRIM = 1000
+
+
+_BUMP_VERSION = ("UPDATE catalog_version SET version = version + 1, "
+                 "modified = CAST(strftime('%s', 'now') AS INTEGER);")
+
+
+_COUNT_UPSERT = ('INSERT INTO picture_counts (kind, k1, k2, k3, total) '
+                 'VALUES %s ON CONFLICT (kind, k1, k2, k3) '
+                 'DO UPDATE SET total = total + excluded.total;')
+
+
 class DB(BaseDB):
     _create = (
             'CREATE TABLE IF NOT EXISTS pictures '
@@ -228,7 +844,11 @@ class DB(BaseDB):
             '  taken_time INTEGER,'
             '  upload_time INTEGER,'
             '  exif_read INTEGER,'
-            '  date_taken TEXT'
+            '  date_taken TEXT,'
+            '  flickr_id TEXT,'
+            '  flickr_url TEXT,'
+            '  gphotos_id TEXT,'
+            '  gphotos_url TEXT'
             ');',
             'CREATE TABLE IF NOT EXISTS tags '
             '('
@@ -242,25 +862,319 @@ class DB(BaseDB):
             '  picture_id INTEGER,'
             '  FOREIGN KEY(tag_id) REFERENCES tags(id),'
             '  FOREIGN KEY(picture_id) REFERENCES pictures(id)'
-            ');'
+            ');',
+            'CREATE UNIQUE INDEX IF NOT EXISTS pictures_key ON pictures (key);',
+            'CREATE INDEX IF NOT EXISTS pictures_date ON pictures '
+            '(year, month, day, taken_time);',
+            'CREATE INDEX IF NOT EXISTS pictures_year ON pictures '
+            '(year, taken_time);',
+            'CREATE INDEX IF NOT EXISTS pictures_taken_time ON pictures '
+            '(taken_time);',
+            'CREATE INDEX IF NOT EXISTS pictures_name ON pictures '
+            '(name, checksum);',
+            'CREATE UNIQUE INDEX IF NOT EXISTS tags_name ON tags (name);',
+            'CREATE UNIQUE INDEX IF NOT EXISTS tagged_pics_tag ON tagged_pics '
+            '(tag_id, picture_id);',
+            'CREATE INDEX IF NOT EXISTS tagged_pics_picture ON tagged_pics '
+            '(picture_id);',
+            'CREATE INDEX IF NOT EXISTS pictures_camera ON pictures '
+            '(camera, taken_time);',
+            'CREATE INDEX IF NOT EXISTS pictures_format ON pictures '
+            '(format, taken_time);',
+            'CREATE INDEX IF NOT EXISTS pictures_orientation ON pictures '
+            '(' + _orientation() + ', taken_time);',
+            # Totals per date and tag kept up to date by the triggers below.
+            # Missing parts of the key are 0, NULLs would defeat the primary
+            # key.
+            'CREATE TABLE IF NOT EXISTS picture_counts '
+            '('
+            '  kind TEXT,'
+            '  k1 INTEGER,'
+            '  k2 INTEGER,'
+            '  k3 INTEGER,'
+            '  total INTEGER NOT NULL,'
+            '  PRIMARY KEY (kind, k1, k2, k3)'
+            ') WITHOUT ROWID;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_count_insert '
+            'AFTER INSERT ON pictures BEGIN ' +
+            _COUNT_UPSERT % ("('all', 0, 0, 0, 1), " +
+                             _count_values('NEW', 1)) +
+            ' END;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_count_delete '
+            'AFTER DELETE ON pictures BEGIN ' +
+            _COUNT_UPSERT % ("('all', 0, 0, 0, -1), " +
+                             _count_values('OLD', -1)) +
+            ' END;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_count_update '
+            'AFTER UPDATE OF year, month, day ON pictures '
+            'WHEN OLD.year IS NOT NEW.year OR OLD.month IS NOT NEW.month '
+            'OR OLD.day IS NOT NEW.day BEGIN ' +
+            _COUNT_UPSERT % (_count_values('OLD', -1) + ', ' +
+                             _count_values('NEW', 1)) +
+            ' END;',
+            # Facets are counted per value and month: (facet, value, year,
+            # month)
+            'CREATE TRIGGER IF NOT EXISTS pictures_facets_insert '
+            'AFTER INSERT ON pictures BEGIN ' +
+            _COUNT_UPSERT % _facet_values('NEW', 1) +
+            ' END;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_facets_delete '
+            'AFTER DELETE ON pictures BEGIN ' +
+            _COUNT_UPSERT % _facet_values('OLD', -1) +
+            ' END;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_facets_update '
+            'AFTER UPDATE OF camera, format, width, height, year, month '
+            'ON pictures '
+            'WHEN OLD.camera IS NOT NEW.camera OR OLD.format IS NOT NEW.format '
+            'OR OLD.width IS NOT NEW.width OR OLD.height IS NOT NEW.height '
+            'OR OLD.year IS NOT NEW.year OR OLD.month IS NOT NEW.month BEGIN ' +
+            _COUNT_UPSERT % (_facet_values('OLD', -1) + ', ' +
+                             _facet_values('NEW', 1)) +
+            ' END;',
+            'CREATE TRIGGER IF NOT EXISTS tagged_pics_count_insert '
+            'AFTER INSERT ON tagged_pics BEGIN ' +
+            _COUNT_UPSERT % "('tag', NEW.tag_id, 0, 0, 1)" +
+            ' END;',
+            'CREATE TRIGGER IF NOT EXISTS tagged_pics_count_delete '
+            'AFTER DELETE ON tagged_pics BEGIN ' +
+            _COUNT_UPSERT % "('tag', OLD.tag_id, 0, 0, -1)" +
+            ' END;',
+            # Full text search, the rowid is the picture id
+            'CREATE VIRTUAL TABLE IF NOT EXISTS pictures_fts USING fts5 '
+            '(name, filename, notes, camera, tags);',
+            # Replaced by pictures_fts_add, which indexes the tags a bulk
+            # import links before inserting the picture
+            'DROP TRIGGER IF EXISTS pictures_fts_insert;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_fts_add '
+            'AFTER INSERT ON pictures BEGIN '
+            'INSERT INTO pictures_fts (rowid, name, filename, notes, camera, '
+            'tags) VALUES (NEW.id, NEW.name, NEW.filename, NEW.notes, '
+            'NEW.camera, ' + _PICTURE_TAGS % 'NEW.id' + '); END;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_fts_update '
+            'AFTER UPDATE OF name, filename, notes, camera ON pictures BEGIN '
+            'UPDATE pictures_fts SET name = NEW.name, filename = NEW.filename, '
+            'notes = NEW.notes, camera = NEW.camera WHERE rowid = NEW.id; END;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_fts_delete '
+            'AFTER DELETE ON pictures BEGIN '
+            'DELETE FROM pictures_fts WHERE rowid = OLD.id; END;',
+            'CREATE TRIGGER IF NOT EXISTS tagged_pics_fts_insert '
+            'AFTER INSERT ON tagged_pics BEGIN '
+            'UPDATE pictures_fts SET tags = ' +
+            _PICTURE_TAGS % 'NEW.picture_id' +
+            ' WHERE rowid = NEW.picture_id; END;',
+            'CREATE TRIGGER IF NOT EXISTS tagged_pics_fts_delete '
+            'AFTER DELETE ON tagged_pics BEGIN '
+            'UPDATE pictures_fts SET tags = ' +
+            _PICTURE_TAGS % 'OLD.picture_id' +
+            ' WHERE rowid = OLD.picture_id; END;',
+            # Where pictures were taken, a single point box per picture id.
+            # The R*Tree keeps 32 bit floats, the exact values go alongside.
+            'CREATE VIRTUAL TABLE IF NOT EXISTS pictures_geo USING rtree('
+            '  id, min_lat, max_lat, min_lng, max_lng,'
+            '  +latitude, +longitude, +altitude'
+            ');',
+            'CREATE TRIGGER IF NOT EXISTS pictures_geo_delete '
+            'AFTER DELETE ON pictures BEGIN '
+            'DELETE FROM pictures_geo WHERE id = OLD.id; END;',
+            # Pictures whose place in the timeline (photolog.timeline) may
+            # have changed, so it can refresh just those. Old entries are
+            # trimmed in bulk every CHANGES_TRIM inserts.
+            'CREATE TABLE IF NOT EXISTS picture_changes '
+            '('
+            '  seq INTEGER PRIMARY KEY,'
+            '  picture_id INTEGER'
+            ');',
+            'CREATE TRIGGER IF NOT EXISTS pictures_changes_insert '
+            'AFTER INSERT ON pictures BEGIN '
+            'INSERT INTO picture_changes (picture_id) VALUES (NEW.id); END;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_changes_delete '
+            'AFTER DELETE ON pictures BEGIN '
+            'INSERT INTO picture_changes (picture_id) VALUES (OLD.id); END;',
+            'CREATE TRIGGER IF NOT EXISTS pictures_changes_update '
+            'AFTER UPDATE OF key, taken_time, year, month, day ON pictures '
+            'WHEN OLD.key IS NOT NEW.key OR OLD.taken_time IS NOT '
+            'NEW.taken_time OR OLD.year IS NOT NEW.year OR OLD.month IS NOT '
+            'NEW.month OR OLD.day IS NOT NEW.day BEGIN '
+            'INSERT INTO picture_changes (picture_id) VALUES (NEW.id); END;',
+            'CREATE TRIGGER IF NOT EXISTS tagged_pics_changes_insert '
+            'AFTER INSERT ON tagged_pics BEGIN '
+            'INSERT INTO picture_changes (picture_id) '
+            'VALUES (NEW.picture_id); END;',
+            'CREATE TRIGGER IF NOT EXISTS tagged_pics_changes_delete '
+            'AFTER DELETE ON tagged_pics BEGIN '
+            'INSERT INTO picture_changes (picture_id) '
+            'VALUES (OLD.picture_id); END;',
+            'CREATE TRIGGER IF NOT EXISTS picture_changes_trim '
+            'AFTER INSERT ON picture_changes '
+            'WHEN NEW.seq %% %(trim)d = 0 BEGIN '
+            'DELETE FROM picture_changes WHERE seq <= NEW.seq - %(kept)d; '
+            'END;' % {'trim': CHANGES_TRIM, 'kept': CHANGES_KEPT},
+            # A single row counting the writes to what the web pages show,
+            # for their ETags. Unlike data_version it stays put when the queue
+            # writes its jobs to the same file.
+            'CREATE TABLE IF NOT EXISTS catalog_version '
+            '('
+            '  id INTEGER PRIMARY KEY CHECK (id = 1),'
+            '  version INTEGER NOT NULL,'
+            '  modified INTEGER NOT NULL'
+            ');',
+            "INSERT OR IGNORE INTO catalog_version VALUES "
+            "(1, 0, CAST(strftime('%s', 'now') AS INTEGER));",
+            ) + tuple(
+            'CREATE TRIGGER IF NOT EXISTS %s_version_%s AFTER %s ON %s '
+            'BEGIN %s END;' % (table, event.lower(), event, table,
+                               _BUMP_VERSION)
+            for table in ('pictures', 'tags', 'tagged_pics')
+            for event in ('INSERT', 'UPDATE', 'DELETE'))
+    # Catalogs created before picture_counts existed get their totals
+    # computed once, the 'all' row tells us it was done.
+    _counts_ready = "SELECT 1 FROM picture_counts WHERE kind = 'all'"
+    _backfill_counts = (
+            'DELETE FROM picture_counts',
+            "INSERT INTO picture_counts SELECT 'all', 0, 0, 0, COUNT(*) "
+            'FROM pictures',
+            "INSERT INTO picture_counts SELECT 'year', IFNULL(year, 0), 0, 0, "
+            'COUNT(*) FROM pictures GROUP BY 2',
+            "INSERT INTO picture_counts SELECT 'month', IFNULL(year, 0), "
+            'IFNULL(month, 0), 0, COUNT(*) FROM pictures GROUP BY 2, 3',
+            "INSERT INTO picture_counts SELECT 'day', IFNULL(year, 0), "
+            'IFNULL(month, 0), IFNULL(day, 0), COUNT(*) FROM pictures '
+            'GROUP BY 2, 3, 4',
+            "INSERT INTO picture_counts SELECT 'tag', tag_id, 0, 0, COUNT(*) "
+            'FROM tagged_pics GROUP BY 2',
             )
+    # Every picture has a format row, even if it's ''
+    _facets_ready = ('SELECT NOT EXISTS (SELECT 1 FROM pictures) OR EXISTS '
+                     "(SELECT 1 FROM picture_counts WHERE kind = 'format') ready")
+    _backfill_facets = tuple(
+            "INSERT INTO picture_counts SELECT '%s', %s, IFNULL(year, 0), "
+            'IFNULL(month, 0), COUNT(*) FROM pictures GROUP BY 2, 3, 4' % (
+                facet, value)
+            for facet, value in (('camera', "IFNULL(camera, '')"),
+                                 ('format', "IFNULL(format, '')"),
+                                 ('orientation', _orientation())))
+    _search_ready = ('SELECT NOT EXISTS (SELECT 1 FROM pictures) OR '
+                     'EXISTS (SELECT 1 FROM pictures_fts) ready')
+    _backfill_search = ('INSERT INTO pictures_fts (rowid, name, filename, '
+                        'notes, camera, tags) SELECT p.id, p.name, p.filename, '
+                        'p.notes, p.camera, ' + _PICTURE_TAGS % 'p.id' +
+                        ' FROM pictures p')
+    _get_count = ('SELECT total FROM picture_counts '
+                  'WHERE kind = ? AND k1 = ? AND k2 = ? AND k3 = ?')
     _add_picture = 'INSERT INTO pictures (%(fields)s) VALUES (%(values)s)'
-    _total_pictures = 'SELECT COUNT(*) as count FROM pictures'
-    _get_years = 'SELECT DISTINCT year from pictures ORDER BY year DESC'
-    _get_months = 'SELECT DISTINCT month from pictures WHERE year = ? ORDER BY year DESC'
-    _get_days = 'SELECT DISTINCT day from pictures WHERE year=? AND month=? ORDER BY year DESC'
-    _get_pictures_by_year = ('SELECT * FROM pictures WHERE year = ? ORDER BY '
-                             'taken_time DESC LIMIT ? OFFSET ?')
-    _total_for_year = 'SELECT COUNT(*) count FROM pictures WHERE year = ?'
+    _existing_keys = 'SELECT key FROM pictures WHERE key IN (%s)'
+    # What AUTOINCREMENT would assign next
+    _next_picture_id = ("SELECT MAX(IFNULL(MAX(id), 0), IFNULL((SELECT seq "
+                        "FROM sqlite_sequence WHERE name = 'pictures'), 0)) "
+                        "+ 1 FROM pictures")
+    _get_dates = ("SELECT k1 year, k2 month, k3 day FROM picture_counts "
+                  "WHERE kind = 'day' AND total > 0")
+    _data_version = 'PRAGMA data_version'
+    _catalog_version = 'SELECT version, modified FROM catalog_version'
     _file_exists = 'SELECT COUNT(*) count FROM pictures WHERE name=? AND checksum=?'
 
-    @property
-    def tags(self):
-        return TagManager(self)
+    def __init__(self, path, pragmas=None, readers=0):
+        try:
+            super(DB, self).__init__(path, pragmas, readers)
+        except sqlite3.IntegrityError as err:
+            # Catalogs from before the unique indexes may have duplicates
+            self.close()
+            raise sqlite3.IntegrityError(
+                '%s: merge duplicated tags first with DB_FILE=%s python -m '
+                'photolog.tools.migrations.add_indexes' % (err, path)) from err
+        self.tags = TagManager(self)
+        self.pictures = PictureManager(self)
+        self.places = PlaceManager(self)
+        self.facets = FacetManager(self)
+        self._caches = {}
+        self._fill_counts()
+        self._fill_facets()
+        self._fill_search()
+
+    def _fill_counts(self):
+        with self._get_conn() as conn:
+            if conn.execute(self._counts_ready).fetchone():
+                return
+            conn.execute('BEGIN IMMEDIATE')
+            # Another process may have filled them while we waited
+            if not conn.execute(self._counts_ready).fetchone():
+                for statement in self._backfill_counts:
+                    conn.execute(statement)
+
+    def _fill_facets(self):
+        with self._get_conn() as conn:
+            if conn.execute(self._facets_ready).fetchone()['ready']:
+                return
+            conn.execute('BEGIN IMMEDIATE')
+            if not conn.execute(self._facets_ready).fetchone()['ready']:
+                for statement in self._backfill_facets:
+                    conn.execute(statement)
+
+    def _fill_search(self):
+        with self._get_conn() as conn:
+            if conn.execute(self._search_ready).fetchone()['ready']:
+                return
+            conn.execute('BEGIN IMMEDIATE')
+            if not conn.execute(self._search_ready).fetchone()['ready']:
+                conn.execute(self._backfill_search)
+
+    def cached(self, name, build):
+        """
+        Returns `build(conn)`, reusing the previous result until the catalog
+        is written to, by this connection or by any other one.
+        """
+        with self._read_conn() as conn:
+            # data_version moves on any commit to the file, the queue and
+            # the buckets included. Only then is catalog_version looked at.
+            seen = (
+                conn.execute(self._data_version).fetchone()['data_version'],
+                conn.total_changes)
+            # data_version is only comparable within the same connection
+            cache = self._caches.setdefault(id(conn), {})
+            if cache.get('seen') != seen:
+                version = self._build_version(conn)
+                if cache.get('version') != version:
+                    cache.clear()
+                    cache['version'] = version
+                cache['seen'] = seen
+            if name not in cache:
+                cache[name] = build(conn)
+            return cache[name]
+
+    def _build_version(self, conn):
+        row = conn.execute(self._catalog_version).fetchone()
+        return row['version'], row['modified']
+
+    def catalog_version(self):
+        """
+        (version, modified timestamp) of the catalog, they move on every
+        write to pictures, tags, tagged_pics or the places.
+        """
+        return self.cached('version', self._build_version)
 
-    @property
-    def pictures(self):
-        return PictureManager(self)
+    def _build_dates(self, conn):
+        dates = {}
+        for row in conn.execute(self._get_dates):
+            if not row['year']:
+                continue  # Pictures without a date
+            dates.setdefault(row['year'], {}).setdefault(
+                row['month'], []).append(row['day'])
+        return dates
+
+    def date_tree(self):
+        """
+        {year: {month: [days]}} of the dates that have pictures
+        """
+        return self.cached('dates', self._build_dates)
+
+    def count_for(self, kind, k1=0, k2=0, k3=0):
+        """
+        Reads a total from picture_counts, `kind` is one of all, year,
+        month, day or tag (by tag id).
+        """
+        with self._read_conn() as conn:
+            row = conn.execute(self._get_count, [kind, k1, k2, k3]).fetchone()
+            return row['total'] if row else 0
 
     def add_picture(self, picture_data, tags):
         with self._get_conn() as conn:
@@ -271,36 +1185,86 @@ class DB(BaseDB):
             cur = conn.execute(query, picture_data)
             picture_id = cur.lastrowid
             self.tags.tag_picture(picture_id, tags)
+        return picture_id
 
-    def total_pictures(self):
+    def _new_records(self, conn, records):
+        """
+        Drops the records whose key is in the catalog or earlier in `records`
+        """
+        keys = [picture['key'] for picture, _ in records if 'key' in picture]
+        seen = set()
+        for chunk in chunks(keys):
+            query = self._existing_keys % ', '.join('?' * len(chunk))
+            seen.update(row['key'] for row in conn.execute(query, chunk))
+        new = []
+        for picture, tags in records:
+            key = picture.get('key')
+            if key is None or key not in seen:
+                new.append((picture, tags))
+                seen.add(key)
+        return new
+
+    def add_pictures(self, records, skip_existing=False):
+        """
+        Bulk version of add_picture for (picture_data, tags) records, inserted
+        in one transaction. With `skip_existing` pictures whose key is already
+        in the catalog are left alone instead of failing the import. Returns
+        how many were added.
+        """
+        records = list(records)
+        tag_ids = self.tags.ids({t for _, tags in records for t in tags})
         with self._get_conn() as conn:
-            return conn.execute(self._total_pictures).fetchone()['count']
+            # Nobody else can add pictures until we commit, ids are ours
+            conn.execute('BEGIN IMMEDIATE')
+            if skip_existing:
+                records = self._new_records(conn, records)
+            next_id = max([conn.execute(self._next_picture_id).fetchone()[0]] +
+                          [p['id'] + 1 for p, _ in records if 'id' in p])
+            pictures, links = [], []
+            for picture, tags in records:
+                if 'id' not in picture:
+                    picture = dict(picture, id=next_id)
+                    next_id += 1
+                pictures.append(picture)
+                links.extend([tag_ids[t], picture['id']] for t in
+                             {t.strip().lower() for t in tags} - {''})
+            # Linked before the pictures exist, the tags are indexed for search
+            # once per picture on insert instead of once per tag.
+            conn.executemany(self.tags._tag_picture, links)
+            # Consecutive rows with the same columns share the statement
+            for fields, group in groupby(pictures, lambda p: tuple(sorted(p))):
+                query = self._add_picture % {
+                    'fields': ', '.join(fields),
+                    'values': ', '.join([':%s' % k for k in fields]),
+                }
+                conn.executemany(query, group)
+        return len(pictures)
+
+    def total_pictures(self):
+        return self.count_for('all')
 
     def tagged(self, name):
         return self.tags.pictures_for_tag(name)
 
     def get_years(self):
-        with self._get_conn() as conn:
-            return [y['year'] for y in conn.execute(self._get_years)]
+        return sorted(self.date_tree(), reverse=True)
 
     def get_months(self, year):
-        with self._get_conn() as conn:
-            return [y['month'] for y in conn.execute(self._get_months, [year])]
+        return sorted(self.date_tree().get(year, {}))
 
     def get_days(self, year, month):
-        with self._get_conn() as conn:
-            return [y['day'] for y in conn.execute(self._get_days, [year, month])]
+        return sorted(self.date_tree().get(year, {}).get(month, []))
 
-    def get_pictures_for_year(self, year, limit, offset):
-        with self._get_conn() as conn:
-            return conn.execute(self._get_pictures_by_year, (year, limit, offset))
+    def get_pictures_for_year(self, year, limit, offset, before=None,
+                              after=None, columns=None):
+        return self.pictures.page('year = ?', [year], limit, offset, before,
+            after, columns)
 
     def total_for_year(self, year):
-        with self._get_conn() as conn:
-            return conn.execute(self._total_for_year, [year]).fetchone()['count']
+        return self.count_for('year', year)
 
     def file_exists(self, name, checksum):
-        with self._get_conn() as conn:
+        with self._read_conn() as conn:
             return bool(conn.execute(self._file_exists, [name, checksum]).fetchone()['count'])
 
 
@@ -314,13 +1278,21 @@ class TokensDB(BaseDB):
             '  access_token TEXT,'
             '  refresh_token TEXT,'
             '  expires INTEGER'
+            ');',
+            'CREATE TABLE IF NOT EXISTS token_refresh '
+            '('
+            '  service TEXT PRIMARY KEY,'
+            '  until REAL'
             ');']
+    _write_lock = 'BEGIN IMMEDIATE'
+    _get_refresh = 'SELECT until FROM token_refresh WHERE service = ?'
+    _claim_refresh = ('INSERT OR REPLACE INTO token_refresh (service, until) '
+                      'VALUES (?, ?)')
     _save_token = ('INSERT INTO tokens (service, access_token, token_type, '
                    'refresh_token, expires) VALUES (?,?,?,?,?)')
     _update_token = ('UPDATE tokens SET access_token=?, token_type=?, '
                      'expires=? WHERE service=?')
     _get_token = 'SELECT * FROM tokens WHERE service = ?'
-    _get_expires = 'SELECT expires FROM tokens WHERE service = ? AND access_token = ?'
 
     def save_token(self, service, token, token_type, refresh_token, expires):
         with self._get_conn() as conn:
@@ -333,12 +1305,178 @@ class TokensDB(BaseDB):
             conn.execute(self._update_token, [token, token_type, expires,
                                               service])
 
-    def needs_refresh(self, service, token):
-        with self._get_conn() as conn:
-            response = conn.execute(self._get_expires, [service, token]).fetchone()
-            expires = response['expires']
-            return (time() + self.EXPIRE_WINDOW) > expires
-
     def get_token(self, service):
         with self._get_conn() as conn:
             return conn.execute(self._get_token, [service]).fetchone()
+
+    def claim_refresh(self, service, seconds):
+        """
+        Returns True if the caller may refresh the token for the next
+        `seconds`, False if another process is already on it.
+        """
+        with self._get_conn() as conn:
+            conn.execute(self._write_lock)
+            now = time()
+            claim = conn.execute(self._get_refresh, [service]).fetchone()
+            if claim and claim['until'] > now:
+                return False
+            conn.execute(self._claim_refresh, [service, now + seconds])
+            return True
+
+
+class BucketsDB(BaseDB):
+    """
+    Token buckets shared by every process using the same database file.
+    Tokens are allowed to go negative, the caller then has to wait until they
+    are paid back.
+    """
+    _create = ['CREATE TABLE IF NOT EXISTS rate_buckets '
+            '('
+            '  name TEXT PRIMARY KEY,'
+            '  tokens REAL,'
+            '  updated REAL'
+            ');']
+    _write_lock = 'BEGIN IMMEDIATE'
+    _get_bucket = 'SELECT tokens, updated FROM rate_buckets WHERE name = ?'
+    _save_bucket = ('INSERT OR REPLACE INTO rate_buckets (name, tokens, updated)'
+                    ' VALUES (?, ?, ?)')
+
+    def take(self, name, amount, rate, burst, reserve=True):
+        """
+        Takes `amount` tokens from the bucket `name` which refills at `rate`
+        tokens per second up to `burst`. Returns the seconds the caller has to
+        wait before using them.
+        If `reserve` is False tokens are only taken when available right away.
+        """
+        with self._get_conn() as conn:
+            conn.execute(self._write_lock)
+            now = time()
+            bucket = conn.execute(self._get_bucket, [name]).fetchone()
+            if bucket:
+                elapsed = max(0, now - bucket['updated'])
+                tokens = min(burst, bucket['tokens'] + elapsed * rate)
+            else:
+                tokens = burst
+            if not reserve and tokens < amount:
+                return (amount - tokens) / rate
+            tokens -= amount
+            conn.execute(self._save_bucket, [name, tokens, now])
+        return -tokens / rate if tokens < 0 else 0
+
+
+class PendingItemsDB(BaseDB):
+    """
+    Upload tokens waiting to be turned into media items, so many uploads can
+    be committed together with a single API call.
+    """
+    CLAIM_TIMEOUT = 60 * 10  # Claims from dead workers expire
+    _create = ['CREATE TABLE IF NOT EXISTS pending_items '
+            '('
+            '  upload_token TEXT PRIMARY KEY,'
+            '  service TEXT,'
+            '  key TEXT,'
+            '  status TEXT,'
+            '  created REAL,'
+            '  claimed REAL,'
+            '  result TEXT'
+            ');']
+    _write_lock = 'BEGIN IMMEDIATE'
+    _add_item = ('INSERT OR REPLACE INTO pending_items (upload_token, service,'
+                 " key, status, created) VALUES (?, ?, ?, 'pending', ?)")
+    _get_item = 'SELECT * FROM pending_items WHERE upload_token = ?'
+    _claimable = ('SELECT upload_token, key FROM pending_items WHERE service = ?'
+                  " AND (status = 'pending' OR (status = 'claimed' AND"
+                  ' claimed < ?)) ORDER BY upload_token = ? DESC, created'
+                  ' LIMIT ?')
+    _claim_item = ("UPDATE pending_items SET status = 'claimed', claimed = ?"
+                   ' WHERE upload_token = ?')
+    _resolve_item = ('UPDATE pending_items SET status = ?, result = ?'
+                     ' WHERE upload_token = ?')
+    _release_item = ("UPDATE pending_items SET status = 'pending', claimed = NULL"
+                     ' WHERE upload_token = ?')
+    _remove_item = 'DELETE FROM pending_items WHERE upload_token = ?'
+
+    def add(self, service, upload_token, key):
+        with self._get_conn() as conn:
+            conn.execute(self._add_item, [upload_token, service, key, time()])
+
+    def get(self, upload_token):
+        with self._get_conn() as conn:
+            return conn.execute(self._get_item, [upload_token]).fetchone()
+
+    def claim(self, service, upload_token, size):
+        """
+        Claims up to `size` pending items for `service`, `upload_token` first
+        if it is still pending.
+        """
+        with self._get_conn() as conn:
+            conn.execute(self._write_lock)
+            now = time()
+            items = list(conn.execute(self._claimable, [
+                service, now - self.CLAIM_TIMEOUT, upload_token, size]))
+            conn.executemany(self._claim_item,
+                [(now, i['upload_token']) for i in items])
+            return items
+
+    def resolve(self, upload_token, status, result):
+        with self._get_conn() as conn:
+            conn.execute(self._resolve_item, [status, result, upload_token])
+
+    def release(self, upload_tokens):
+        with self._get_conn() as conn:
+            conn.executemany(self._release_item, [[t] for t in upload_tokens])
+
+    def remove(self, upload_token):
+        with self._get_conn() as conn:
+            conn.execute(self._remove_item, [upload_token])
+
+
+class ServicesDB(BaseDB):
+    """
+    Health of the external services shared by all the workers. A service is
+    blocked when it asks us to back off or after too many failures in a row
+    (circuit breaker), the first call after the block expires probes it.
+    """
+    _create = ['CREATE TABLE IF NOT EXISTS service_state '
+            '('
+            '  service TEXT PRIMARY KEY,'
+            '  blocked_until REAL,'
+            '  failures INTEGER'
+            ');']
+    _get_state = 'SELECT * FROM service_state WHERE service = ?'
+    _add_state = ('INSERT OR IGNORE INTO service_state (service, blocked_until,'
+                  ' failures) VALUES (?, 0, 0)')
+    _block = ('UPDATE service_state SET blocked_until = MAX(blocked_until, ?) '
+              'WHERE service = ?')
+    _add_failure = ('UPDATE service_state SET failures = failures + 1 '
+                    'WHERE service = ?')
+    _open_circuit = ('UPDATE service_state SET blocked_until = ? '
+                     'WHERE service = ? AND failures >= ?')
+    _reset = ('UPDATE service_state SET failures = 0 WHERE service = ? '
+              'AND failures > 0')
+
+    def blocked_for(self, service):
+        """
+        Seconds until `service` can be used again
+        """
+        with self._get_conn() as conn:
+            state = conn.execute(self._get_state, [service]).fetchone()
+        if not state:
+            return 0
+        return max(0, state['blocked_until'] - time())
+
+    def block(self, service, seconds):
+        with self._get_conn() as conn:
+            conn.execute(self._add_state, [service])
+            conn.execute(self._block, [time() + seconds, service])
+
+    def failure(self, service, threshold, cooldown):
+        with self._get_conn() as conn:
+            conn.execute(self._add_state, [service])
+            conn.execute(self._add_failure, [service])
+            conn.execute(self._open_circuit, [time() + cooldown, service,
+                                              threshold])
+
+    def success(self, service):
+        with self._get_conn() as conn:
+            conn.execute(self._reset, [service])
@@ -0,0 +1,244 @@
+"""
+Optional instrumentation of the SQLite connections.
+
+When enabled (`DB_PROFILE` setting) every statement run by a BaseDB
+connection is timed, from execute until its last row is fetched. Statements
+slower than `DB_SLOW_QUERY_MS` go to the DB log with their parameters shape,
+row count and query plan. The Flask apps add the totals of each request as a
+`Server-Timing` header, which browsers show in their network panel.
+"""
+
+import sqlite3
+import threading
+from time import perf_counter
+from urllib.request import pathname2url
+
+from photolog import db_logger as log
+
+profiler = None
+
+
+class Statement(object):
+    __slots__ = ('sql', 'params', 'many', 'path', 'duration', 'rows', 'done')
+
+    def __init__(self, sql, params, many, path):
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.path = path
+        self.duration = 0
+        self.rows = 0
+        self.done = False
+
+    def shape(self):
+        """
+        Describes the parameters without their values
+        """
+        params = self.params
+        if self.many:
+            params = list(params)
+            width = len(params[0]) if params else 0
+            return '%sx%s' % (len(params), width)
+        if isinstance(params, dict):
+            return 'named(%s)' % ', '.join(sorted(params))
+        return str(len(params))
+
+
+class Profiler(object):
+    """
+    Collects the statements of each thread, `begin()` starts counting a new
+    request and `totals()` returns (statements, seconds, rows) since then.
+    """
+    def __init__(self, slow_ms=100, explain=True):
+        self.slow = slow_ms / 1000.0
+        self.explain = explain
+        self._local = threading.local()
+
+    def _state(self):
+        state = self._local
+        if not hasattr(state, 'count'):
+            state.current = None
+            state.count, state.duration, state.rows = 0, 0, 0
+        return state
+
+    def begin(self):
+        state = self._state()
+        self.finish(state.current)
+        state.count, state.duration, state.rows = 0, 0, 0
+
+    def start(self, sql, params, many, path):
+        # Statements that weren't fully fetched end when the next one starts
+        state = self._state()
+        self.finish(state.current)
+        state.current = Statement(sql, params, many, path)
+        return state.current
+
+    def finish(self, statement):
+        if statement is None or statement.done:
+            return
+        statement.done = True
+        state = self._state()
+        state.count += 1
+        state.duration += statement.duration
+        state.rows += statement.rows
+        if statement.duration >= self.slow:
+            self.log_slow(statement)
+        statement.params = None
+
+    def totals(self):
+        state = self._state()
+        self.finish(state.current)
+        return state.count, state.duration, state.rows
+
+    def log_slow(self, statement):
+        plan = self.query_plan(statement) if self.explain else ''
+        log.warning('Slow query %.1fms, %s rows, params %s: %s%s' % (
+            statement.duration * 1000, statement.rows, statement.shape(),
+            ' '.join(statement.sql.split()), plan))
+
+    def query_plan(self, statement):
+        """
+        EXPLAIN QUERY PLAN of the statement, on a connection of its own as
+        the one that ran it may be busy in another thread by now.
+        """
+        if not statement.path:
+            return ''
+        params = statement.params
+        if statement.many:
+            params = next(iter(params), ())
+        try:
+            conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(
+                statement.path), uri=True, timeout=1)
+            try:
+                rows = conn.execute('EXPLAIN QUERY PLAN ' + statement.sql,
+                    params).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return ''
+        return ''.join('\n    %s' % row[-1] for row in rows)
+
+    def server_timing(self):
+        count, duration, rows = self.totals()
+        return 'db;dur=%.2f;desc="%s queries, %s rows"' % (
+            duration * 1000, count, rows)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Adds the time spent executing and fetching to its statement
+    """
+    _statement = None
+
+    def _run(self, method, sql, params, many):
+        conn = self.connection
+        self._statement = conn.profiler.start(sql, params, many, conn.path)
+        started = perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            self._statement.duration += perf_counter() - started
+            if self.description is None:
+                # Nothing to fetch, count what it changed
+                self._statement.rows = max(self.rowcount, 0)
+                self.connection.profiler.finish(self._statement)
+
+    def execute(self, sql, params=()):
+        return self._run(super(TimedCursor, self).execute, sql, params, False)
+
+    def executemany(self, sql, params):
+        if self.connection.profiler.explain and not isinstance(params, list):
+            params = list(params)  # Kept for EXPLAIN if it turns out slow
+        return self._run(super(TimedCursor, self).executemany, sql, params,
+            True)
+
+    def _fetched(self, started, rows, exhausted):
+        statement = self._statement
+        if statement is None:
+            return
+        statement.duration += perf_counter() - started
+        statement.rows += rows
+        if exhausted:
+            self.connection.profiler.finish(statement)
+
+    def fetchone(self):
+        started = perf_counter()
+        row = super(TimedCursor, self).fetchone()
+        self._fetched(started, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = perf_counter()
+        size = self.arraysize if size is None else size
+        rows = super(TimedCursor, self).fetchmany(size)
+        self._fetched(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = perf_counter()
+        rows = super(TimedCursor, self).fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = perf_counter()
+        try:
+            row = super(TimedCursor, self).__next__()
+        except StopIteration:
+            self._fetched(started, 0, True)
+            raise
+        self._fetched(started, 1, False)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    profiler = None
+    path = None
+
+    def cursor(self, factory=TimedCursor):
+        return super(InstrumentedConnection, self).cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+
+def connect(path, *args, **kwargs):
+    """
+    sqlite3.connect, returning an instrumented connection when profiling
+    """
+    if profiler is None:
+        return sqlite3.connect(*args, **kwargs)
+    conn = sqlite3.connect(*args, factory=InstrumentedConnection, **kwargs)
+    conn.profiler = profiler
+    conn.path = path
+    return conn
+
+
+def configure(settings):
+    """
+    Turns profiling on if the settings ask for it, before opening databases
+    """
+    global profiler
+    if getattr(settings, 'DB_PROFILE', False):
+        profiler = Profiler(settings.DB_SLOW_QUERY_MS)
+    return profiler
+
+
+def init_app(app):
+    """
+    Adds the Server-Timing header to the responses of a Flask `app`
+    """
+    if profiler is None:
+        return
+
+    @app.before_request
+    def begin_timing():
+        profiler.begin()
+
+    @app.after_request
+    def server_timing(response):
+        response.headers.add('Server-Timing', profiler.server_timing())
+        return response
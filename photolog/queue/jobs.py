@@ -1,10 +1,19 @@
 import os
 import json
 from time import mktime
-from photolog.services import s3, gphotos, flickr, base
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from photolog.services import s3, gphotos, flickr, base, throttle
 from photolog import queue_logger as log, RAW_FILES, IMAGE_FILES, VIDEO_FILES
 
 
+COMMIT_WAIT = 30
+PUBLISH_THREADS = 4
+
+# Long lived so the service clients of each thread get reused
+publisher = ThreadPoolExecutor(max_workers=PUBLISH_THREADS)
+
+
 def job_fname(filename, settings):
     return os.path.join(settings.UPLOAD_FOLDER, filename)
 
@@ -24,6 +33,11 @@ class BaseJob(object):
 
 class BaseUploadJob(BaseJob):
     format = 'image'
+    services = {  # Steps that depend on an external service
+        'flickr': flickr.SERVICE,
+        'gphotos': gphotos.SERVICE,
+        'gphotos_commit': gphotos.SERVICE,
+    }
 
     def __init__(self, job_data, db, settings):
         super(BaseUploadJob, self).__init__(job_data, db, settings)
@@ -74,6 +88,77 @@ class BaseUploadJob(BaseJob):
             s3_urls, tags, upload_date, exif, self.format,
             checksum, notes=self._get_notes())
 
+    def _gphotos_upload(self, mime):
+        """
+        Uploads the file bytes only, the media item gets created by
+        `gphotos_commit` together with other pending uploads.
+        """
+        # Keeps the resumable upload session if the job has to be retried
+        session = self.data['data'].setdefault('gphotos_session', {})
+        upload_token = gphotos.upload_media(self.settings, self.full_filepath,
+            self.filename, mime, session)
+        gphotos.get_pending(self.settings).add(gphotos.SERVICE, upload_token,
+            self.key)
+        self.data['data']['gphotos_token'] = upload_token
+        log.info("Uploaded %s to Gphotos" % self.key)
+
+    def _gphotos_commit_batch(self, upload_token):
+        """
+        Creates the media items for a batch of pending uploads (this one
+        included) and stores them on each of their pictures.
+        """
+        pending = gphotos.get_pending(self.settings)
+        batch = pending.claim(gphotos.SERVICE, upload_token,
+            gphotos.BATCH_SIZE)
+        if not batch:
+            return
+        tokens = [item['upload_token'] for item in batch]
+        try:
+            results = gphotos.commit_media(self.settings, tokens)
+        except Exception:
+            pending.release(tokens)
+            raise
+        for item in batch:
+            result = results.get(item['upload_token'], {})
+            if 'mediaItem' in result:
+                media_item = result['mediaItem']
+                self.db.pictures.set_service(item['key'], gphotos.SERVICE,
+                    json.dumps({'json': media_item}), media_item.get('id'),
+                    media_item.get('productUrl'))
+                pending.resolve(item['upload_token'], 'done', None)
+            else:
+                pending.resolve(item['upload_token'], 'failed',
+                    json.dumps(result.get('status')))
+        log.info("Created %s Gphotos items" % len(batch))
+
+    def gphotos_commit(self):
+        upload_token = self.data['data'].get('gphotos_token')
+        if not upload_token:
+            return self.data  # Nothing was uploaded
+        pending = gphotos.get_pending(self.settings)
+        item = pending.get(upload_token)
+        if not item or item['status'] == 'failed':
+            # Gphotos refused the upload token, upload again
+            if item:
+                log.info("Gphotos rejected %s: %s" % (self.key, item['result']))
+                pending.remove(upload_token)
+            del self.data['data']['gphotos_token']
+            self.gphotos_upload()
+            upload_token = self.data['data'].get('gphotos_token')
+            if not upload_token:
+                return self.data
+            item = pending.get(upload_token)
+        if item['status'] != 'done':
+            self._gphotos_commit_batch(upload_token)
+            item = pending.get(upload_token)
+        if item['status'] != 'done':
+            # Another worker is committing it, check again later
+            raise throttle.Deferred('Gphotos item for %s not created yet' %
+                                    self.key, COMMIT_WAIT)
+        pending.remove(upload_token)
+        del self.data['data']['gphotos_token']
+        return self.data
+
     def finish_job(self):
         thumbs = self.data['data'].get('thumbs', {})
         base.delete_file(self.full_filepath, thumbs)
@@ -95,7 +180,8 @@ class BaseUploadJob(BaseJob):
                 log.info('Attempt %s for %s - %s' % (job['attempt'], step,
                                                      self.key))
             task = getattr(self, task_name)
-            job = task()
+            with throttle.guard(self.services.get(step), self.settings):
+                job = task()
             if job:
                 job['step'] = next_step
                 job['attempt'] = 0  # Step completed. Start next job fresh
@@ -110,11 +196,18 @@ class BaseUploadJob(BaseJob):
 
 class ImageJob(BaseUploadJob):
     steps = {  # Step function, Next job
-        'upload_and_store': ('local_process', 'flickr'),
+        'upload_and_store': ('local_process', 'publish'),
+        'publish': ('publish', 'gphotos_commit'),
+        # Sequential steps, for jobs queued before `publish`
         'flickr': ('flickr_upload', 'gphotos'),
-        'gphotos': ('gphotos_upload', 'finish'),
+        'gphotos': ('gphotos_upload', 'gphotos_commit'),
+        'gphotos_commit': ('gphotos_commit', 'finish'),
         'finish': ('finish_job', None)
     }
+    branches = {  # Published at the same time by `publish`
+        'flickr': 'flickr_upload',
+        'gphotos': 'gphotos_upload',
+    }
 
     def _generate_thumbs(self):
         thumbs = base.generate_thumbnails(self.full_filepath,
@@ -128,10 +221,10 @@ class ImageJob(BaseUploadJob):
         key = self.key
         flickr_url, photo_id = flickr.upload(self.settings, self.filename,
             self.full_filepath, tags)
-        self.db.pictures.update(key, 'flickr', json.dumps({
+        self.db.pictures.set_service(key, flickr.SERVICE, json.dumps({
             'url': flickr_url,
             'id': photo_id
-        }))
+        }), photo_id, flickr_url)
         log.info("Uploaded %s to Flickr" % key)
         return self.data
 
@@ -143,12 +236,39 @@ class ImageJob(BaseUploadJob):
         if batch_id:
             album_url = base.batch_2_album(batch_id, self.settings,
                 section='feed')
-        gphotos_data = gphotos.upload_photo(self.settings, self.full_filepath,
-            self.filename)
-        self.db.pictures.update(self.key, 'gphotos', json.dumps({
-            'json': gphotos_data
-        }))
-        log.info("Uploaded %s to Gphotos" % self.key)
+        self._gphotos_upload(gphotos.photo_mime(self.filename))
+        return self.data
+
+    def _run_branch(self, name):
+        with throttle.guard(self.services.get(name), self.settings):
+            getattr(self, self.branches[name])()
+
+    def publish(self):
+        """
+        Uploads to every service at the same time. Branches that succeed are
+        recorded so a retried job only runs the ones that failed.
+        """
+        published = self.data['data'].setdefault('published', [])
+        skip = self.data.get('skip', [])
+        pending = [name for name in sorted(self.branches)
+                   if name not in published and name not in skip]
+        log.info('Processing %s - Publishing to %s (%s)' % (self.key,
+            ', '.join(pending), self.filename))
+        running = [(name, publisher.submit(self._run_branch, name))
+                   for name in pending]
+        errors = []
+        for name, future in running:
+            try:
+                future.result()
+            except Exception as err:
+                errors.append(err)
+            else:
+                published.append(name)
+        if errors:
+            # Real failures count as an attempt, deferrals don't
+            failures = [e for e in errors
+                        if not isinstance(e, throttle.Deferred)]
+            raise (failures or errors)[0]
         return self.data
 
     def local_process(self):
@@ -173,7 +293,8 @@ class VideoJob(BaseUploadJob):
     format = 'video'
     steps = {
         'upload_and_store': ('local_process', 'gphotos'),
-        'gphotos': ('gphotos_upload', 'finish'),
+        'gphotos': ('gphotos_upload', 'gphotos_commit'),
+        'gphotos_commit': ('gphotos_commit', 'finish'),
         'finish': ('finish_job', None)
     }
 
@@ -216,14 +337,8 @@ class VideoJob(BaseUploadJob):
         self.data['data']['exif'] = exif
 
     def gphotos_upload(self):
-        batch_id = self.data['batch_id']
         mime = self.data['data']['exif']['mime']
-        gphotos_data = gphotos.upload_video(self.settings, self.full_filepath,
-            self.filename, mime)
-        self.db.pictures.update(self.key, 'gphotos', json.dumps({
-            'xml': gphotos_data
-        }))
-        log.info("Uploaded %s to Gphotos" % self.key)
+        self._gphotos_upload(mime)
         return self.data
 
     def finish_job(self):
@@ -335,16 +450,10 @@ class TagDayJob(BaseJob):
     """
     def process(self):
         data = self.data
-        pictures = list(self.db.pictures.find({
-            'year': data['year'],
-            'month': data['month'],
-            'day': data['day']
-        }))
-        log.info("Tagging day: %s-%s-%s (%s pictures)" % (data['year'],
-            data['month'], data['day'], len(pictures)))
-        tags = data['tags']
-        for picture in pictures:
-            self.db.tags.change_for_picture(picture['id'], tags)
+        log.info("Tagging day: %s-%s-%s" % (data['year'], data['month'],
+            data['day']))
+        self.db.tags.change_for_day(data['year'], data['month'], data['day'],
+            data['tags'])
         log.info("Done")
 
 
@@ -354,31 +463,33 @@ class MassTagJob(BaseJob):
     """
     def process(self):
         data = self.data
-        pictures = list(self.db.pictures.by_keys(data['keys']))
-        log.info("Tagging %s pictures" % len(pictures))
-        tags = data['tags']
-        for picture in pictures:
-            self.db.tags.change_for_picture(picture['id'], tags)
+        log.info("Tagging %s pictures" % len(data['keys']))
+        self.db.tags.change_for_keys(data['keys'], data['tags'])
         log.info("Done")
 
 
+def date_struct(date):
+    return {
+        'year': date.year,
+        'month': date.month,
+        'day': date.day,
+        'taken_time': mktime(date.timetuple()),
+        'date_taken': date.strftime('%Y-%m-%d')
+    }
+
+
 class EditDatesJob(BaseJob):
     """
-    Will receive a list of picture keys and change tags for each of them.
+    Will receive a list of picture keys and change the date for each of them.
     """
     def process(self):
-        changes = self.data['changes']
-        keys, dates = zip(*changes)
-        pictures = {p['key']: p for p in self.db.pictures.by_keys(keys)}
-        log.info("Changing dates for %s pictures" % len(pictures))
-        for key, date in changes:
-            self.db.pictures.change_date(key, {
-                'year': date.year,
-                'month': date.month,
-                'day': date.day,
-                'taken_time': mktime(date.timetuple()),
-                'date_taken': date.strftime('%Y-%m-%d')
-            })
+        by_date = defaultdict(list)
+        # The last change of a key wins, as when they were applied in order
+        for key, date in dict(self.data['changes']).items():
+            by_date[date].append(key)
+        log.info("Changing dates for %s pictures" % len(self.data['changes']))
+        self.db.pictures.change_dates([(keys, date_struct(date))
+                                       for date, keys in by_date.items()])
         log.info("Done")
 
 
@@ -388,21 +499,8 @@ class ChangeDateJob(BaseJob):
     """
     def process(self):
         origin = self.data['origin']
-        target = self.data['target']
-        params = {
-            'year': origin.year,
-            'month': origin.month,
-            'day': origin.day
-        }
-        pictures = list(self.db.pictures.find(params))
-        for pic in pictures:
-            self.db.pictures.change_date(pic['key'], {
-                'year': target.year,
-                'month': target.month,
-                'day': target.day,
-                'taken_time': mktime(target.timetuple()),
-                'date_taken': target.strftime('%Y-%m-%d')
-            })
+        self.db.pictures.change_day(origin.year, origin.month, origin.day,
+            date_struct(self.data['target']))
         log.info("Done")
 
 
@@ -2,10 +2,12 @@ import sys
 import traceback
 
 import os
+from photolog import profiling
 from photolog.db import DB
 from photolog.settings import Settings
 from photolog.squeue import SqliteQueue
 from photolog.queue.jobs import prepare_job
+from photolog.services.throttle import Deferred
 from photolog import queue_logger as log, settings_file
 
 
@@ -25,6 +27,11 @@ def daemon(db, settings, queue):
             queue.append(job)
             log.info('Daemon interrupted')
             daemon_started = False
+        except Deferred as deferred:
+            # Not a failure, try again once the service is available
+            log.info('Deferring %s for %ss: %s' % (job['key'],
+                int(deferred.retry_after), deferred))
+            queue.append(job, delay=deferred.retry_after)
         except Exception as exc:
             ex_type, ex, tb = sys.exc_info()
             traceback.print_tb(tb)
@@ -45,10 +52,12 @@ def daemon(db, settings, queue):
 
 def start():
     settings = Settings.load(settings_file)
-    db = DB(settings.DB_FILE)
+    profiling.configure(settings)
+    db = DB(settings.DB_FILE, settings.DB_PRAGMAS)
     queue = SqliteQueue(settings.DB_FILE)
     ensure_thumbs_folder(settings)
     daemon(db, settings, queue)
+    db.close()
 
 
 def ensure_thumbs_folder(settings):
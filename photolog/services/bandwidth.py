@@ -0,0 +1,131 @@
+# coding: utf-8
+
+"""
+Upload bandwidth governor shared by all the queue workers.
+
+Every outbound transfer (S3, Flickr, Gphotos) reads its file through a
+`ThrottledReader` that takes tokens from a bucket stored in the database, so
+many workers together stay within the configured budget.
+
+The budget is configured with the `UPLOAD_RATE_LIMITS` setting, a list of
+`[start_hour, end_hour, kilobytes_per_second]` entries. The first entry
+matching the current hour wins, ranges can wrap midnight and a rate of 0 (or
+no matching entry) means unlimited:
+
+    UPLOAD_RATE_LIMITS:
+      - [8, 23, 512]   # 512KB/s during the day
+      - [23, 8, 0]     # Unlimited at night
+"""
+
+import os
+from time import sleep
+from datetime import datetime
+
+from photolog.db import BucketsDB
+
+BUCKET = 'upload'
+READ_SIZE = 64 * 1024
+# How many seconds worth of bandwidth a worker reserves at once, so we don't
+# hit the database on every read.
+QUANTUM_SECONDS = 0.25
+
+_buckets = {}
+
+
+def get_buckets(settings):
+    if settings.DB_FILE not in _buckets:
+        _buckets[settings.DB_FILE] = BucketsDB(settings.DB_FILE)
+    return _buckets[settings.DB_FILE]
+
+
+def current_rate(settings, now=None):
+    """
+    Returns the allowed upload rate in bytes per second, or None if uploads
+    are not limited right now.
+    """
+    hour = (now or datetime.now()).hour
+    for start, end, kbps in getattr(settings, 'UPLOAD_RATE_LIMITS', None) or []:
+        if start <= end:
+            matches = start <= hour < end
+        else:
+            matches = hour >= start or hour < end
+        if matches:
+            return kbps * 1024 if kbps else None
+    return None
+
+
+class ThrottledReader(object):
+    """
+    File like object that reads at most `length` bytes from `fh` (from its
+    current position) paying for them on the shared bandwidth bucket.
+
+    It behaves as a file holding just that slice: `len()` is the slice size
+    and `tell()`/`seek()` are relative to its start, which is what requests
+    uses to work out the Content-Length.
+    """
+    def __init__(self, fh, settings, length=None):
+        self.fh = fh
+        self.name = getattr(fh, 'name', None)
+        self.settings = settings
+        self.start = fh.tell()
+        size = os.fstat(fh.fileno()).st_size
+        self.end = size if length is None else min(size, self.start + length)
+        self.allowance = 0
+
+    def __len__(self):
+        return max(0, self.end - self.start)
+
+    def _pay(self, size):
+        if size <= self.allowance:
+            self.allowance -= size
+            return
+        rate = current_rate(self.settings)
+        if not rate:
+            return
+        amount = max(size, int(rate * QUANTUM_SECONDS))
+        wait = get_buckets(self.settings).take(BUCKET, amount, rate, rate)
+        if wait:
+            sleep(wait)
+        self.allowance = amount - size
+
+    def read(self, size=-1):
+        remaining = max(0, self.end - self.fh.tell())
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        chunks = []
+        while size > 0:
+            chunk_size = min(size, READ_SIZE)
+            self._pay(chunk_size)
+            chunk = self.fh.read(chunk_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def tell(self):
+        return self.fh.tell() - self.start
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.fh.seek(self.start + offset)
+        elif whence == os.SEEK_END:
+            self.fh.seek(self.end + offset)
+        else:
+            self.fh.seek(offset, whence)
+        return self.tell()
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def throttled_open(filename, settings, offset=0, length=None):
+    fh = open(filename, 'rb')
+    fh.seek(offset)
+    return ThrottledReader(fh, settings, length)
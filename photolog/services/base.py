@@ -144,7 +144,8 @@ def store_photo(db, key, name, s3_urls, tags, upload_date, exif, format,
         'large': s3_urls.get('large', ''),
         'taken_time': taken_time,
     }
-    db.add_picture(values, tags)
+    picture_id = db.add_picture(values, tags)
+    store_location(db, picture_id, exif)
 
 
 def store_video(db, key, name, s3_urls, tags, upload_date, exif, format,
@@ -173,7 +174,14 @@ def store_video(db, key, name, s3_urls, tags, upload_date, exif, format,
         'large': s3_urls.get('original', ''),
         'taken_time': taken_time,
     }
-    db.add_picture(values, tags)
+    picture_id = db.add_picture(values, tags)
+    store_location(db, picture_id, exif)
+
+
+def store_location(db, picture_id, exif):
+    if exif.get('latitude') is not None:
+        db.places.locate(picture_id, exif['latitude'], exif['longitude'],
+            exif.get('altitude'))
 
 
 def delete_file(filename, thumbs):
@@ -190,6 +198,42 @@ def delete_dir(filename):
     shutil.rmtree(dirname)
 
 
+def _gps_degrees(exif, name):
+    """
+    Reads a GPS degrees, minutes, seconds tag as signed decimal degrees
+    """
+    value, ref = exif.get('GPS GPS%s' % name), exif.get('GPS GPS%sRef' % name)
+    try:
+        degrees, minutes, seconds = [float(v) for v in value.values]
+    except (AttributeError, TypeError, ValueError, ZeroDivisionError):
+        return None
+    decimal = degrees + minutes / 60 + seconds / 3600
+    return -decimal if str(ref).strip().upper() in ('S', 'W') else decimal
+
+
+def gps_coordinates(exif):
+    """
+    Returns (latitude, longitude, altitude) out of the GPS tags, None for
+    the ones that are missing.
+    """
+    latitude = _gps_degrees(exif, 'Latitude')
+    longitude = _gps_degrees(exif, 'Longitude')
+    if latitude is None or longitude is None or not (
+            -90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None, None, None
+    altitude = exif.get('GPS GPSAltitude')
+    try:
+        altitude = float(altitude.values[0])
+    except (AttributeError, IndexError, TypeError, ValueError,
+            ZeroDivisionError):
+        altitude = None
+    else:
+        ref = exif.get('GPS GPSAltitudeRef')
+        if ref and ref.values and ref.values[0] == 1:  # Below sea level
+            altitude = -altitude
+    return latitude, longitude, altitude
+
+
 def read_exif(filename, upload_date, is_image):
     exif = exifread.process_file(open(filename, 'rb'))
     timestamp = None
@@ -211,6 +255,7 @@ def read_exif(filename, upload_date, is_image):
 
     brand = str(exif.get('Image Make', 'Unknown camera'))
     model = str(exif.get('Image Model', ''))
+    latitude, longitude, altitude = gps_coordinates(exif)
 
     return {
         'year': year,
@@ -222,7 +267,10 @@ def read_exif(filename, upload_date, is_image):
         'width': dims[0],
         'height': dims[1],
         'size': os.stat(filename).st_size,
-        'exif_read': exif_read
+        'exif_read': exif_read,
+        'latitude': latitude,
+        'longitude': longitude,
+        'altitude': altitude,
     }
 
 
@@ -0,0 +1,46 @@
+# coding: utf-8
+
+"""
+Long lived clients for the external services.
+
+Each thread keeps its own clients and reuses them for every job it runs, so
+requests go over keep-alive connections instead of paying a TCP+TLS
+handshake every time.
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 10  # Connections kept alive per host
+
+_local = threading.local()
+
+
+def get(name, factory):
+    """
+    Returns this thread's client called `name`, building it with `factory`
+    the first time.
+    """
+    clients = getattr(_local, 'clients', None)
+    if clients is None:
+        clients = _local.clients = {}
+    if name not in clients:
+        clients[name] = factory()
+    return clients[name]
+
+
+def _build_http():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def http():
+    """
+    Keep-alive `requests.Session` for this thread
+    """
+    return get('http', _build_http)
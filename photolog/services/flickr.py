@@ -1,7 +1,11 @@
+import re
+import json
 import flickrapi
 import flickrapi.shorturl
 import flickrapi.auth
 
+from photolog.services import bandwidth, clients, throttle
+
 """
 
 Need to create an app type "Desktop application"
@@ -25,6 +29,9 @@ FLICKR_APP_SECRET = api.flickr_oauth.oauth.client.resource_owner_secret
 
 
 KEY_LOOKUP_USER = 'Photolog'
+SERVICE = 'flickr'
+# flickrapi only tells us about the HTTP status in the error message
+THROTTLED_ERROR = re.compile(r'Status code (429|503) received')
 
 
 def build(settings):
@@ -36,19 +43,33 @@ def build(settings):
     return api
 
 
+def get_api(settings):
+    """
+    FlickrAPI client reused by this thread, keeps its connection alive
+    """
+    return clients.get(SERVICE, lambda: build(settings))
+
+
 def upload(settings, title, filename, tags):
     """
     Uploads the given file to Flickr and returns its url
     """
-    api = build(settings)
-    uploaded = api.upload(
-        filename=filename,
-        tags=' '.join(tags),
-        is_public=0,
-        is_family=0,
-        is_friend=0,
-        title=title,
-    )
+    api = get_api(settings)
+    try:
+        with bandwidth.throttled_open(filename, settings) as fileobj:
+            uploaded = api.upload(
+                filename=filename,
+                fileobj=fileobj,
+                tags=' '.join(tags),
+                is_public=0,
+                is_family=0,
+                is_friend=0,
+                title=title,
+            )
+    except flickrapi.FlickrError as err:
+        if THROTTLED_ERROR.search(str(err)):
+            raise throttle.Throttled(SERVICE)
+        raise
     # Understanding the response
     # https://secure.flickr.com/services/api/upload.api.html
     # https://secure.flickr.com/services/api/response.rest.html
@@ -57,3 +78,15 @@ def upload(settings, title, filename, tags):
         raise ValueError('Error uploading photo to Flickr')
     photo_id = uploaded.find('photoid').text
     return flickrapi.shorturl.url(photo_id), photo_id
+
+
+def parse_data(data):
+    """
+    Returns the (photo id, url) stored in a picture's `flickr` column
+    """
+    try:
+        data = json.loads(data) if data else {}
+    except ValueError:
+        # Bad Json?
+        data = {}
+    return data.get('id'), data.get('url')
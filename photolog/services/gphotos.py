@@ -1,11 +1,16 @@
 import os
+import json
+import mimetypes
+from io import StringIO
+import threading
 from time import time, sleep
 import xml.etree.ElementTree as etree
 from urllib.parse import urlencode, urlunparse
 
 import requests
-from photolog.db import TokensDB
+from photolog.db import TokensDB, PendingItemsDB
 from photolog import queue_logger as log
+from photolog.services import bandwidth, clients, throttle
 
 """
 To obtain a bearer token you must:
@@ -44,6 +49,10 @@ OOB_URL = "urn:ietf:wg:oauth:2.0:oob"
 CODE_ENDPOINT = "https://accounts.google.com/o/oauth2/v2/auth"
 UPLOAD_ENDPOINT = "https://photoslibrary.googleapis.com/v1/uploads"
 ITEM_ENDPOINT = "https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate"
+CHUNK_SIZE = 8 * 2 ** 20  # Bytes sent per request, rounded to the granularity
+DEFAULT_GRANULARITY = 256 * 1024
+RESUME_ATTEMPTS = 3  # Dropped connections resumed before giving up
+BATCH_SIZE = 50  # Max items per mediaItems:batchCreate call
 
 AUTH_ENDPOINT = "https://accounts.google.com/o/oauth2/auth"
 #EXCHANGE_TOKEN_ENDPOINT = "https://oauth2.googleapis.com/token"
@@ -61,6 +70,12 @@ SCOPE = "https://www.googleapis.com/auth/photoslibrary"
 GACCOUNT_HOST = "accounts.google.com"
 GACCOUNT_PATH = "/o/oauth2/v2/auth"
 
+_pending = {}
+_token_caches = {}
+EXPIRY_MARGIN = 60  # Don't use tokens this close to expire
+REFRESH_LEASE = 60  # Seconds a worker has to refresh the token
+REFRESH_WAIT = 10
+
 
 def get_access_code(client_id):
     """
@@ -81,7 +96,7 @@ def get_access_code(client_id):
 
 
 def exchange_token(tokens, client_id, secret, code):
-    response = requests.post(EXCHANGE_TOKEN_ENDPOINT, data={
+    response = clients.http().post(EXCHANGE_TOKEN_ENDPOINT, data={
         'code': code,
         'client_id': client_id,
         'client_secret': secret,
@@ -105,7 +120,7 @@ def exchange_token(tokens, client_id, secret, code):
 
 
 def refresh_access_token(tokens, client_id, secret, refresh_token):
-    response = requests.post(EXCHANGE_TOKEN_ENDPOINT, data={
+    response = clients.http().post(EXCHANGE_TOKEN_ENDPOINT, data={
         'refresh_token': refresh_token,
         'client_id': client_id,
         'client_secret': secret,
@@ -126,70 +141,104 @@ def refresh_access_token(tokens, client_id, secret, refresh_token):
         raise ValueError('Error refreshing %s token: %s' % (SERVICE, response))
 
 
-def _upload_photo(filename, name, access_token, token_type):
-    headers = {
-        'Authorization': '%s %s' % (token_type, access_token),
-        'Content-type': 'application/octet-stream',
-        # 'Content-Length': str(os.stat(filename).st_size),
+def _start_upload(filename, name, mime, authorization):
+    """
+    Opens a resumable upload session, returns its URL and chunk granularity
+    """
+    response = clients.http().post(UPLOAD_ENDPOINT, headers={
+        'Authorization': authorization,
+        'Content-Length': '0',
+        'X-Goog-Upload-Command': 'start',
+        'X-Goog-Upload-Content-Type': mime,
         'X-Goog-Upload-File-Name': name,
-        'X-Goog-Upload-Protocol': 'raw',
-    }
-    files = open(filename, 'rb').read()
-    return do_upload(files, headers)
-
-
-def _upload_video(filename, name, access_token, token_type, mime):
-    metadata = """<entry xmlns='http://www.w3.org/2005/Atom'>
-      <title>%(name)s</title>
-      <summary>%(name)s</summary>
-      <category scheme="http://schemas.google.com/g/2005#kind"
-        term="http://schemas.google.com/photos/2007#photo"/>
-    </entry>""" % {
-        'name': name
-    }
-    metadata = metadata.encode('utf-8')
-    headers = {
-        'GData-Version': '2',
-        'Slug': name,
-        'Content-Type': 'multipart/related',
-        'Authorization': '%s %s' % (token_type, access_token),
-        'Content-Length': str(os.stat(filename).st_size + len(metadata)),
-        'MIME-version': '1.0'
+        'X-Goog-Upload-Protocol': 'resumable',
+        'X-Goog-Upload-Raw-Size': str(os.stat(filename).st_size),
+    })
+    throttle.check_response(SERVICE, response)
+    if response.status_code > 300:
+        log.error('Failed to start upload: %s' % response.text)
+        raise ValueError(response.text)
+    granularity = response.headers.get('X-Goog-Upload-Chunk-Granularity')
+    return {
+        'url': response.headers['X-Goog-Upload-URL'],
+        'granularity': int(granularity or DEFAULT_GRANULARITY),
     }
-    files = [
-        (None, (None, metadata, 'application/atom+xml')),
-        (None, (None, open(filename, 'rb'), mime))
-    ]
-    return do_upload(files, headers)
 
 
-def do_upload(files, headers, retry=True):
+def _uploaded_offset(session, authorization):
     """
-    Follows the steps described in:
-        https://developers.google.com/photos/library/guides/upload-media
-    :param files: The bytes to upload
-    :param headers: dict of headers to upload containing the Authorization
-    :param retry: Boolean to indicate if we should backoff/retry
-    :return: media item ID
+    Asks Gphotos how many bytes of the upload it already has, returns None
+    if the session can't be resumed.
     """
-    try:
-        response = requests.post(UPLOAD_ENDPOINT, data=files, headers=headers)
-    except Exception as err:
-        log.exception(err)
-        raise
+    response = clients.http().post(session['url'], headers={
+        'Authorization': authorization,
+        'Content-Length': '0',
+        'X-Goog-Upload-Command': 'query',
+    })
+    status = response.headers.get('X-Goog-Upload-Status')
+    if response.status_code != 200 or status != 'active':
+        return None
+    return int(response.headers['X-Goog-Upload-Size-Received'])
 
-    if response.status_code == 429:
-        # RESOURCE_EXHAUSTED
-        if retry:
-            log.info("Sleeping for 60s")
-            sleep(60)  # Wait a minute
-            log.info("Retrying")
-            return do_upload(files, headers, retry=False)
-    elif response.status_code > 300:
-        log.error('Failed obtain upload token: %s' % response.text)
-        raise ValueError(response.text)
-    upload_token = response.text
 
+def resumable_upload(settings, filename, name, mime, authorization, session):
+    """
+    Streams the file to Gphotos in chunks using the resumable protocol:
+        https://developers.google.com/photos/library/guides/resumable-uploads
+    :param session: dict where the upload URL is kept, keep it around (ie: on
+        the job data) so a retried upload continues from the last
+        acknowledged byte instead of starting over.
+    :return: upload token
+    """
+    offset = None
+    if session.get('url'):
+        offset = _uploaded_offset(session, authorization)
+    if offset is None:
+        session.update(_start_upload(filename, name, mime, authorization))
+        offset = 0
+    size = os.stat(filename).st_size
+    granularity = session['granularity']
+    chunk_size = max(granularity, CHUNK_SIZE - CHUNK_SIZE % granularity)
+    attempts = 0
+    while True:
+        last = offset + chunk_size >= size
+        try:
+            with bandwidth.throttled_open(filename, settings, offset,
+                    chunk_size) as chunk:
+                length = len(chunk)
+                response = clients.http().post(session['url'], data=chunk, headers={
+                    'Authorization': authorization,
+                    'Content-Length': str(length),
+                    'X-Goog-Upload-Command': 'upload, finalize' if last else 'upload',
+                    'X-Goog-Upload-Offset': str(offset),
+                })
+        except requests.ConnectionError as err:
+            attempts += 1
+            offset = _uploaded_offset(session, authorization)
+            if attempts > RESUME_ATTEMPTS or offset is None:
+                log.exception(err)
+                raise
+            log.info('Resuming upload of %s at byte %s' % (name, offset))
+            continue
+        throttle.check_response(SERVICE, response)
+        if response.status_code > 300:
+            log.error('Failed to upload chunk: %s' % response.text)
+            raise ValueError(response.text)
+        if last:
+            session.clear()
+            return response.text
+        offset += length
+
+
+def create_media_items(upload_tokens, authorization):
+    """
+    Turns up to BATCH_SIZE upload tokens into media items with a single call:
+        https://developers.google.com/photos/library/guides/upload-media
+    :param upload_tokens: Tokens obtained from uploading the bytes
+    :param authorization: Authorization header
+    :return: dict of upload token -> newMediaItemResult, successful ones
+        contain a `mediaItem`
+    """
     new_items = {
         "newMediaItems": [
             {
@@ -197,69 +246,149 @@ def do_upload(files, headers, retry=True):
                 "simpleMediaItem": {
                     "uploadToken": upload_token
                 }
-            }
+            } for upload_token in upload_tokens
         ]
     }
     try:
-        item_response = requests.post(ITEM_ENDPOINT, json=new_items, headers={
-            "Authorization": headers["Authorization"],
+        item_response = clients.http().post(ITEM_ENDPOINT, json=new_items, headers={
+            "Authorization": authorization,
             "Content-Type": "application/json"
         })
     except Exception as err:
         log.exception(err)
         raise
 
-    if item_response.status_code == 429:
-        # RESOURCE_EXHAUSTED
-        if retry:
-            log.info("Sleeping for 60s")
-            sleep(60)  # Wait a minute
-            log.info("Retrying")
-            return do_upload(files, headers, retry=False)
-    elif item_response.status_code > 300:
+    # RESOURCE_EXHAUSTED
+    throttle.check_response(SERVICE, item_response)
+    if item_response.status_code > 300:
         log.error('Failed to upload: %s' % item_response.text)
         raise ValueError(item_response.text)
 
-    new_items_resp = item_response.json()
-    return new_items_resp["newMediaItemResults"][0]["mediaItem"]
+    results = item_response.json()["newMediaItemResults"]
+    return {r["uploadToken"]: r for r in results}
 
 
-def get_token(settings):
-    tokens = TokensDB(settings.DB_FILE)
-    token = tokens.get_token(SERVICE)
-    token_type = 'Bearer'
-    if token:
-        access_token = token['access_token']
-        token_type = token['token_type']
-        if tokens.needs_refresh(SERVICE, access_token):
-            log.info('Refreshing Gphotos token...')
-            access_token = refresh_access_token(tokens,
-                settings.GPHOTOS_CLIENT_ID,
-                settings.GPHOTOS_SECRET,
-                token['refresh_token']
-            )
-            log.info("Token refreshed")
-    else:
-        log.info('Obtaining Gphotos token')
-        #access_token = gphotos.exchange_token(tokens,
-        access_token = exchange_token(tokens,
-            settings.GPHOTOS_CLIENT_ID,
-            settings.GPHOTOS_SECRET,
-            settings.GPHOTOS_ACCESS_CODE)
-        log.info("Token obtained")
-    return access_token, token_type
-
-
-def upload_photo(settings, filename, name):
-    """Uploads the given file to Google Photos and returns its url"""
+def upload_media(settings, filename, name, mime, session=None):
+    """Uploads the bytes of the given file and returns its upload token"""
     access_token, token_type = get_token(settings)
-    return _upload_photo(filename, name, access_token, token_type)
+    authorization = '%s %s' % (token_type, access_token)
+    session = {} if session is None else session
+    return resumable_upload(settings, filename, name, mime, authorization,
+        session)
 
 
-def upload_video(settings, filename, name, mime):
-    """Uploads the given file to Google Photos and returns its url"""
+def commit_media(settings, upload_tokens):
     access_token, token_type = get_token(settings)
-    return _upload_video(filename, name, access_token, token_type, mime)
+    authorization = '%s %s' % (token_type, access_token)
+    return create_media_items(upload_tokens, authorization)
+
+
+def photo_mime(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def parse_data(data):
+    """
+    Returns the (media item id, url) stored in a picture's `gphotos` column
+    """
+    try:
+        data = json.loads(data) if data else {}
+    except ValueError:
+        # Bad Json?
+        return None, None
+    json_data, xml_str = data.get('json'), data.get('xml')
+    if json_data:
+        # Gphotos API (2019)
+        return json_data.get('id'), json_data.get('productUrl')
+    if not xml_str:
+        return None, None
+    # For old photos where it returned XML, Picasa API
+    try:
+        root = etree.parse(StringIO(xml_str)).getroot()
+    except etree.ParseError as e:
+        log.warning('Unreadable Google Photos XML: %s' % e)
+        return None, None
+    links = root.findall('{http://www.w3.org/2005/Atom}link')
+    rel = 'http://schemas.google.com/photos/2007#canonical'
+    matching = [l.attrib['href'] for l in links if l.attrib.get('rel') == rel]
+    photo_ids = root.findall('{http://schemas.google.com/photos/2007}id')
+    return (photo_ids[0].text if photo_ids else None,
+            matching[0] if matching else None)
+
+
+def get_pending(settings):
+    if settings.DB_FILE not in _pending:
+        _pending[settings.DB_FILE] = PendingItemsDB(settings.DB_FILE)
+    return _pending[settings.DB_FILE]
+
+
+class TokenCache(object):
+    """
+    Keeps the access token in memory and refreshes it from a background
+    thread before it expires, so uploads never wait on it. Only one process
+    refreshes at a time, the others pick the new token from the database.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.tokens = TokensDB(settings.DB_FILE)
+        self.lock = threading.Lock()
+        self.token = None
+        self.timer = None
+
+    def get(self):
+        with self.lock:
+            if not self.token or self.token['expires'] - EXPIRY_MARGIN < time():
+                # First use or the background refresh failed
+                self._refresh()
+            return self.token['access_token'], self.token['token_type']
+
+    def _refresh(self):
+        settings = self.settings
+        token = self.tokens.get_token(SERVICE)
+        if not token:
+            log.info('Obtaining Gphotos token')
+            exchange_token(self.tokens,
+                settings.GPHOTOS_CLIENT_ID,
+                settings.GPHOTOS_SECRET,
+                settings.GPHOTOS_ACCESS_CODE)
+            log.info("Token obtained")
+        elif time() + self.tokens.EXPIRE_WINDOW > token['expires']:
+            if self.tokens.claim_refresh(SERVICE, REFRESH_LEASE):
+                log.info('Refreshing Gphotos token...')
+                refresh_access_token(self.tokens,
+                    settings.GPHOTOS_CLIENT_ID,
+                    settings.GPHOTOS_SECRET,
+                    token['refresh_token']
+                )
+                log.info("Token refreshed")
+            elif token['expires'] - EXPIRY_MARGIN < time():
+                # Another worker is refreshing it and ours is not usable
+                sleep(REFRESH_WAIT)
+        self.token = self.tokens.get_token(SERVICE)
+        self._schedule()
+
+    def _schedule(self):
+        if self.timer:
+            self.timer.cancel()
+        delay = self.token['expires'] - self.tokens.EXPIRE_WINDOW - time()
+        self.timer = threading.Timer(max(delay, REFRESH_WAIT),
+            self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        try:
+            with self.lock:
+                self._refresh()
+        except Exception as err:
+            # get() will try again if the token gets too close to expire
+            log.exception(err)
+
+
+def get_token(settings):
+    if settings.DB_FILE not in _token_caches:
+        _token_caches[settings.DB_FILE] = TokenCache(settings)
+    return _token_caches[settings.DB_FILE].get()
 
 
 album_meta = """<entry xmlns='http://www.w3.org/2005/Atom'
@@ -284,10 +413,8 @@ def create_album(album_name, settings):
         'Content-length': str(len(payload.encode('ascii'))),
         'Content-Type': 'application/atom+xml; charset=UTF-8'
     }
-    session = requests.Session()
-    request = requests.Request('POST', UPLOAD_ENDPOINT,
+    response = clients.http().post(UPLOAD_ENDPOINT,
         data=payload.encode('ascii'), headers=headers)
-    response = session.send(request.prepare())
     if response.status_code == 201:
         xml = etree.fromstring(response.text)
         links = [t for t in xml.findall(link_tag) if t.get('rel') == 'self']
@@ -306,7 +433,7 @@ def delete_album(album_url, settings):
         'MIME-version': '1.0',
         'If-Match': '*'
     }
-    response = requests.delete(album_url, headers=headers)
+    response = clients.http().delete(album_url, headers=headers)
     if response.status_code != 200:
         raise ValueError('Failed to delete album')
 
@@ -316,7 +443,7 @@ def clear_album(album_url, settings):
     Removes all photos from an album
     """
     access_token, token_type = get_token(settings)
-    response = requests.get(album_url, headers={
+    response = clients.http().get(album_url, headers={
         'GData-Version': '2',
         'Authorization': '%s %s' % (token_type, access_token),
         'MIME-version': '1.0',
@@ -330,7 +457,7 @@ def clear_album(album_url, settings):
         while group:  # While it has children, remove it
             group.remove(group[0])
     empty_album = etree.tostring(xml)
-    response = requests.put(album_url, data=empty_album, headers={
+    response = clients.http().put(album_url, data=empty_album, headers={
         'GData-Version': '2',
         'Authorization': '%s %s' % (token_type, access_token),
         'MIME-version': '1.0',
@@ -4,9 +4,30 @@ import os
 import math
 from boto.s3.key import Key
 from os.path import basename
+from boto.utils import compute_md5
 from boto.s3.connection import S3Connection
 
 from photolog import queue_logger as log
+from photolog.services import bandwidth, clients
+
+
+def file_md5(filename, offset=0, size=None):
+    """
+    Hashes the file beforehand so boto doesn't read the throttled file twice
+    """
+    with open(filename, 'rb') as fh:
+        fh.seek(offset)
+        return compute_md5(fh, size=size)
+
+
+def get_bucket(settings):
+    """
+    Bucket reused by this thread, boto keeps its connections alive
+    """
+    def build():
+        conn = S3Connection(settings.S3_ACCESS_KEY, settings.S3_SECRET_KEY)
+        return conn.get_bucket(settings.S3_BUCKET, validate=False)
+    return clients.get('s3', build)
 
 
 def upload_thumbs(settings, thumbs, path):
@@ -14,14 +35,14 @@ def upload_thumbs(settings, thumbs, path):
     Receives an object with a list of thumbnails, uploads them to s3 and returns
      another object with the s3 urls of those files
     """
-    conn = S3Connection(settings.S3_ACCESS_KEY, settings.S3_SECRET_KEY)
-    bucket = conn.get_bucket(settings.S3_BUCKET, validate=False)
+    bucket = get_bucket(settings)
     uploaded = {}
     for thumb_name, full_filename in thumbs.items():
         filename = basename(full_filename)
         key = Key(bucket)
         key.key = '%s/%s' % (path, filename)
-        key.set_contents_from_filename(full_filename)
+        with bandwidth.throttled_open(full_filename, settings) as fh:
+            key.set_contents_from_file(fh, md5=file_md5(full_filename))
         key.set_acl('public-read')
         uploaded[thumb_name] = key.generate_url(expires_in=0, query_auth=False)
     return uploaded
@@ -31,8 +52,7 @@ CHUNK_SIZE = int(5e3 * 2 ** 20)
 
 
 def upload_video(settings, video_full_filename, path):
-    conn = S3Connection(settings.S3_ACCESS_KEY, settings.S3_SECRET_KEY)
-    bucket = conn.get_bucket(settings.S3_BUCKET, validate=False)
+    bucket = get_bucket(settings)
     video_filename = basename(video_full_filename)
     video_key = Key(bucket)
     video_key.key = '%s/%s' % (path, video_filename)
@@ -48,9 +68,10 @@ def upload_video(settings, video_full_filename, path):
         part_num = i + 1
 
         log.info("Uploading part " + str(part_num) + " of " + str(chunks_count))
-        with open(video_full_filename, 'rb') as fp:
-            fp.seek(offset)
-            mp.upload_part_from_file(fp=fp, part_num=part_num, size=bytes)
+        with bandwidth.throttled_open(video_full_filename, settings, offset,
+                bytes) as fp:
+            mp.upload_part_from_file(fp=fp, part_num=part_num, size=bytes,
+                md5=file_md5(video_full_filename, offset, bytes))
             log.info("Done part " + str(part_num) + " of " + str(chunks_count))
 
     if len(mp.get_all_parts()) == chunks_count:
@@ -0,0 +1,110 @@
+# coding: utf-8
+
+"""
+Per service rate limiting and circuit breaking for the queue workers.
+
+Job steps that talk to an external service run inside `guard()`. When the
+service is over its quota, asked us to back off (HTTP 429/503) or failed too
+many times in a row, `Throttled` is raised and the daemon defers the job
+instead of sleeping, so the worker keeps processing everything else.
+
+Settings:
+    SERVICE_RATE_LIMITS: {service: calls per minute}
+    CIRCUIT_FAILURES: Failures in a row that open the circuit
+    CIRCUIT_COOLDOWN: Seconds an open circuit stays blocked
+"""
+
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+from photolog.db import ServicesDB
+from photolog.services.bandwidth import get_buckets
+
+DEFAULT_RETRY_AFTER = 60
+THROTTLE_STATUS = {429, 503}
+
+_services = {}
+
+
+class Deferred(Exception):
+    """
+    The job can't go on right now, it should be retried in `retry_after`
+    seconds without counting as a failed attempt.
+    """
+    def __init__(self, message, retry_after=DEFAULT_RETRY_AFTER):
+        super(Deferred, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class Throttled(Deferred):
+    """
+    The service asked us to back off, nobody should call it for a while
+    """
+    def __init__(self, service, retry_after=DEFAULT_RETRY_AFTER):
+        super(Throttled, self).__init__(
+            '%s throttled for %ss' % (service, retry_after), retry_after)
+        self.service = service
+
+
+def get_services(settings):
+    if settings.DB_FILE not in _services:
+        _services[settings.DB_FILE] = ServicesDB(settings.DB_FILE)
+    return _services[settings.DB_FILE]
+
+
+def retry_after(response, default=DEFAULT_RETRY_AFTER):
+    """
+    Reads the Retry-After header, which may be in seconds or an HTTP date
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(1, int(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def check_response(service, response):
+    """
+    Raises Throttled if the service asked us to back off
+    """
+    if response.status_code in THROTTLE_STATUS:
+        raise Throttled(service, retry_after(response))
+
+
+@contextmanager
+def guard(service, settings):
+    if not service:
+        yield
+        return
+    services = get_services(settings)
+    wait = services.blocked_for(service)
+    if wait:
+        raise Throttled(service, wait)
+    per_minute = getattr(settings, 'SERVICE_RATE_LIMITS', {}).get(service)
+    if per_minute:
+        rate = per_minute / 60.0
+        wait = get_buckets(settings).take('service:%s' % service, 1, rate,
+            per_minute, reserve=False)
+        if wait:
+            raise Throttled(service, wait)
+    try:
+        yield
+    except Throttled as err:
+        services.block(service, err.retry_after)
+        raise
+    except Deferred:
+        raise
+    except Exception:
+        services.failure(service, settings.CIRCUIT_FAILURES,
+            settings.CIRCUIT_COOLDOWN)
+        raise
+    else:
+        services.success(service)
@@ -9,6 +9,17 @@ class Settings(object):
     UPLOAD_FOLDER = os.path.join(PROJECT_DIR, 'media')
     THUMBS_FOLDER = os.path.join(UPLOAD_FOLDER, 'thumbs')
     MAX_QUEUE_ATTEMPTS = 3
+    UPLOAD_RATE_LIMITS = []  # [[start_hour, end_hour, KB/s], ...]
+    SERVICE_RATE_LIMITS = {}  # {service: calls per minute}
+    CIRCUIT_FAILURES = 5  # Failures in a row before blocking a service
+    CIRCUIT_COOLDOWN = 60 * 5
+    DB_PRAGMAS = {}  # Overrides for photolog.db.PRAGMAS
+    DB_READERS = 4  # Read only connections kept by the web apps
+    DB_PROFILE = False  # Time queries, see photolog.profiling
+    DB_SLOW_QUERY_MS = 100
+    BACKUP_FOLDER = None
+    BACKUP_INTERVAL = 60 * 60  # Seconds between scheduled backup checks
+    BACKUP_KEEP = 7
 
     @classmethod
     def load(cls, settings_file):
@@ -2,7 +2,7 @@
 
 import os, sqlite3
 from pickle import loads, dumps
-from time import sleep
+from time import sleep, time
 try:
     from _thread import get_ident
 except ImportError:
@@ -23,12 +23,24 @@ class SqliteQueue(object):
             '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
             '  item BLOB'
             ')'
+            ), (
+            'CREATE TABLE IF NOT EXISTS deferred '
+            '('
+            '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            '  item BLOB,'
+            '  due REAL'
+            ')'
             )]
     _count = 'SELECT COUNT(*) count FROM queue'
     _count_bad = 'SELECT COUNT(*) count FROM bad_jobs'
+    _count_deferred = 'SELECT COUNT(*) count FROM deferred'
     _iterate = 'SELECT id, item FROM queue'
     _append = 'INSERT INTO queue (item) VALUES (?)'
     _append_bad = 'INSERT INTO bad_jobs (item) VALUES (?)'
+    _append_deferred = 'INSERT INTO deferred (item, due) VALUES (?, ?)'
+    _promote_deferred = ('INSERT INTO queue (item) SELECT item FROM deferred '
+                         'WHERE due <= ? ORDER BY id')
+    _drop_deferred = 'DELETE FROM deferred WHERE due <= ?'
     _bad_jobs = 'SELECT item FROM bad_jobs ORDER BY id DESC LIMIT ?'
     _bad_jobs_raw = 'SELECT * FROM bad_jobs'
     _write_lock = 'BEGIN IMMEDIATE'
@@ -66,10 +78,17 @@ class SqliteQueue(object):
                                                              timeout=60)
         return self._connection_cache[_id]
 
-    def append(self, obj):
+    def append(self, obj, delay=None):
+        """
+        Adds `obj` at the end of the queue, if `delay` is given it won't be
+        handed out by `popleft` until that many seconds have passed.
+        """
         obj_buffer = memoryview(dumps(obj, 2))
         with self._get_conn() as conn:
-            conn.execute(self._append, (obj_buffer,))
+            if delay:
+                conn.execute(self._append_deferred, (obj_buffer, time() + delay))
+            else:
+                conn.execute(self._append, (obj_buffer,))
 
     def append_bad(self, obj):
         obj_buffer = memoryview(dumps(obj, 2))
@@ -98,6 +117,10 @@ class SqliteQueue(object):
         with self._get_conn() as conn:
             return conn.execute(self._count_bad).fetchone()[0]
 
+    def total_deferred(self):
+        with self._get_conn() as conn:
+            return conn.execute(self._count_deferred).fetchone()[0]
+
     def popleft(self, sleep_wait=True):
         keep_pooling = True
         wait = 0.1
@@ -107,6 +130,10 @@ class SqliteQueue(object):
             _id = None
             while keep_pooling:
                 conn.execute(self._write_lock)
+                now = time()
+                # Deferred jobs that are due go back at the end of the queue
+                conn.execute(self._promote_deferred, (now,))
+                conn.execute(self._drop_deferred, (now,))
                 cursor = conn.execute(self._popleft_get)
                 try:
                     _id, obj_buffer = next(cursor)
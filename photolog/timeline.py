@@ -0,0 +1,373 @@
+"""
+In-memory index of the catalog in taken_time order, for the web process.
+
+Browsing by date is read mostly, so the web keeps the taken_time, id, key,
+date and tags of every picture in arrays sorted by (taken_time, id). Paging,
+date slices and prev/next are binary searches on them, SQLite is only asked
+for the rows of the page being shown.
+
+The DB triggers log the ids of the pictures that change in picture_changes.
+When the catalog's data_version moves only those pictures are read again,
+everything is reloaded when too many changed or the log was trimmed past
+what we had.
+"""
+
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import islice
+from time import mktime
+
+from photolog.db import TagManager, chunks
+
+ALL, ANY = TagManager.ALL, TagManager.ANY
+# Past this many changes reloading everything is cheaper than patching
+RELOAD_AFTER = 500
+# Tags with a bit in the bitmaps, the most used ones. SQLite is quick enough
+# on the rest, they match few pictures.
+TAG_BITS = 64
+
+_ORDERED = ('times', 'ids', 'years', 'months', 'days')
+_ARRAYS = _ORDERED + ('by_id', 'id_times')
+
+
+def _time(taken_time):
+    # Pictures without a time go first, as SQLite sorts NULLs
+    return float('-inf') if taken_time is None else float(taken_time)
+
+
+def _date_bounds(year, month, day):
+    """
+    Timestamps starting and ending a (year, month, day) date, month and day
+    are 0 for whole years and months.
+    """
+    start = datetime(year, month or 1, day or 1)
+    if day:
+        end = start + timedelta(1)
+    elif month:
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+    else:
+        end = datetime(year + 1, 1, 1)
+    return mktime(start.timetuple()), mktime(end.timetuple())
+
+
+class Snapshot(object):
+    """
+    The index at one point in time, not modified once published so requests
+    can read it while a newer one is built. Arrays go by ascending
+    (taken_time, id), tags are a bitmap per picture. by_id and id_times are
+    the ids and times in id order, to find where a picture is.
+    """
+    def __init__(self):
+        self.times = array('d')
+        self.ids = array('q')
+        self.years = array('H')
+        self.months = array('B')
+        self.days = array('B')
+        self.by_id = array('q')
+        self.id_times = array('d')
+        self.keys = []
+        self.tags = []
+        self.counts = {}  # {(year, month, day): total}, 0 for missing parts
+        self.bits = {}  # {tag id: bit}
+        self.tag_ids = {}  # {tag name: tag id}
+        self.seq = 0  # Last picture_changes entry applied
+        self._ranges = {}
+
+    def copy(self):
+        other = Snapshot()
+        for name in _ARRAYS:
+            setattr(other, name, getattr(self, name)[:])
+        other.keys = self.keys[:]
+        other.tags = self.tags[:]
+        other.counts = dict(self.counts)
+        other.bits = dict(self.bits)
+        other.tag_ids = dict(self.tag_ids)
+        other.seq = self.seq
+        return other
+
+    def bit(self, tag_id):
+        """
+        The bit of a tag, given out while there are some left
+        """
+        bit = self.bits.get(tag_id)
+        if bit is None and len(self.bits) < TAG_BITS:
+            bit = self.bits[tag_id] = len(self.bits)
+        return bit
+
+    def mask(self, tag_ids):
+        return sum(1 << bit for bit in
+                   {self.bits.get(tag_id) for tag_id in tag_ids} - {None})
+
+    def _count(self, year, month, day, amount):
+        for date in ((year, 0, 0), (year, month, 0), (year, month, day)):
+            self.counts[date] = self.counts.get(date, 0) + amount
+
+    def fill(self, pictures):
+        """
+        Loads the (id, key, taken_time, year, month, day) of all `pictures`,
+        given in id order.
+        """
+        ids, keys, times, years, months, days = list(zip(*pictures)) or [()] * 6
+        times = array('d', map(_time, times))
+        self.by_id, self.id_times = array('q', ids), times
+        # Being stable, the sort leaves pictures taken at once in id order
+        order = sorted(range(len(ids)), key=times.__getitem__)
+        self.times = array('d', [times[i] for i in order])
+        self.ids = array('q', [ids[i] for i in order])
+        self.keys = [keys[i] for i in order]
+        self.years = array('H', [years[i] for i in order])
+        self.months = array('B', [months[i] for i in order])
+        self.days = array('B', [days[i] for i in order])
+        self.tags = [0] * len(ids)
+        for date, total in Counter(zip(years, months, days)).items():
+            self._count(*date, total)
+
+    def insert(self, picture_id, key, taken_time, year, month, day, tags):
+        taken_time = _time(taken_time)
+        i = self.position(taken_time, picture_id)
+        self.times.insert(i, taken_time)
+        self.ids.insert(i, picture_id)
+        self.years.insert(i, year)
+        self.months.insert(i, month)
+        self.days.insert(i, day)
+        self.keys.insert(i, key)
+        self.tags.insert(i, tags)
+        i = bisect_left(self.by_id, picture_id)
+        self.by_id.insert(i, picture_id)
+        self.id_times.insert(i, taken_time)
+        self._count(year, month, day, 1)
+
+    def remove(self, picture_id):
+        """
+        Takes the picture out if it's there
+        """
+        by_id = self.by_id
+        i = bisect_left(by_id, picture_id)
+        if i == len(by_id) or by_id[i] != picture_id:
+            return
+        taken_time = self.id_times[i]
+        del by_id[i]
+        del self.id_times[i]
+        i = self.position(taken_time, picture_id)
+        self._count(self.years[i], self.months[i], self.days[i], -1)
+        for name in _ORDERED:
+            del getattr(self, name)[i]
+        del self.keys[i]
+        del self.tags[i]
+
+    def position(self, taken_time, picture_id):
+        """
+        Index of the first picture at or after (taken_time, picture_id)
+        """
+        lo = bisect_left(self.times, taken_time)
+        hi = bisect_right(self.times, taken_time, lo)
+        return bisect_left(self.ids, picture_id, lo, hi)
+
+    def date_range(self, date):
+        """
+        (start, end) indexes of the pictures taken on a (year, [month,
+        [day]]) date. None if their taken_time doesn't agree with their date
+        columns, those can't be sliced by time.
+        """
+        date = tuple(date) + (0,) * (3 - len(date))
+        if date not in self._ranges:
+            self._ranges[date] = self._date_range(*date)
+        return self._ranges[date]
+
+    def _date_range(self, year, month, day):
+        total = self.counts.get((year, month, day), 0)
+        if not total:
+            return 0, 0
+        try:
+            start, end = _date_bounds(year, month, day)
+        except (ValueError, OverflowError):
+            return None  # Undated pictures
+        lo = bisect_left(self.times, start)
+        hi = bisect_left(self.times, end, lo)
+        if hi - lo != total:
+            return None
+        for values, value in ((self.years, year), (self.months, month),
+                              (self.days, day)):
+            if value and values[lo:hi].count(value) != total:
+                return None
+        return lo, hi
+
+    def tag_matcher(self, tags, mode=ALL):
+        """
+        Test on the tags bitmaps for pictures having all or any of `tags`.
+        False if no picture can match them, None if some of the tags have no
+        bit.
+        """
+        names = {t.strip().lower() for t in tags} - {''}
+        tag_ids = {self.tag_ids.get(n) for n in names} - {None}
+        if not tag_ids or (mode == ALL and len(tag_ids) < len(names)):
+            return False  # No such tags
+        if any(self.bits.get(t) is None for t in tag_ids):
+            return None
+        mask = self.mask(tag_ids)
+        if mode == ALL:
+            return lambda t: t & mask == mask
+        return lambda t: t & mask
+
+    def page(self, limit, offset=0, before=None, after=None, lo=0, hi=None,
+             match=None):
+        """
+        Ids between the `lo` and `hi` indexes, newest first. The cursors work
+        like in PictureManager.page(), `match` filters on the tags bitmap.
+        """
+        hi = len(self.ids) if hi is None else hi
+        if before:
+            hi = min(hi, self.position(_time(before[0]), before[1]))
+            indexes = range(hi - 1, lo - 1, -1)
+        elif after:
+            # Walk up from the cursor and flip the page afterwards
+            lo = max(lo, self.position(_time(after[0]), after[1] + 1))
+            indexes = range(lo, hi)
+        else:
+            indexes = range(hi - 1, lo - 1, -1)
+        if match is None:
+            picked = list(indexes[offset:offset + limit])
+        else:
+            tags = self.tags
+            picked = list(islice((i for i in indexes if match(tags[i])),
+                                 offset, offset + limit))
+        if after and not before:
+            picked.reverse()
+        return [self.ids[i] for i in picked]
+
+
+class Timeline(object):
+    _changes = 'SELECT MIN(seq) first, MAX(seq) last FROM picture_changes'
+    _last_change = 'SELECT IFNULL(MAX(seq), 0) seq FROM picture_changes'
+    _changed = 'SELECT DISTINCT picture_id FROM picture_changes WHERE seq > ?'
+    _columns = ('SELECT id, key, taken_time, IFNULL(year, 0) year, '
+                'IFNULL(month, 0) month, IFNULL(day, 0) day FROM pictures ')
+    _pictures = _columns + 'ORDER BY id'
+    _changed_pictures = _columns + 'WHERE id IN (%s)'
+    # Pictures per tag, the most used first so they get the lowest bits and
+    # most bitmaps stay small
+    _tagged = ('SELECT tag_id, group_concat(picture_id) FROM tagged_pics '
+               'INDEXED BY tagged_pics_tag GROUP BY tag_id '
+               'ORDER BY COUNT(*) DESC LIMIT ?')
+    _changed_tags = ('SELECT picture_id, tag_id FROM tagged_pics '
+                     'WHERE picture_id IN (%s)')
+    _new_tags = 'SELECT id, name FROM tags WHERE id > ?'
+
+    def __init__(self, db):
+        self.db = db
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def _last_seq(self, conn):
+        return conn.execute(self._last_change).fetchone()['seq']
+
+    def current(self):
+        """
+        The index, refreshed first if the catalog changed since
+        """
+        seq = self.db.cached('timeline_seq', self._last_seq)
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.seq < seq:
+            with self._lock:
+                # Another thread may have refreshed it while we waited
+                if self._snapshot is None or self._snapshot.seq < seq:
+                    self._snapshot = self._refresh(self._snapshot)
+                snapshot = self._snapshot
+        return snapshot
+
+    def _refresh(self, snapshot):
+        with self.db._read_conn() as conn:
+            # All reads from the same version of the catalog
+            conn.execute('BEGIN')
+            try:
+                first, last = conn.execute(self._changes).fetchone()
+                if (snapshot is None or first is None or
+                        first > snapshot.seq + 1 or
+                        last - snapshot.seq > RELOAD_AFTER):
+                    fresh = self._load(conn)
+                else:
+                    changed = [row['picture_id'] for row in
+                               conn.execute(self._changed, [snapshot.seq])]
+                    fresh = self._update(conn, snapshot, changed)
+                fresh.seq = last or 0
+            finally:
+                conn.execute('COMMIT')
+        return fresh
+
+    def _add_tags(self, conn, snapshot):
+        last = max(snapshot.tag_ids.values(), default=0)
+        for row in conn.execute(self._new_tags, [last]):
+            snapshot.tag_ids[row['name']] = row['id']
+
+    def _load(self, conn):
+        snapshot = Snapshot()
+        # Plain tuples, much cheaper than records for the whole catalog
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        snapshot.fill(cursor.execute(self._pictures).fetchall())
+        indexes = {picture_id: i for i, picture_id in enumerate(snapshot.ids)}
+        tags = snapshot.tags
+        for tag_id, picture_ids in cursor.execute(self._tagged, [TAG_BITS]):
+            mask = 1 << snapshot.bit(tag_id)
+            for picture_id in map(int, picture_ids.split(',')):
+                i = indexes.get(picture_id)
+                if i is not None:
+                    tags[i] |= mask
+        self._add_tags(conn, snapshot)
+        return snapshot
+
+    def _update(self, conn, snapshot, changed):
+        fresh = snapshot.copy()
+        for picture_id in changed:
+            fresh.remove(picture_id)
+        # Deleted pictures are simply not found again
+        pictures, tags = [], {}
+        for chunk in chunks(changed):
+            marks = ', '.join('?' * len(chunk))
+            pictures.extend(conn.execute(self._changed_pictures % marks, chunk))
+            for picture_id, tag_id in conn.execute(
+                    self._changed_tags % marks, chunk):
+                fresh.bit(tag_id)
+                tags.setdefault(picture_id, set()).add(tag_id)
+        for row in pictures:
+            fresh.insert(*row, fresh.mask(tags.get(row['id'], ())))
+        self._add_tags(conn, fresh)
+        return fresh
+
+    def page(self, limit, offset=0, before=None, after=None, date=(),
+             tags=(), mode=ALL):
+        """
+        Ids of a page of pictures newest first, see PictureManager.page().
+        `date` is a (year, [month, [day]]) tuple, `tags` must all (or any,
+        depending on `mode`) be on the pictures. Returns None when the date
+        can't be sliced from the index or some tag has no bit, SQLite has to
+        answer then.
+        """
+        snapshot = self.current()
+        lo, hi = 0, len(snapshot.ids)
+        if date:
+            date_range = snapshot.date_range(date)
+            if date_range is None:
+                return None
+            lo, hi = date_range
+        match = None
+        if tags:
+            match = snapshot.tag_matcher(tags, mode)
+            if not match:
+                return match if match is None else []
+        return snapshot.page(limit, offset, before, after, lo, hi, match)
+
+    def nav(self, taken_time, picture_id):
+        """
+        Keys of the pictures taken right before and after the given one
+        """
+        snapshot = self.current()
+        ids, keys = snapshot.ids, snapshot.keys
+        i = snapshot.position(_time(taken_time), picture_id)
+        following = i + 1 if i < len(ids) and ids[i] == picture_id else i
+        prev_key = keys[i - 1] if i > 0 else None
+        next_key = keys[following] if following < len(keys) else None
+        return prev_key, next_key
@@ -0,0 +1,97 @@
+"""
+Bulk imports pictures into the catalog from NDJSON, one picture per line
+with its `pictures` columns and an optional `tags` list (or comma separated
+string):
+
+    {"key": "a1b2", "name": "IMG_001.jpg", "year": 2019, "tags": ["beach"]}
+
+    SETTINGS=settings.yaml photolog_import pictures.ndjson
+
+Lines are inserted in batches, each one in a single transaction. Use `-` to
+read from stdin.
+
+Expect around 8-9k pictures per second with a couple of tags each and 12k
+without. Most of that time goes to the catalog triggers that run for every
+row and tag link (totals, facets, search, change log and catalog version),
+not to the inserts themselves.
+"""
+
+import sys
+import json
+import argparse
+from itertools import islice
+from time import time
+
+from photolog import cli_logger as log, settings_file
+from photolog.db import DB
+from photolog.settings import Settings
+
+BATCH_SIZE = 5000
+
+
+def read_records(lines, columns, keep_ids=False):
+    """
+    Yields (picture_data, tags) out of NDJSON `lines`, dropping the fields
+    that are not `columns` of the pictures table.
+    """
+    if not keep_ids:
+        columns = columns - {'id'}
+    for line in lines:
+        if not line.strip():
+            continue
+        picture = json.loads(line)
+        tags = picture.pop('tags', None) or []
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        yield {k: v for k, v in picture.items() if k in columns}, tags
+
+
+def import_records(db, records, batch_size=BATCH_SIZE, skip_existing=False):
+    total = 0
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return total
+        total += db.add_pictures(batch, skip_existing)
+
+
+def run():
+    settings = Settings.load(settings_file)
+    parser = argparse.ArgumentParser(
+        description="Import pictures into the Photolog catalog from NDJSON"
+    )
+    parser.add_argument('files', type=str, nargs='+',
+        help="NDJSON files to import, - for stdin")
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE,
+        help="Pictures inserted per transaction")
+    parser.add_argument('--skip-existing', action='store_true',
+        help="Skip pictures whose key is already in the catalog")
+    parser.add_argument('--keep-ids', action='store_true',
+        help="Keep the picture ids from the file")
+    parsed = parser.parse_args()
+
+    db = DB(settings.DB_FILE, settings.DB_PRAGMAS)
+    with db._get_conn() as conn:
+        columns = {row['name'] for row in
+                   conn.execute('PRAGMA table_info(pictures)')}
+    try:
+        for filename in parsed.files:
+            start = time()
+            fh = sys.stdin if filename == '-' else open(filename)
+            try:
+                records = read_records(fh, columns, parsed.keep_ids)
+                total = import_records(db, records, parsed.batch,
+                    parsed.skip_existing)
+            finally:
+                if fh is not sys.stdin:
+                    fh.close()
+            elapsed = time() - start
+            log.info('Imported %s pictures from %s in %.1fs (%d/s)' % (
+                total, filename, elapsed, total / max(elapsed, 0.001)))
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    run()
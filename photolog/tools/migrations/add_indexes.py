@@ -0,0 +1,36 @@
+import os
+import sqlite3
+from photolog.db import DB
+
+DB_FILE = os.environ['DB_FILE']
+
+# Duplicated tags and tag links would make the unique indexes fail, so they
+# are merged first. DB() creates the indexes on startup, that's why we talk
+# to the file directly here.
+SCRIPT = """
+UPDATE tagged_pics SET tag_id = (
+  SELECT MIN(dupe.id) FROM tags JOIN tags dupe ON dupe.name = tags.name
+  WHERE tags.id = tagged_pics.tag_id
+);
+DELETE FROM tags WHERE id NOT IN (SELECT MIN(id) FROM tags GROUP BY name);
+DELETE FROM tagged_pics WHERE id NOT IN
+  (SELECT MIN(id) FROM tagged_pics GROUP BY tag_id, picture_id);
+DROP INDEX IF EXISTS year_idx;
+DROP INDEX IF EXISTS month_idx;
+DROP INDEX IF EXISTS day_idx;
+DROP INDEX IF EXISTS key_idx;
+"""
+
+
+def migrate(conn):
+    conn.executescript(SCRIPT)
+    for statement in DB._create:
+        conn.execute(statement)
+    conn.execute('ANALYZE')
+
+
+if __name__ == '__main__':
+    conn = sqlite3.connect(DB_FILE)
+    with conn:
+        migrate(conn)
+    conn.close()
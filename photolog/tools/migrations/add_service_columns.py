@@ -0,0 +1,69 @@
+"""
+Adds the flickr/gphotos id and url columns and fills them from the stored
+service responses, so detail pages read them instead of parsing JSON and XML.
+
+Rows are processed in batches of BATCH_SIZE, each in its own transaction, so
+the queue can keep writing while this runs.
+"""
+
+import os
+import sqlite3
+import xml.etree.ElementTree as etree
+from photolog.services import flickr, gphotos
+
+DB_FILE = os.environ['DB_FILE']
+BATCH_SIZE = 500
+
+COLUMNS = ('flickr_id', 'flickr_url', 'gphotos_id', 'gphotos_url')
+BATCH = ('SELECT id, flickr, gphotos FROM pictures WHERE id > ? AND '
+         '(flickr IS NOT NULL OR gphotos IS NOT NULL) ORDER BY id LIMIT ?')
+UPDATE = ('UPDATE pictures SET flickr_id = ?, flickr_url = ?, '
+          'gphotos_id = ?, gphotos_url = ? WHERE id = ?')
+
+
+def add_columns(conn):
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(pictures)')}
+    with conn:
+        for column in COLUMNS:
+            if column not in existing:
+                conn.execute('ALTER TABLE pictures ADD COLUMN %s TEXT' % column)
+
+
+def parse_row(row):
+    """
+    The UPDATE values for a picture, None if its data can't be read
+    """
+    try:
+        return (flickr.parse_data(row['flickr']) +
+                gphotos.parse_data(row['gphotos']) + (row['id'],))
+    except (ValueError, AttributeError, etree.ParseError) as e:
+        print('Skipping picture %s, unreadable service data: %s' % (
+            row['id'], e))
+        return None
+
+
+def backfill(conn, batch_size=BATCH_SIZE):
+    last_id, total = 0, 0
+    while True:
+        rows = conn.execute(BATCH, [last_id, batch_size]).fetchall()
+        if not rows:
+            break
+        updates = [u for u in map(parse_row, rows) if u]
+        with conn:
+            conn.executemany(UPDATE, updates)
+        last_id = rows[-1]['id']
+        total += len(rows)
+        print('Updated %s pictures' % total)
+    return total
+
+
+def migrate(conn):
+    add_columns(conn)
+    backfill(conn)
+
+
+if __name__ == '__main__':
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    migrate(conn)
+    conn.close()
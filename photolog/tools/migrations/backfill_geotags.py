@@ -0,0 +1,71 @@
+"""
+Reads the GPS position of the pictures uploaded before geotags were stored.
+
+Only the beginning of each original is downloaded (a ranged GET), that's
+where JPEG and most RAW files keep their EXIF. Pictures are walked by id in
+batches, START_ID lets an interrupted run carry on where it stopped.
+"""
+
+import os
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import exifread
+import requests
+from photolog.db import DB
+from photolog.services import clients
+from photolog.services.base import gps_coordinates
+
+DB_FILE = os.environ['DB_FILE']
+START_ID = int(os.environ.get('START_ID', 0))
+HEAD_BYTES = 128 * 1024
+BATCH_SIZE = 200
+WORKERS = 8
+
+PENDING = ("SELECT id, original FROM pictures p WHERE id > ? AND "
+           "format IN ('image', 'raw') AND original != '' AND "
+           "NOT EXISTS (SELECT 1 FROM pictures_geo g WHERE g.id = p.id) "
+           "ORDER BY id LIMIT ?")
+
+
+def read_location(picture):
+    try:
+        # Streamed, in case the server ignores the range and sends it all
+        response = clients.http().get(picture['original'], timeout=30,
+            stream=True, headers={'Range': 'bytes=0-%s' % (HEAD_BYTES - 1)})
+        with response:
+            if response.status_code not in (200, 206):
+                return None
+            head = response.raw.read(HEAD_BYTES, decode_content=True)
+    except requests.RequestException:
+        return None
+    try:
+        exif = exifread.process_file(BytesIO(head), details=False)
+    except Exception:
+        return None  # Truncated or unreadable
+    latitude, longitude, altitude = gps_coordinates(exif)
+    if latitude is None:
+        return None
+    return picture['id'], latitude, longitude, altitude
+
+
+def backfill(db, start_id=0):
+    last_id, found = start_id, 0
+    with ThreadPoolExecutor(WORKERS) as pool:
+        while True:
+            with db._read_conn() as conn:
+                batch = conn.execute(PENDING, [last_id, BATCH_SIZE]).fetchall()
+            if not batch:
+                break
+            places = [p for p in pool.map(read_location, batch) if p]
+            db.places.locate_many(places)
+            last_id = batch[-1]['id']
+            found += len(places)
+            print('Up to id %s, %s pictures located' % (last_id, found))
+    return found
+
+
+if __name__ == '__main__':
+    db = DB(DB_FILE)
+    backfill(db, START_ID)
+    db.close()
@@ -5,6 +5,7 @@ import argparse
 from time import time
 from hashlib import md5
 from urllib.parse import urljoin
+from photolog.services import clients
 from photolog.services.base import file_checksum
 from photolog import cli_logger as log, ALLOWED_FILES, IMAGE_FILES, RAW_FILES, VIDEO_FILES
 
@@ -29,7 +30,7 @@ def read_local_conf(conf_file=None):
 
 def start_batch(endpoint, secret):
     batch_endpoint = urljoin(endpoint, 'batch/')
-    response = requests.post(batch_endpoint, headers={
+    response = clients.http().post(batch_endpoint, headers={
         'X-PHOTOLOG-SECRET': secret
     })
     batch_id = response.json()['batch_id']
@@ -40,7 +41,7 @@ def verify_exists(host, full_filepath, secret):
     verification = urljoin(host, '/photos/verify/')
     checksum = file_checksum(full_filepath)
     filename = os.path.basename(full_filepath)
-    response = requests.get(verification, params={
+    response = clients.http().get(verification, params={
         'filename': filename,
         'checksum': checksum
     }, headers={
@@ -114,7 +115,7 @@ def handle_file(host, full_file, secret, tags, skip, halt, target_date):
                         metadata_file = find_metadata_file(full_file)
                         if metadata_file:
                             files['metadata_file'] = open(metadata_file, 'rb')
-                    response = requests.post(endpoint, data=post_data, files=files, headers={
+                    response = clients.http().post(endpoint, data=post_data, files=files, headers={
                         'X-PHOTOLOG-SECRET': secret
                     })
                     return response.status_code == 201
@@ -2,27 +2,35 @@ import os
 import math
 import json
 import uuid
-import requests
-from io import StringIO
-from urllib.parse import urljoin, parse_qsl
-import xml.etree.ElementTree as etree
+import hashlib
+from calendar import timegm
+from functools import wraps
+from urllib.parse import urljoin, parse_qsl, urlencode
+from time import time
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, abort, send_file
+from flask import Flask, Response, render_template, request, redirect, url_for, abort, jsonify, make_response
 from flask_login import LoginManager, login_required, login_user, UserMixin, logout_user
+from werkzeug.http import http_date
 
 from photolog import web_logger as log, settings_file
+from photolog import backup as backup_snapshot
+from photolog import profiling
 from photolog.db import DB
 from photolog.settings import Settings
 from photolog.squeue import SqliteQueue
-from photolog.services import base
+from photolog.timeline import Timeline
+from photolog.services import base, clients, flickr, gphotos
 
 INDIEAUTH_ENDPOINT = 'https://indieauth.com/auth'
 
 settings = Settings.load(settings_file)
-db = DB(settings.DB_FILE)
+profiling.configure(settings)
+db = DB(settings.DB_FILE, settings.DB_PRAGMAS, settings.DB_READERS)
 queue = SqliteQueue(settings.DB_FILE)
+timeline = Timeline(db)
 app = Flask(__name__)
 app.secret_key = settings.SECRET_KEY
+profiling.init_app(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -47,6 +55,71 @@ def load_user(user_id):
 
 
 PAGE_SIZE = 24
+PLACES_LIMIT = 100
+PLACES_MAX = 1000
+
+
+def pages_release():
+    """
+    Part of every ETag, changes when a deploy brings new code, templates or
+    static files but is the same for every worker running them.
+    """
+    web = os.path.dirname(os.path.abspath(__file__))
+    files = [os.path.abspath(__file__)]
+    for folder in ('templates', 'static'):
+        for root, _, names in os.walk(os.path.join(web, folder)):
+            files.extend(os.path.join(root, name) for name in names)
+    release = hashlib.sha1()
+    for path in sorted(files):
+        stat = os.stat(path)
+        release.update(('%s %s %s\n' % (os.path.relpath(path, web),
+            stat.st_mtime_ns, stat.st_size)).encode())
+    return release.hexdigest()[:16]
+
+
+PAGES_RELEASE = pages_release()
+
+
+def page_etag(version):
+    """
+    Identifies the requested page, route and arguments, as rendered from
+    `version` of the catalog.
+    """
+    page = '%s %s' % (PAGES_RELEASE, request.full_path)
+    return '%s-%s' % (version, hashlib.sha1(page.encode()).hexdigest()[:16])
+
+
+def not_modified(etag, modified):
+    # The ETag wins, dates only tell apart writes a second away (RFC 7232 6)
+    if 'If-None-Match' in request.headers:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and modified <= timegm(since.utctimetuple())
+
+
+def conditional(view):
+    """
+    Pages that only show the catalog answer 304 to browsers that have them
+    for its current version, without running the view.
+    """
+    @wraps(view)
+    def conditional_view(*args, **kwargs):
+        version, modified = db.catalog_version()
+        etag = page_etag(version)
+        if not_modified(etag, modified):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        # Another write may still land within the same second
+        if modified < int(time()):
+            response.headers['Last-Modified'] = http_date(modified)
+        # Cached by the browser only, and checked with us every time
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return conditional_view
 
 
 def human_size(size):
@@ -59,7 +132,33 @@ def human_size(size):
     return '0B'
 
 
-def get_paginator(total, page_size, current):
+def parse_cursor(value):
+    """
+    Reads a `taken_time:id` listing cursor, taken_time is empty for
+    undated pictures
+    """
+    try:
+        taken_time, picture_id = (value or '').split(':')
+        return float(taken_time) if taken_time else None, int(picture_id)
+    except ValueError:
+        return None
+
+
+def picture_cursor(picture):
+    taken_time = picture['taken_time']
+    return '%s:%s' % ('' if taken_time is None else taken_time, picture['id'])
+
+
+def page_cursors():
+    """
+    Returns the (before, after) cursors of the requested page
+    """
+    before = parse_cursor(request.args.get('before'))
+    after = parse_cursor(request.args.get('after'))
+    return before, after
+
+
+def get_paginator(total, page_size, current, pictures=()):
     total_pages = math.ceil(total / page_size)
     next_page = current + 1 if current < total_pages else None
     prev_page = current - 1 if current > 1 else None
@@ -74,74 +173,62 @@ def get_paginator(total, page_size, current):
         'total_pages': total_pages,
         'next': next_page,
         'prev': prev_page,
-        'adjacent': adjacent
+        'adjacent': adjacent,
+        # Prev/next links seek from the edges of this page instead of
+        # making SQLite skip over all the previous rows.
+        'after': picture_cursor(pictures[0]) if pictures else '',
+        'before': picture_cursor(pictures[-1]) if pictures else '',
     }
 
 
-def pictures_for_page(db, page_num, tags=None, year=None):
-    offset, limit = (page_num - 1) * PAGE_SIZE, PAGE_SIZE
+def page_offset(page_num):
+    before, after = page_cursors()
+    if before or after:
+        return 0, before, after
+    return (page_num - 1) * PAGE_SIZE, None, None
+
+
+def pictures_for_page(db, page_num, tags=None, year=None, mode=None,
+                      month=None, day=None):
+    limit, columns = PAGE_SIZE, db.pictures.THUMB_COLUMNS
+    offset, before, after = page_offset(page_num)
+    mode = mode or db.tags.ALL
+    date = tuple(v for v in (year, month, day) if v)
+    # The timeline picks the page, SQLite only reads those rows
+    ids = timeline.page(limit, offset, before, after, date, tags or (), mode)
+    if ids is not None:
+        return db.pictures.by_ids(ids, columns)
     if tags:
-        db_pics = list(db.tags.tagged_pictures(tags, limit, offset))
-    elif year:
-        db_pics = list(db.get_pictures_for_year(year, limit, offset))
-    else:
-        db_pics = list(db.pictures.get_all(limit, offset))
-    return db_pics
-
-
-def get_flickr_data(picture):
-    data = picture.get('flickr')
-    flickr = {'id': '', 'url': ''}
-    if data:
-        try:
-            flickr = json.loads(data)
-        except ValueError:
-            # Bad Json?
-            pass
-    return flickr
-
-
-def get_gphotos_data(picture):
-    picture_data = picture.get('gphotos')
-    photo_id, url = '', ''
-    if picture_data:
-        try:
-            picture_data = json.loads(picture_data)
-        except ValueError:
-            # Bad Json?
-            pass
-        else:
-            xml_str = picture_data.get('xml')
-            json_data = picture_data.get('json')
-            if json_data:
-                # Gphotos API (2019)
-                photo_id = json_data['id']
-                url = json_data['productUrl']
-            elif xml_str:
-                # For old photos where it returned XML, Picasa API
-                xml = etree.parse(StringIO(xml_str))
-                root = xml.getroot()
-                links = root.findall('{http://www.w3.org/2005/Atom}link')
-                rel = 'http://schemas.google.com/photos/2007#canonical'
-                matching = [l.attrib['href'] for l in links
-                            if l.attrib['rel'] == rel]
-                id_node = '{http://schemas.google.com/photos/2007}id'
-                photo_ids = root.findall(id_node)
-                photo_id = photo_ids[0].text if photo_ids else ''
-                url = matching[0] if matching else ''
+        return list(db.tags.tagged_pictures(tags, limit, offset, mode, before,
+            after, columns))
+    # Dates whose pictures don't sort together by taken_time
+    params = dict(zip(('year', 'month', 'day'), date))
+    return list(db.pictures.find(params, limit, offset, before, after,
+        columns))
+
+
+# Parse what we store from each service into its id and url columns
+SERVICE_PARSERS = {
+    flickr.SERVICE: flickr.parse_data,
+    gphotos.SERVICE: gphotos.parse_data,
+}
+
+
+def get_service_data(picture, service):
     return {
-        'url': url,
-        'id': photo_id
+        'id': picture.get(service + '_id') or '',
+        'url': picture.get(service + '_url') or '',
     }
 
 
 @app.route('/', methods=['GET'])
 @login_required
+@conditional
 def index():
     db_total = db.total_pictures()
     all_tags = db.tags.all()
     years = db.get_years()
-    recent = list(db.pictures.recent(24, 0))
+    recent = list(db.pictures.recent(24, 0, db.pictures.THUMB_COLUMNS))
     ctx = {
         'recent': recent,
         'total': db_total,
@@ -154,11 +241,12 @@ def index():
 
 @app.route('/photo/', methods=['GET'])
 @login_required
+@conditional
 def photo_list():
     page = int(request.args.get('page', '1'))
     pictures = pictures_for_page(db, page)
     db_total = db.total_pictures()
-    paginator = get_paginator(db_total, PAGE_SIZE, page)
+    paginator = get_paginator(db_total, PAGE_SIZE, page, pictures)
     all_tags = db.tags.all()
     years = db.get_years()
     ctx = {
@@ -171,8 +259,8 @@ def photo_list():
     return render_template('photo_list.html', **ctx)
 
 
-def get_pic_nav(taken_time):
-    prev_key, next_key = db.pictures.nav(taken_time)
+def get_pic_nav(picture):
+    prev_key, next_key = timeline.nav(picture['taken_time'], picture['id'])
     return {
         'prev': url_for('picture_detail', key=prev_key) if prev_key else '',
         'next': url_for('picture_detail', key=next_key) if next_key else ''
@@ -181,16 +269,18 @@ def get_pic_nav(taken_time):
 
 @app.route('/photo/<string:key>/')
 @login_required
+@conditional
 def picture_detail(key):
     picture = db.pictures.by_key(key)
     tags = db.tags.for_picture(picture['id'])
-    nav = get_pic_nav(picture['taken_time'])
+    nav = get_pic_nav(picture)
     return render_template('detail.html', **{
         'picture': picture,
         'tags': tags,
         'human_size': human_size(picture['size']),
-        'flickr': get_flickr_data(picture),
-        'gphotos': get_gphotos_data(picture),
+        'flickr': get_service_data(picture, flickr.SERVICE),
+        'gphotos': get_service_data(picture, gphotos.SERVICE),
+        'location': db.places.for_picture(picture['id']),
         'nav': nav,
         'month': '%02d' % picture['month'],
         'day': '%02d' % picture['day'],
@@ -222,12 +312,16 @@ def edit_attr(key):
     if request.method == 'GET':
         return render_template('edit_attr.html', **{
             'picture': picture,
-            'blob': json.dumps(picture, indent=2),
+            'blob': json.dumps(dict(picture), indent=2),
         })
     else:
         attr = request.form['attr']
         value = request.form['value']
         confirm = request.form.get('confirm')
+        if confirm and attr in SERVICE_PARSERS:
+            db.pictures.set_service(key, attr, value,
+                *SERVICE_PARSERS[attr](value))
+            return redirect(url_for('picture_detail_blob', key=key))
         if confirm and attr in picture:
             db.pictures.edit_attribute(key, attr, value)
             return redirect(url_for('picture_detail_blob', key=key))
@@ -239,7 +333,7 @@ def picture_detail_blob(key):
     picture = db.pictures.by_key(key)
     return render_template('detail_blob.html', **{
         'picture': picture,
-        'blob': json.dumps(picture, indent=2),
+        'blob': json.dumps(dict(picture), indent=2),
     })
 
 
@@ -321,16 +415,23 @@ def change_date():
 
 @app.route('/tags/<string:tag_list>/')
 @login_required
+@conditional
 def view_tags(tag_list):
     page = int(request.args.get('page', '1'))
+    mode = request.args.get('mode', db.tags.ALL)
+    if mode not in (db.tags.ALL, db.tags.ANY):
+        mode = db.tags.ALL
     tags = [t.lower() for t in tag_list.split(',') if t]
-    pictures = pictures_for_page(db, page, tags)
-    tagged_total = db.tags.total_for_tags(tags)
-    paginator = get_paginator(tagged_total, PAGE_SIZE, page)
+    if not tags:
+        abort(404)
+    pictures = pictures_for_page(db, page, tags, mode=mode)
+    tagged_total = db.tags.total_for_tags(tags, mode)
+    paginator = get_paginator(tagged_total, PAGE_SIZE, page, pictures)
     all_tags = db.tags.all()
     years = db.get_years()
     ctx = {
         'selected_tags': tags,
+        'tag_mode': mode,
         'all_tags': all_tags,
         'pictures': pictures,
         'paginator': paginator,
@@ -340,6 +441,77 @@ def view_tags(tag_list):
     return render_template('photo_list.html', **ctx)
 
 
+# Query arguments of /browse/ carried along by its links
+BROWSE_ARGS = ('camera', 'format', 'orientation', 'start', 'end', 'tags',
+               'mode')
+
+
+def parse_month(value):
+    """
+    Reads a YYYY-MM month as (year, month)
+    """
+    year, month = value.split('-')
+    return int(year), int(month)
+
+
+def facet_links(query, facet, counts):
+    links = []
+    for value, total in counts:
+        current = query.get(facet) == value
+        link_query = {k: v for k, v in query.items() if k != facet}
+        if not current:
+            link_query[facet] = value
+        links.append({
+            'label': value or 'Unknown',
+            'total': total,
+            'current': current,
+            'url': '%s?%s' % (url_for('browse'), urlencode(link_query)),
+        })
+    return links
+
+
+@app.route('/browse/')
+@login_required
+@conditional
+def browse():
+    """
+    Listing narrowed by camera, format, orientation, a month range and tags
+    """
+    page = int(request.args.get('page', '1'))
+    # An empty facet value filters the pictures that don't have one
+    query = {k: request.args[k] for k in BROWSE_ARGS if request.args.get(k)
+             or (k in db.facets.FACETS and k in request.args)}
+    mode = query.get('mode', db.tags.ALL)
+    if mode not in (db.tags.ALL, db.tags.ANY):
+        mode = db.tags.ALL
+    tags = [t.lower() for t in query.get('tags', '').split(',') if t]
+    filters = {f: query[f] for f in db.facets.FACETS if f in query}
+    try:
+        for name in ('start', 'end'):
+            if name in query:
+                filters[name] = parse_month(query[name])
+    except ValueError:
+        abort(400)
+    offset, before, after = page_offset(page)
+    pictures = list(db.facets.pictures(filters, PAGE_SIZE, offset, tags,
+        mode, before, after, db.pictures.THUMB_COLUMNS))
+    total = db.facets.total(filters, tags, mode)
+    facets = [(facet, facet_links(query, facet, db.facets.counts(facet,
+        filters.get('start'), filters.get('end'))))
+        for facet in db.facets.FACETS]
+    ctx = {
+        'browse_query': query,
+        'facets': facets,
+        'page_query': '?%s&' % urlencode(query) if query else '?',
+        'pictures': pictures,
+        'paginator': get_paginator(total, PAGE_SIZE, page, pictures),
+        'total': total,
+        'all_tags': db.tags.all(),
+        'years': db.get_years(),
+    }
+    return render_template('photo_list.html', **ctx)
+
+
 def months_tags(months, month):
     return [{
         'month': '%02d' % m,
@@ -358,11 +530,12 @@ def days_tags(days, current):
 
 @app.route('/date/<int:year>/')
 @login_required
+@conditional
 def view_year(year):
     page = int(request.args.get('page', '1'))
     pictures = pictures_for_page(db, page, tags=None, year=year)
     tagged_total = db.total_for_year(year)
-    paginator = get_paginator(tagged_total, PAGE_SIZE, page)
+    paginator = get_paginator(tagged_total, PAGE_SIZE, page, pictures)
     all_tags = db.tags.all()
     years = db.get_years()
     present_months = db.get_months(year)
@@ -380,16 +553,16 @@ def view_year(year):
 
 @app.route('/date/<int:year>/<int:month>/')
 @login_required
+@conditional
 def view_month(year, month):
     page = int(request.args.get('page', '1'))
     params = {
         'year': year,
         'month': month
     }
-    offset, limit = (page - 1) * PAGE_SIZE, PAGE_SIZE
-    pictures = db.pictures.find(params, limit, offset)
+    pictures = pictures_for_page(db, page, **params)
     tagged_total = db.pictures.count(params)
-    paginator = get_paginator(tagged_total, PAGE_SIZE, page)
+    paginator = get_paginator(tagged_total, PAGE_SIZE, page, pictures)
     all_tags = db.tags.all()
     years = db.get_years()
     present_months = db.get_months(year)
@@ -410,6 +583,7 @@ def view_month(year, month):
 
 @app.route('/date/<int:year>/<int:month>/<int:day>/')
 @login_required
+@conditional
 def view_day(year, month, day):
     page = int(request.args.get('page', '1'))
     params = {
@@ -417,10 +591,9 @@ def view_day(year, month, day):
         'month': month,
         'day': day
     }
-    offset, limit = (page - 1) * PAGE_SIZE, PAGE_SIZE
-    pictures = db.pictures.find(params, limit, offset)
+    pictures = pictures_for_page(db, page, **params)
     tagged_total = db.pictures.count(params)
-    paginator = get_paginator(tagged_total, PAGE_SIZE, page)
+    paginator = get_paginator(tagged_total, PAGE_SIZE, page, pictures)
     all_tags = db.tags.all()
     years = db.get_years()
     present_months = db.get_months(year)
@@ -495,8 +668,9 @@ def serial_job(obj):
 def view_queue():
     result = queue.peek(200)
     size = len(queue)
+    deferred = queue.total_deferred()
     return render_template('jobs.html',
-        jobs=result, size=size)
+        jobs=result, size=size, deferred=deferred)
 
 
 @app.route('/jobs/bad/', methods=['POST'])
@@ -551,7 +725,65 @@ def search():
             'name': name
         })
         return redirect(url_for('picture_detail', key=pic['key']))
-    return render_template('search.html')
+    query = request.args.get('q', '').strip()
+    if not query:
+        return render_template('search.html')
+    page = int(request.args.get('page', '1'))
+    offset = (page - 1) * PAGE_SIZE
+    pictures = db.pictures.search(query, PAGE_SIZE, offset,
+        db.pictures.THUMB_COLUMNS)
+    total = db.pictures.count_search(query)
+    ctx = {
+        'search_query': query,
+        'page_query': '?%s&' % urlencode({'q': query}),
+        'pictures': pictures,
+        'paginator': get_paginator(total, PAGE_SIZE, page),
+        'total': total,
+        'all_tags': db.tags.all(),
+        'years': db.get_years(),
+    }
+    return render_template('photo_list.html', **ctx)
+
+
+def place_json(picture, distance=None):
+    place = {
+        'key': picture['key'],
+        'name': picture['name'],
+        'thumb': picture['thumb'],
+        'url': url_for('picture_detail', key=picture['key']),
+        'latitude': picture['latitude'],
+        'longitude': picture['longitude'],
+        'altitude': picture['altitude'],
+    }
+    if distance is not None:
+        place['distance_km'] = round(distance, 3)
+    return place
+
+
+@app.route('/places/')
+@login_required
+def places():
+    """
+    Geotagged pictures as JSON, the newest ones inside
+    ?bbox=south,west,north,east or the closest ones to ?lat=&lng=
+    """
+    columns = db.pictures.THUMB_COLUMNS
+    try:
+        limit = max(1, min(int(request.args.get('limit', PLACES_LIMIT)),
+            PLACES_MAX))
+        if 'bbox' in request.args:
+            south, west, north, east = [
+                float(v) for v in request.args['bbox'].split(',')]
+            found = [(None, p) for p in db.places.in_box(south, west, north,
+                east, limit, columns)]
+        else:
+            found = db.places.nearest(float(request.args['lat']),
+                float(request.args['lng']), limit, columns)
+    except (KeyError, ValueError):
+        abort(400)
+    return jsonify({
+        'pictures': [place_json(p, distance) for distance, p in found]
+    })
 
 
 @app.route('/backup/', methods=['GET', 'POST'])
@@ -559,8 +791,11 @@ def search():
 def backup():
     if request.method == 'POST':
         today = datetime.now().date()
-        return send_file(settings.DB_FILE,
-            as_attachment=True, attachment_filename='backup-%s.db' % today)
+        return Response(backup_snapshot.stream_snapshot(settings.DB_FILE),
+            mimetype='application/gzip', headers={
+                'Content-Disposition':
+                    'attachment; filename=backup-%s.db.gz' % today
+            })
     db_size = human_size(os.stat(settings.DB_FILE).st_size)
     return render_template('backup.html', db_size=db_size)
 
@@ -572,7 +807,7 @@ def login():
     redirect_uri = urljoin(settings.DOMAIN, url_for('login'))
     client_id = settings.DOMAIN
     if code and me:
-        r = requests.post(INDIEAUTH_ENDPOINT, data={
+        r = clients.http().post(INDIEAUTH_ENDPOINT, data={
             'code': code,
             'redirect_uri': redirect_uri,
             'client_id': client_id
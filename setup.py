@@ -19,7 +19,9 @@ setup(
             'start_queue=photolog.queue.main:start',
             'start_web=photolog.web.main:start',
             'upload2photolog=photolog.tools.uploader:run',
-            'prep_folder=photolog.tools.prep_folder:run'
+            'prep_folder=photolog.tools.prep_folder:run',
+            'photolog_backup=photolog.backup:run',
+            'photolog_import=photolog.tools.importer:run'
         ]
     }
 )
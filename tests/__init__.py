@@ -15,8 +15,8 @@ TEST_FILES = os.path.join(TESTS_DIR, 'files')
 class TestDbBase(TestCase):
     @classmethod
     def setUpClass(cls):
-        shutil.rmtree(TEST_FILES)
-        os.makedirs(TEST_FILES)
+        shutil.rmtree(TEST_FILES, ignore_errors=True)
+        os.makedirs(TEST_FILES, exist_ok=True)
 
     def get_db(self, db_filename):
         db_file = os.path.join(TEST_FILES, db_filename)
@@ -0,0 +1,42 @@
+import os
+import gzip
+import sqlite3
+
+from . import TestDbBase, TEST_FILES
+from photolog.backup import Scheduler, stream_snapshot
+
+
+class TestBackup(TestDbBase):
+    def test_stream_snapshot(self):
+        db = self.get_db('test_backup.db')
+        db.add_picture({'key': '1', 'name': 'one'}, ['a'])
+        data = gzip.decompress(b''.join(stream_snapshot(db.path)))
+        db.close()
+        # The temporary snapshot is gone once streamed
+        self.assertFalse([f for f in os.listdir(TEST_FILES)
+                          if f.startswith('tmp') and f.endswith('.db')])
+        copy = os.path.join(TEST_FILES, 'test_backup_copy.db')
+        with open(copy, 'wb') as fh:
+            fh.write(data)
+        conn = sqlite3.connect(copy)
+        self.assertEqual(
+            conn.execute('SELECT key FROM pictures').fetchall(), [('1',)])
+        conn.close()
+
+    def test_scheduler(self):
+        db = self.get_db('test_scheduled.db')
+        folder = os.path.join(TEST_FILES, 'backups')
+        os.makedirs(folder)
+        scheduler = Scheduler(db.path, folder, keep=1)
+        self.assertTrue(scheduler.run_once())
+        # Nothing changed, no new snapshot
+        self.assertIsNone(scheduler.run_once())
+        db.add_picture({'key': '1', 'name': 'one'}, [])
+        os.rename(*[os.path.join(folder, f) for f in
+                    (scheduler.backups()[0], 'photolog-00000000-000000.db.gz')])
+        self.assertTrue(scheduler.run_once())
+        # Only the newest one is kept
+        self.assertEqual(len(scheduler.backups()), 1)
+        self.assertNotIn('photolog-00000000-000000.db.gz', scheduler.backups())
+        scheduler.close()
+        db.close()
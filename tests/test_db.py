@@ -1,4 +1,11 @@
-from . import TestDbBase
+import os
+import sqlite3
+from unittest import mock
+
+from photolog.db import BucketsDB, PendingItemsDB, TokensDB, DB, TagManager
+from photolog.db import PictureManager, distance_km as db_distance
+from photolog.squeue import SqliteQueue
+from . import TestDbBase, TEST_FILES
 
 
 class TestDB(TestDbBase):
@@ -41,6 +48,77 @@ class TestDB(TestDbBase):
         pic = db.pictures.by_key(key)
         self.assertEqual(pic[attr], value)
 
+    def test_add_pictures(self):
+        db = self.get_db('test_add_pictures.db')
+        db.add_picture({'key': 'old', 'year': 2019}, ['beach'])
+        records = [
+            ({'key': 'k1', 'year': 2019}, ['Beach', 'sun']),
+            ({'year': 2020, 'key': 'k2'}, []),
+            ({'key': 'k3', 'name': 'three', 'year': 2020}, ['sun']),
+        ]
+        self.assertEqual(db.add_pictures(records), 3)
+        self.assertEqual(db.total_pictures(), 4)
+        self.assertEqual(db.total_for_year(2020), 2)
+        k1 = db.pictures.by_key('k1')
+        self.assertEqual(sorted(db.tags.for_picture(k1['id'])),
+            ['beach', 'sun'])
+        self.assertEqual(db.tags.total_for_tags(['sun']), 2)
+        self.assertEqual(db.pictures.by_key('k3')['name'], 'three')
+        self.assertEqual(sorted(p['key'] for p in db.pictures.search('sun', 10)),
+            ['k1', 'k3'])
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.add_pictures([({'key': 'k4'}, []), ({'key': 'k1'}, [])])
+        # The whole batch is rolled back
+        self.assertIsNone(db.pictures.by_key('k4'))
+        added = db.add_pictures([({'key': 'k4'}, []), ({'key': 'k1'}, [])],
+            skip_existing=True)
+        self.assertEqual(added, 1)
+
+    def test_places(self):
+        db = self.get_db('test_places.db')
+        places = {
+            'paris': (48.8566, 2.3522),
+            'london': (51.5074, -0.1278),
+            'fiji': (-17.7134, 178.065),
+            'samoa': (-13.759, -172.1046),
+            'quito': (-0.1807, -78.4678),
+        }
+        for n, (key, (lat, lng)) in enumerate(sorted(places.items())):
+            picture_id = db.add_picture({'key': key, 'taken_time': n}, [])
+            db.places.locate(picture_id, lat, lng, 35.5)
+        db.add_picture({'key': 'nowhere'}, [])
+
+        europe = db.places.in_box(40, -10, 60, 10, 10)
+        self.assertEqual([p['key'] for p in europe], ['paris', 'london'])
+        self.assertEqual(europe[0]['latitude'], 48.8566)
+        self.assertEqual(europe[0]['altitude'], 35.5)
+        # Crossing the antimeridian
+        pacific = db.places.in_box(-20, 170, -10, -170, 10, ['key'])
+        self.assertEqual(sorted(p['key'] for p in pacific), ['fiji', 'samoa'])
+
+        for lat, lng in [(48.0, 2.0), (-15.0, 179.9), (0, 0), (89, 0)]:
+            nearest = db.places.nearest(lat, lng, 3, ['key'])
+            expected = sorted(places, key=lambda k: db_distance(
+                lat, lng, *places[k]))[:3]
+            self.assertEqual([p['key'] for _, p in nearest], expected)
+        self.assertEqual(db.places.for_picture(
+            db.pictures.by_key('quito')['id'])['longitude'], -78.4678)
+
+    def test_set_service(self):
+        db = self.get_db('test_set_service.db')
+        key = 'test_set_service'
+        db.add_picture({'key': key, 'original': 'original.jpg'}, [])
+        db.pictures.set_service(key, 'flickr', '{"id": "1"}', '1',
+            'https://flic.kr/p/1')
+        pic = db.pictures.by_key(key)
+        self.assertEqual(pic['flickr'], '{"id": "1"}')
+        self.assertEqual((pic['flickr_id'], pic['flickr_url']),
+            ('1', 'https://flic.kr/p/1'))
+        self.assertIsNone(pic['gphotos_id'])
+        with self.assertRaises(ValueError):
+            db.pictures.set_service(key, 'name', 'x', 'y', 'z')
+
     def test_find_picture(self):
         db = self.get_db('test_find_picture.db')
         db.add_picture({
@@ -106,3 +184,341 @@ class TestDB(TestDbBase):
         }, [])
         self.assertEqual({p['name'] for p in db.pictures.by_keys(['1', '2'])},
             {'one', 'two'})
+
+    def test_tagged_pictures(self):
+        db = self.get_db('test_multi_tags.db')
+        db.add_picture({'key': 'ab', 'name': 'ab', 'taken_time': 3},
+            ['a', 'b'])
+        db.add_picture({'key': 'a', 'name': 'a', 'taken_time': 2}, ['a'])
+        db.add_picture({'key': 'bc', 'name': 'bc', 'taken_time': 1},
+            ['b', 'c'])
+
+        def keys(tags, mode, before=None):
+            return [p['key'] for p in
+                    db.tags.tagged_pictures(tags, 10, 0, mode, before)]
+        self.assertEqual(keys(['a', 'b'], db.tags.ALL), ['ab'])
+        self.assertEqual(keys(['a', 'b'], db.tags.ANY), ['ab', 'a', 'bc'])
+        self.assertEqual(keys(['a', 'c'], db.tags.ALL), [])
+        self.assertEqual(keys(['a', 'b'], db.tags.ANY, (2, 2)), ['bc'])
+        self.assertEqual(db.tags.total_for_tags(['a', 'b']), 1)
+        self.assertEqual(db.tags.total_for_tags(['a', 'b'], db.tags.ANY), 3)
+
+    def test_tag_ids_cached(self):
+        db = self.get_db('test_tag_cache.db')
+        db.add_picture({'key': 'first', 'name': 'first'}, ['a', 'b', 'a '])
+        statements = []
+        db._get_conn().set_trace_callback(statements.append)
+        db.add_picture({'key': 'second', 'name': 'second'}, ['A', 'b'])
+        db._get_conn().set_trace_callback(None)
+        # Known tags cost no lookups or inserts, only the links are written
+        # (triggers trace the statement that fired them again)
+        self.assertEqual(
+            len({s for s in statements if 'INTO tagged_pics' in s}), 2)
+        self.assertFalse([s for s in statements
+                          if s.startswith('SELECT') or 'INTO tags ' in s])
+        self.assertEqual(db.tagged('a')[-1]['key'], 'second')
+
+    def test_page_cursors(self):
+        db = self.get_db('test_page.db')
+        for n in range(5):
+            # Two pictures share each timestamp, ties are broken by id
+            db.add_picture({'key': str(n), 'name': str(n),
+                            'taken_time': n // 2}, [])
+        first = db.pictures.get_all(2, 0)
+        self.assertEqual([p['key'] for p in first], ['4', '3'])
+        last = first[-1]
+        second = db.pictures.get_all(2, 0, (last['taken_time'], last['id']))
+        self.assertEqual([p['key'] for p in second], ['2', '1'])
+        top = second[0]
+        back = db.pictures.get_all(2, 0, after=(top['taken_time'], top['id']))
+        self.assertEqual(back, first)
+
+    def test_undated_cursors(self):
+        db = self.get_db('test_undated_page.db')
+        for n in range(6):
+            # The first three have no taken_time, they are listed last
+            db.add_picture({'key': str(n), 'name': str(n),
+                            'taken_time': n if n > 2 else None}, [])
+        keys, page = [], db.pictures.get_all(2, 0)
+        while page:
+            keys.extend(p['key'] for p in page)
+            last = page[-1]
+            page = db.pictures.get_all(2, 0, (last['taken_time'], last['id']))
+        self.assertEqual(keys, ['5', '4', '3', '2', '1', '0'])
+        bottom = db.pictures.by_key('1')
+        back = db.pictures.get_all(2, 0, after=(None, bottom['id']))
+        self.assertEqual([p['key'] for p in back], ['3', '2'])
+        self.assertEqual(len(db.pictures.find({'name': '4'}, after=(
+            None, bottom['id']))), 1)
+
+    def test_counts(self):
+        db = self.get_db('test_counts.db')
+        for key, day in [('1', 1), ('2', 1), ('3', 2)]:
+            db.add_picture({'key': key, 'name': key, 'year': 2015,
+                            'month': 12, 'day': day}, ['a', 'b'])
+        db.pictures.change_day(2015, 12, 2, {'year': 2016, 'month': 1,
+            'day': 1, 'taken_time': 0, 'date_taken': '2016-01-01'})
+        db.tags.change_for_keys(['1'], ['c'])
+        self.assertEqual(db.total_pictures(), 3)
+        self.assertEqual(db.total_for_year(2015), 2)
+        self.assertEqual(db.total_for_year(2016), 1)
+        self.assertEqual(db.pictures.count({'year': 2015, 'month': 12}), 2)
+        self.assertEqual(db.pictures.count(
+            {'year': 2015, 'month': 12, 'day': 2}), 0)
+        self.assertEqual(db.tags.total_for_tags(['a']), 2)
+        self.assertEqual(db.tags.total_for_tags(['c']), 1)
+        self.assertEqual(db.tags.total_for_tags(['missing']), 0)
+        # Counts are rebuilt from scratch for catalogs that lack them
+        with db._get_conn() as conn:
+            conn.execute('DELETE FROM picture_counts')
+        db = self.get_db('test_counts.db')
+        self.assertEqual(db.total_for_year(2015), 2)
+        self.assertEqual(db.tags.total_for_tags(['b']), 2)
+
+    def test_date_tree(self):
+        db = self.get_db('test_dates.db')
+        db.add_picture({'key': '1', 'name': '1', 'year': 2015, 'month': 12,
+                        'day': 25}, [])
+        self.assertEqual(db.get_years(), [2015])
+        db.add_picture({'key': '2', 'name': '2', 'year': 2016, 'month': 1,
+                        'day': 2}, [])
+        self.assertEqual(db.get_years(), [2016, 2015])
+        # Writes from other connections are picked up too
+        other = self.get_db('test_dates.db')
+        other.pictures.change_day(2015, 12, 25, {'year': 2016, 'month': 1,
+            'day': 3, 'taken_time': 0, 'date_taken': '2016-01-03'})
+        self.assertEqual(db.get_years(), [2016])
+        self.assertEqual(db.get_months(2016), [1])
+        self.assertEqual(db.get_days(2016, 1), [2, 3])
+
+    def test_cached(self):
+        db = self.get_db('test_cached.db')
+        builds = []
+        build = lambda conn: builds.append(1) or len(builds)
+        self.assertEqual(db.cached('x', build), 1)
+        # Jobs and buckets share the file but not what pages show
+        SqliteQueue(db.path).append({'type': 'upload'})
+        BucketsDB(db.path).take('upload', 1, 1, 10)
+        self.assertEqual(db.cached('x', build), 1)
+        db.add_picture({'key': '1'}, [])
+        self.assertEqual(db.cached('x', build), 2)
+
+    def test_catalog_version(self):
+        db = self.get_db('test_catalog_version.db')
+        version, _ = db.catalog_version()
+        picture_id = db.add_picture({'key': '1'}, ['a'])
+        self.assertEqual(db.catalog_version()[0], version + 3)
+        db.places.locate(picture_id, 1.5, 2.5)
+        self.assertEqual(db.catalog_version()[0], version + 4)
+        # Jobs in the same file don't change any page
+        SqliteQueue(db.path).append({'type': 'upload'})
+        other = self.get_db('test_catalog_version.db')
+        other.pictures.update('1', 'notes', 'hello')
+        self.assertEqual(db.catalog_version()[0], version + 5)
+
+    def test_search(self):
+        db = self.get_db('test_search.db')
+        db.add_picture({'key': '1', 'name': 'IMG_4821.JPG', 'camera': 'Canon',
+                        'notes': 'sunset'}, ['trip'])
+        db.add_picture({'key': '2', 'name': 'IMG_4822.JPG', 'camera': 'Canon'},
+            ['beach'])
+
+        def keys(text):
+            return [p['key'] for p in db.pictures.search(text, 10)]
+        self.assertEqual(keys('img_4821'), ['1'])
+        self.assertEqual(keys('canon beach'), ['2'])
+        self.assertEqual(db.pictures.count_search('can'), 2)
+        self.assertEqual(keys('"unbalanced'), [])
+        # Edits and tag changes are indexed
+        db.pictures.edit_attribute('2', 'notes', 'sunrise')
+        db.tags.change_for_keys(['1'], ['beach'])
+        self.assertEqual(keys('sunrise'), ['2'])
+        self.assertEqual(set(keys('beach')), {'1', '2'})
+        self.assertEqual(keys('trip'), [])
+
+    def test_columns(self):
+        db = self.get_db('test_columns.db')
+        db.add_picture({'key': '1', 'name': 'one', 'gphotos': '{}'}, [])
+        picture = db.pictures.get_all(10, 0,
+            columns=db.pictures.THUMB_COLUMNS)[0]
+        self.assertEqual(picture['key'], '1')
+        self.assertNotIn('gphotos', picture)
+        self.assertIsNone(picture.get('gphotos'))
+        self.assertEqual(dict(db.pictures.by_key('1'))['gphotos'], '{}')
+
+    def test_facets(self):
+        db = self.get_db('test_facets.db')
+        pictures = [
+            ('1', 'Canon', 'image', 300, 200, 2015, 1, ['a']),
+            ('2', 'Canon', 'image', 200, 300, 2015, 6, ['a', 'b']),
+            ('3', 'Nikon', 'image', 300, 200, 2016, 2, ['b']),
+            ('4', None, 'video', 100, 100, 2016, 3, []),
+        ]
+        for n, (key, camera, fmt, w, h, year, month, tags) in enumerate(pictures):
+            db.add_picture({'key': key, 'camera': camera, 'format': fmt,
+                            'width': w, 'height': h, 'year': year,
+                            'month': month, 'day': 1, 'taken_time': n}, tags)
+        self.assertEqual(db.facets.counts('camera'),
+            [('Canon', 2), ('', 1), ('Nikon', 1)])
+        self.assertEqual(db.facets.counts('orientation', (2016, 1)),
+            [('landscape', 1), ('square', 1)])
+
+        def keys(filters, tags=(), mode=db.tags.ALL):
+            found = db.facets.pictures(filters, 10, tags=tags, mode=mode)
+            self.assertEqual(db.facets.total(filters, tags, mode), len(found))
+            return [p['key'] for p in found]
+        self.assertEqual(keys({'camera': 'Canon'}), ['2', '1'])
+        self.assertEqual(keys({'camera': ''}), ['4'])
+        self.assertEqual(keys({'orientation': 'landscape'}), ['3', '1'])
+        self.assertEqual(keys({'format': 'image', 'start': (2015, 6),
+                               'end': (2016, 2)}), ['3', '2'])
+        self.assertEqual(keys({'end': (2015, 12)}), ['2', '1'])
+        self.assertEqual(keys({'camera': 'Canon'}, ['b']), ['2'])
+        self.assertEqual(keys({'orientation': 'landscape'}, ['a', 'b'],
+            db.tags.ANY), ['3', '1'])
+        self.assertEqual(keys({}), ['4', '3', '2', '1'])
+        # Edits move the counts along
+        db.pictures.edit_attribute('3', 'camera', 'Canon')
+        db.pictures.edit_attribute('1', 'width', 100)
+        self.assertEqual(db.facets.counts('camera'), [('Canon', 3), ('', 1)])
+        self.assertEqual(db.facets.counts('orientation'),
+            [('portrait', 2), ('landscape', 1), ('square', 1)])
+
+
+class TestConnections(TestDbBase):
+    def test_readers(self):
+        db = DB(os.path.join(TEST_FILES, 'test_readers.db'), readers=1)
+        with db._get_conn() as conn:
+            mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+            self.assertEqual(mode, 'wal')
+        db.add_picture({'key': '1', 'name': 'one'}, ['a'])
+        with db._read_conn() as conn:
+            self.assertRaises(sqlite3.OperationalError, conn.execute,
+                'DELETE FROM pictures')
+        # The single reader is reused and sees the writer's commits
+        self.assertEqual(db.get_years(), [])
+        db.add_picture({'key': '2', 'name': 'two', 'year': 2015,
+                        'month': 1, 'day': 1}, [])
+        self.assertEqual(db.get_years(), [2015])
+        self.assertEqual(db._connections._created, 1)
+        db.close()
+
+
+class TestQueryPlans(TestDbBase):
+    def plan(self, db, query, params):
+        with db._get_conn() as conn:
+            rows = conn.execute('EXPLAIN QUERY PLAN ' + query, params)
+            return ' | '.join(r['detail'] for r in rows)
+
+    def assertUses(self, query, params, index):
+        db = self.get_db('test_plans.db')
+        plan = self.plan(db, query, params)
+        self.assertRegex(plan, r'INDEX %s\b' % index)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_pictures(self):
+        self.assertUses(PictureManager._get_picture, ['k'], 'pictures_key')
+        self.assertUses(PictureManager._prev_pic, [1], 'pictures_taken_time')
+        self.assertUses(PictureManager._next_pic, [1], 'pictures_taken_time')
+        self.assertUses(PictureManager._page % ('*',
+            PictureManager._before_cursor, 'DESC', 'DESC'), [1, 1, 10, 0],
+            'pictures_taken_time')
+        self.assertUses(DB._file_exists, ['a', 'b'], 'pictures_name')
+        self.assertUses(PictureManager._page % ('*',
+            'year = ? AND ' + PictureManager._after_cursor, 'ASC', 'ASC'),
+            [2015, 1, 1, 10, 0], 'pictures_year')
+        self.assertUses(PictureManager._page % ('*',
+            'year = ? AND month = ? AND day = ?', 'DESC', 'DESC'),
+            [2015, 1, 1, 10, 0], 'pictures_date')
+
+    def test_facets(self):
+        for facet, index in [('camera', 'pictures_camera'),
+                             ('format', 'pictures_format'),
+                             ('orientation', 'pictures_orientation')]:
+            db = self.get_db('test_plans.db')
+            where, params = db.facets._where({facet: 'x'})
+            self.assertUses(PictureManager._page % ('*', where, 'DESC',
+                'DESC'), params + [10, 0], index)
+
+    def test_dates(self):
+        db = self.get_db('test_plans.db')
+        self.assertIn('USING PRIMARY KEY', self.plan(db, DB._get_count,
+            ['day', 2015, 1, 1]))
+
+    def test_tags(self):
+        self.assertUses(TagManager._get_tags_by_name % '?, ?', ['a', 'b'],
+            'tags_name')
+        self.assertUses(TagManager._tagged_pics, [1], 'tagged_pics_tag')
+        self.assertUses(TagManager._pic_tags, [1], 'tagged_pics_picture')
+
+    def test_unique_tags(self):
+        db = self.get_db('test_unique_tags.db')
+        db.add_picture({'key': 'unique', 'name': 'one'}, ['a', 'a', 'b'])
+        self.assertEqual(sorted(db.tags.for_picture(
+            db.pictures.by_key('unique')['id'])), ['a', 'b'])
+        self.assertEqual(len(db.tags.all()), 2)
+
+    def test_duplicate_tags(self):
+        path = os.path.join(TEST_FILES, 'test_duplicate_tags.db')
+        conn = sqlite3.connect(path)
+        conn.executescript(
+            'CREATE TABLE tags (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'name TEXT);'
+            'CREATE TABLE tagged_pics (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'tag_id INTEGER, picture_id INTEGER);'
+            "INSERT INTO tags (name) VALUES ('a'), ('a');"
+            'INSERT INTO tagged_pics (tag_id, picture_id) VALUES (1, 1), (2, 1);')
+        conn.close()
+        with self.assertRaisesRegex(sqlite3.IntegrityError, 'add_indexes'):
+            DB(path)
+
+        with mock.patch.dict(os.environ, {'DB_FILE': path}):
+            from photolog.tools.migrations import add_indexes
+        conn = sqlite3.connect(path)
+        with conn:
+            add_indexes.migrate(conn)
+        conn.close()
+        db = DB(path)
+        self.assertEqual(db.tags.all(), ['a'])
+        db.close()
+
+
+class TestBucketsDB(TestDbBase):
+    def test_take(self):
+        buckets = BucketsDB(os.path.join(TEST_FILES, 'test_buckets.db'))
+        # A fresh bucket starts full
+        self.assertEqual(buckets.take('upload', 100, 100, 100), 0)
+        # Then the caller has to wait for the debt to be paid back
+        wait = buckets.take('upload', 50, 100, 100)
+        self.assertGreater(wait, 0.4)
+        self.assertLessEqual(wait, 0.5)
+
+
+class TestPendingItemsDB(TestDbBase):
+    def test_claim(self):
+        pending = PendingItemsDB(os.path.join(TEST_FILES, 'test_pending.db'))
+        for n in range(5):
+            pending.add('gphotos', 'token%s' % n, 'key%s' % n)
+        claimed = pending.claim('gphotos', 'token4', 3)
+        # Requested token goes first, then the oldest ones
+        self.assertEqual([i['upload_token'] for i in claimed],
+            ['token4', 'token0', 'token1'])
+        # Claimed items are not handed out again
+        claimed = pending.claim('gphotos', 'token4', 3)
+        self.assertEqual([i['upload_token'] for i in claimed],
+            ['token2', 'token3'])
+        pending.release(['token0'])
+        claimed = pending.claim('gphotos', 'token0', 3)
+        self.assertEqual([i['upload_token'] for i in claimed], ['token0'])
+        pending.resolve('token0', 'done', None)
+        self.assertEqual(pending.get('token0')['status'], 'done')
+
+
+class TestTokensDB(TestDbBase):
+    def test_claim_refresh(self):
+        tokens = TokensDB(os.path.join(TEST_FILES, 'test_tokens.db'))
+        self.assertTrue(tokens.claim_refresh('gphotos', 60))
+        # Someone else is refreshing it
+        self.assertFalse(tokens.claim_refresh('gphotos', 60))
+        # Other services are independent
+        self.assertTrue(tokens.claim_refresh('other', 60))
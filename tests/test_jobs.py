@@ -1,7 +1,11 @@
+import os
 from datetime import datetime
+from unittest import mock
 
-from . import TestDbBase
-from photolog.queue.jobs import prepare_job
+from . import TestDbBase, TEST_FILES
+from photolog.settings import Settings
+from photolog.services import gphotos, throttle
+from photolog.queue.jobs import prepare_job, ImageJob
 
 
 class TestTagDay(TestDbBase):
@@ -143,3 +147,184 @@ class TestEditPictureJob(TestDbBase):
         self.assertEqual(pictures['3']['year'], '2015')
         self.assertEqual(pictures['3']['month'], '12')
         self.assertEqual(pictures['3']['day'], '25')
+
+
+class TestChangeDateJob(TestDbBase):
+    def test_process(self):
+        db = self.get_db('test_process.db')
+        for key, day in [('1', 25), ('2', 25), ('3', 26)]:
+            db.add_picture({
+                'original': 'file%s.jpg' % key,
+                'name': 'name',
+                'key': key,
+                'year': 2015,
+                'month': 12,
+                'day': day
+            }, [])
+        job = prepare_job({
+            'type': 'change-date',
+            'key': 'xxxx',
+            'origin': datetime(2015, 12, 25),
+            'target': datetime(2016, 1, 2),
+            'attempt': 0
+        }, db, {})
+        job.process()
+
+        pictures = {p['key']: p for p in db.pictures.by_keys(['1', '2', '3'])}
+        self.assertEqual(pictures['1']['date_taken'], '2016-01-02')
+        self.assertEqual(pictures['2']['date_taken'], '2016-01-02')
+        self.assertEqual(pictures['3']['day'], 26)
+
+
+class TestEditDatesJob(TestDbBase):
+    def test_process(self):
+        db = self.get_db('test_edit_dates.db')
+        for key in ('j', 'k'):
+            db.add_picture({'key': key, 'name': key, 'year': 2015,
+                            'month': 12, 'day': 25}, [])
+        first, second = datetime(2016, 1, 1), datetime(2016, 1, 2)
+        job = prepare_job({
+            'type': 'edit-dates',
+            'key': 'xxxx',
+            # k is changed twice, the last one wins
+            'changes': [('j', first), ('k', second), ('k', first)],
+            'attempt': 0
+        }, db, {})
+        job.process()
+
+        pictures = {p['key']: p for p in db.pictures.by_keys(['j', 'k'])}
+        self.assertEqual(pictures['j']['date_taken'], '2016-01-01')
+        self.assertEqual(pictures['k']['date_taken'], '2016-01-01')
+
+
+class FlakyImageJob(ImageJob):
+    calls = []
+    fail = set()
+
+    def flickr_upload(self):
+        self.calls.append('flickr')
+        if 'flickr' in self.fail:
+            raise ValueError('Flickr is down')
+        return self.data
+
+    def gphotos_upload(self):
+        self.calls.append('gphotos')
+        return self.data
+
+
+class TestPublish(TestDbBase):
+    def test_retry_failed_branch(self):
+        db = self.get_db('test_publish.db')
+        settings = Settings(DB_FILE=os.path.join(TEST_FILES, 'test_publish.db'),
+            UPLOAD_FOLDER=TEST_FILES)
+        job_data = {
+            'key': 'xxxx',
+            'filename': 'file.jpg',
+            'original_filename': 'file.jpg',
+            'step': 'publish',
+            'data': {},
+            'skip': [],
+            'attempt': 0,
+        }
+        FlakyImageJob.fail = {'flickr'}
+        with self.assertRaises(ValueError):
+            FlakyImageJob(job_data, db, settings).process()
+        self.assertEqual(sorted(FlakyImageJob.calls), ['flickr', 'gphotos'])
+        self.assertEqual(job_data['step'], 'publish')
+
+        # Only the failed branch runs again
+        FlakyImageJob.calls, FlakyImageJob.fail = [], set()
+        job = FlakyImageJob(job_data, db, settings).process()
+        self.assertEqual(FlakyImageJob.calls, ['flickr'])
+        self.assertEqual(job['step'], 'gphotos_commit')
+
+
+def media_item(token):
+    return {'uploadToken': token, 'mediaItem': {
+        'id': 'id-%s' % token, 'productUrl': 'https://g/%s' % token}}
+
+
+class TestGphotosCommit(TestDbBase):
+    def setUp(self):
+        name = 'test_gphotos_%s.db' % self._testMethodName
+        self.db = self.get_db(name)
+        self.settings = Settings(DB_FILE=os.path.join(TEST_FILES, name),
+            UPLOAD_FOLDER=TEST_FILES, GPHOTOS_ENABLED=True)
+        self.pending = gphotos.get_pending(self.settings)
+
+    def get_job(self, key):
+        """Job for picture `key`, its bytes uploaded as token `key`"""
+        self.db.add_picture({'key': key, 'name': key}, [])
+        self.pending.add(gphotos.SERVICE, key, key)
+        return ImageJob({
+            'key': key,
+            'filename': '%s.jpg' % key,
+            'original_filename': '%s.jpg' % key,
+            'batch_id': None,
+            'step': 'gphotos_commit',
+            'data': {'gphotos_token': key},
+            'skip': [],
+            'attempt': 0,
+        }, self.db, self.settings)
+
+    def test_single(self):
+        job = self.get_job('single')
+        with mock.patch.object(gphotos, 'commit_media', return_value={
+                'single': media_item('single')}) as commit:
+            data = job.gphotos_commit()
+        commit.assert_called_once_with(self.settings, ['single'])
+        self.assertNotIn('gphotos_token', data['data'])
+        self.assertIsNone(self.pending.get('single'))
+        picture = self.db.pictures.by_key('single')
+        self.assertEqual((picture['gphotos_id'], picture['gphotos_url']),
+            ('id-single', 'https://g/single'))
+
+    def test_batch(self):
+        jobs = [self.get_job(key) for key in ('a', 'b', 'c')]
+        results = {'a': media_item('a'), 'b': media_item('b'),
+                   'c': {'uploadToken': 'c', 'status': {'message': 'bad'}}}
+        with mock.patch.object(gphotos, 'commit_media',
+                return_value=results) as commit:
+            jobs[0].gphotos_commit()
+        self.assertEqual(sorted(commit.call_args[0][1]), ['a', 'b', 'c'])
+        self.assertEqual(self.pending.get('b')['status'], 'done')
+        self.assertEqual(self.pending.get('c')['status'], 'failed')
+        self.assertEqual(self.db.pictures.by_key('b')['gphotos_id'], 'id-b')
+
+        # Already created with the batch, no more calls
+        with mock.patch.object(gphotos, 'commit_media') as commit:
+            jobs[1].gphotos_commit()
+        self.assertFalse(commit.called)
+        self.assertIsNone(self.pending.get('b'))
+
+        # The rejected one is uploaded again and committed on its own
+        with mock.patch.object(gphotos, 'upload_media', return_value='c2'), \
+                mock.patch.object(gphotos, 'commit_media', return_value={
+                    'c2': media_item('c2')}) as commit:
+            jobs[2].gphotos_commit()
+        commit.assert_called_once_with(self.settings, ['c2'])
+        self.assertIsNone(self.pending.get('c'))
+        self.assertIsNone(self.pending.get('c2'))
+        self.assertEqual(self.db.pictures.by_key('c')['gphotos_id'], 'id-c2')
+
+    def test_claimed(self):
+        job = self.get_job('claimed')
+        # Another worker is committing it
+        self.pending.claim(gphotos.SERVICE, 'claimed', gphotos.BATCH_SIZE)
+        with mock.patch.object(gphotos, 'commit_media') as commit:
+            with self.assertRaises(throttle.Deferred):
+                job.gphotos_commit()
+        self.assertFalse(commit.called)
+        self.assertEqual(job.data['data']['gphotos_token'], 'claimed')
+        self.assertEqual(self.pending.get('claimed')['status'], 'claimed')
+
+    def test_release(self):
+        jobs = [self.get_job(key) for key in ('x', 'y')]
+        with mock.patch.object(gphotos, 'commit_media',
+                side_effect=ValueError('Gphotos is down')):
+            with self.assertRaises(ValueError):
+                jobs[0].gphotos_commit()
+        # Claims are released so any worker can commit them
+        for key in ('x', 'y'):
+            self.assertEqual(self.pending.get(key)['status'], 'pending')
+        self.assertEqual(jobs[0].data['data']['gphotos_token'], 'x')
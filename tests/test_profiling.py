@@ -0,0 +1,37 @@
+from photolog import profiling
+from . import TestDbBase
+
+
+class TestProfiler(TestDbBase):
+    def setUp(self):
+        self.profiler = profiling.profiler = profiling.Profiler(slow_ms=10000)
+
+    def tearDown(self):
+        profiling.profiler = None
+
+    def test_totals(self):
+        db = self.get_db('test_profiler.db')
+        db.add_picture({'key': '1', 'year': 2015}, ['a'])
+        db.add_picture({'key': '2', 'year': 2015}, [])
+        self.profiler.begin()
+        self.assertEqual(len(db.pictures.get_all(10, 0)), 2)
+        self.assertEqual(db.pictures.by_key('1')['year'], 2015)
+        db.pictures.edit_attribute('2', 'name', 'two')
+        count, duration, rows = self.profiler.totals()
+        self.assertEqual((count, rows), (3, 4))
+        self.assertGreater(duration, 0)
+        self.profiler.begin()
+        self.assertIn('desc="0 queries, 0 rows"', self.profiler.server_timing())
+
+    def test_slow_log(self):
+        db = self.get_db('test_slow_log.db')
+        self.profiler.slow = 0
+        with self.assertLogs('DB', 'WARNING') as logs:
+            db.pictures.by_key('1')
+            db.tags.tag_picture(1, ['a', 'b'])
+            self.profiler.totals()
+        select, = [l for l in logs.output if 'FROM pictures WHERE key' in l]
+        self.assertIn('0 rows, params 1: SELECT', select)
+        self.assertIn('USING INDEX pictures_key', select)
+        self.assertIn('params 2x2: INSERT OR IGNORE INTO tagged_pics',
+            logs.output[-1])
@@ -0,0 +1,16 @@
+from time import sleep
+
+from . import TestDbBase, QueueMixin
+
+
+class TestQueue(TestDbBase, QueueMixin):
+    def test_deferred(self):
+        queue = self.get_queue('test_deferred.db')
+        queue.append({'key': 'later'}, delay=0.2)
+        queue.append({'key': 'now'})
+        self.assertEqual(queue.popleft(False), {'key': 'now'})
+        self.assertIsNone(queue.popleft(False))
+        self.assertEqual(queue.total_deferred(), 1)
+        sleep(0.2)
+        self.assertEqual(queue.popleft(False), {'key': 'later'})
+        self.assertEqual(queue.total_deferred(), 0)
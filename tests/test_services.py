@@ -0,0 +1,188 @@
+import os
+import json
+from time import time
+from datetime import datetime
+from unittest import TestCase, mock
+
+import requests
+from requests.adapters import BaseAdapter
+
+from photolog.db import TokensDB
+from photolog.settings import Settings
+from exifread.utils import Ratio
+
+from photolog.services import bandwidth, base, flickr, gphotos, throttle
+from . import TestDbBase, TEST_FILES
+
+
+class TestBandwidth(TestCase):
+    def test_current_rate(self):
+        settings = Settings(UPLOAD_RATE_LIMITS=[
+            [8, 23, 512],
+            [23, 8, 0],
+        ])
+        noon = datetime(2019, 1, 1, 12)
+        midnight = datetime(2019, 1, 1, 0)
+        self.assertEqual(bandwidth.current_rate(settings, noon), 512 * 1024)
+        self.assertIsNone(bandwidth.current_rate(settings, midnight))
+
+    def test_unlimited(self):
+        settings = Settings()
+        self.assertIsNone(bandwidth.current_rate(settings))
+
+
+class UploadAdapter(BaseAdapter):
+    """Plays a Gphotos upload session, keeping what each chunk sent"""
+    def __init__(self, received):
+        super().__init__()
+        self.received = received
+        self.chunks = []
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response._content = b''
+        if request.headers['X-Goog-Upload-Command'] == 'query':
+            response.headers.update({
+                'X-Goog-Upload-Status': 'active',
+                'X-Goog-Upload-Size-Received': str(self.received),
+            })
+        else:
+            body = request.body.read()
+            self.chunks.append((request.headers['X-Goog-Upload-Offset'],
+                request.headers['Content-Length'], len(body)))
+            self.received += len(body)
+            if 'finalize' in request.headers['X-Goog-Upload-Command']:
+                response._content = b'token'
+        return response
+
+    def close(self):
+        pass
+
+
+class TestResumableUpload(TestDbBase):
+    def test_resume(self):
+        filename = os.path.join(TEST_FILES, 'test_resume.bin')
+        with open(filename, 'wb') as fh:
+            fh.write(os.urandom(3 * 2 ** 20 // 2))
+        session = requests.Session()
+        # Resumed in the middle of a chunk
+        adapter = UploadAdapter(256 * 1024)
+        session.mount('https://', adapter)
+        upload = {'url': 'https://upload/1', 'granularity': 256 * 1024}
+        with mock.patch.object(gphotos, 'CHUNK_SIZE', 2 ** 20), \
+                mock.patch.object(gphotos.clients, 'http', lambda: session):
+            token = gphotos.resumable_upload(Settings(), filename, 'name',
+                'image/jpeg', 'Bearer x', upload)
+        self.assertEqual(token, 'token')
+        self.assertEqual(adapter.chunks, [
+            ('262144', '1048576', 1048576),
+            ('1310720', '262144', 262144),
+        ])
+        self.assertEqual(upload, {})
+
+
+class TestParseData(TestCase):
+    def test_flickr(self):
+        data = json.dumps({'id': '123', 'url': 'https://flic.kr/p/x'})
+        self.assertEqual(flickr.parse_data(data), ('123', 'https://flic.kr/p/x'))
+        self.assertEqual(flickr.parse_data(None), (None, None))
+        self.assertEqual(flickr.parse_data('{bad'), (None, None))
+
+    def test_gphotos(self):
+        data = json.dumps({'json': {'id': 'abc', 'productUrl': 'https://g/abc'}})
+        self.assertEqual(gphotos.parse_data(data), ('abc', 'https://g/abc'))
+        xml = ('<entry xmlns="http://www.w3.org/2005/Atom" '
+               'xmlns:gphoto="http://schemas.google.com/photos/2007">'
+               '<gphoto:id>42</gphoto:id><link rel="alternate" href="/x"/>'
+               '<link rel="http://schemas.google.com/photos/2007#canonical" '
+               'href="https://picasa/42"/></entry>')
+        self.assertEqual(gphotos.parse_data(json.dumps({'xml': xml})),
+            ('42', 'https://picasa/42'))
+        self.assertEqual(gphotos.parse_data(''), (None, None))
+        with self.assertLogs('QUEUE', 'WARNING'):
+            self.assertEqual(gphotos.parse_data(json.dumps({'xml': '<entry'})),
+                (None, None))
+
+
+class Tag(object):
+    def __init__(self, *values):
+        self.values = list(values)
+
+    def __str__(self):
+        return str(self.values[0])
+
+
+class TestGps(TestCase):
+    def test_coordinates(self):
+        exif = {
+            'GPS GPSLatitude': Tag(Ratio(33, 1), Ratio(51, 1), Ratio(2163, 100)),
+            'GPS GPSLatitudeRef': Tag('S'),
+            'GPS GPSLongitude': Tag(Ratio(151, 1), Ratio(12, 1), Ratio(30, 1)),
+            'GPS GPSLongitudeRef': Tag('E'),
+            'GPS GPSAltitude': Tag(Ratio(58, 2)),
+            'GPS GPSAltitudeRef': Tag(1),
+        }
+        lat, lng, alt = base.gps_coordinates(exif)
+        self.assertAlmostEqual(lat, -33.856008, places=5)
+        self.assertAlmostEqual(lng, 151.208333, places=5)
+        self.assertEqual(alt, -29)
+
+    def test_missing(self):
+        self.assertEqual(base.gps_coordinates({}), (None, None, None))
+        exif = {'GPS GPSLatitude': Tag(Ratio(1, 0), Ratio(0, 1), Ratio(0, 1)),
+                'GPS GPSLongitude': Tag(Ratio(1, 1), Ratio(0, 1), Ratio(0, 1))}
+        self.assertEqual(base.gps_coordinates(exif), (None, None, None))
+
+
+class TestTokenCache(TestDbBase):
+    def test_get(self):
+        settings = Settings(DB_FILE=os.path.join(TEST_FILES, 'test_cache.db'))
+        tokens = TokensDB(settings.DB_FILE)
+        tokens.save_token('gphotos', 'access', 'Bearer', 'refresh',
+            time() + 3600)
+        cache = gphotos.TokenCache(settings)
+        self.assertEqual(cache.get(), ('access', 'Bearer'))
+        # Served from memory afterwards
+        tokens.update_token('gphotos', 'other', 'Bearer', time() + 3600)
+        self.assertEqual(cache.get(), ('access', 'Bearer'))
+        cache.timer.cancel()
+
+
+class TestThrottle(TestDbBase):
+    def get_settings(self, name):
+        return Settings(DB_FILE=os.path.join(TEST_FILES, name))
+
+    def test_circuit_breaker(self):
+        settings = self.get_settings('test_circuit.db')
+        settings.CIRCUIT_FAILURES = 2
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                with throttle.guard('flickr', settings):
+                    raise ValueError('Service down')
+        # Circuit is open, the call is not even attempted
+        with self.assertRaises(throttle.Throttled):
+            with throttle.guard('flickr', settings):
+                self.fail('Should not be called')
+        # Other services are not affected
+        with throttle.guard('gphotos', settings):
+            pass
+
+    def test_throttled(self):
+        settings = self.get_settings('test_throttled.db')
+        with self.assertRaises(throttle.Throttled):
+            with throttle.guard('gphotos', settings):
+                raise throttle.Throttled('gphotos', 30)
+        blocked = throttle.get_services(settings).blocked_for('gphotos')
+        self.assertGreater(blocked, 29)
+
+    def test_rate_limit(self):
+        settings = self.get_settings('test_rate.db')
+        settings.SERVICE_RATE_LIMITS = {'gphotos': 2}
+        for _ in range(2):
+            with throttle.guard('gphotos', settings):
+                pass
+        with self.assertRaises(throttle.Throttled):
+            with throttle.guard('gphotos', settings):
+                pass
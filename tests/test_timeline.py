@@ -0,0 +1,84 @@
+from datetime import datetime
+from time import mktime
+from unittest import mock
+
+from photolog import timeline
+from photolog.timeline import Timeline
+from . import TestDbBase
+
+
+def picture(key, year, month, day, hour=12):
+    taken_time = mktime(datetime(year, month, day, hour).timetuple())
+    return {'key': key, 'name': key, 'year': year, 'month': month,
+            'day': day, 'taken_time': taken_time}
+
+
+class TestTimeline(TestDbBase):
+    def keys(self, db, ids):
+        return [p['key'] for p in db.pictures.by_ids(ids, ('id', 'key'))]
+
+    def test_page(self):
+        db = self.get_db('test_timeline_page.db')
+        for n in range(6):
+            # Two pictures per day, same time, ties are broken by id
+            db.add_picture(picture(str(n), 2015, 12, 1 + n // 2),
+                ['odd'] if n % 2 else ['even'])
+        db.add_picture({'key': 'undated', 'name': 'undated'}, [])
+        line = Timeline(db)
+        sql = db.pictures.get_all(10, 0, columns=('id', 'key'))
+        self.assertEqual(line.page(10), [p['id'] for p in sql])
+        first = line.page(2)
+        self.assertEqual(self.keys(db, first), ['5', '4'])
+        last = db.pictures.by_ids(first[-1:])[0]
+        cursor = (last['taken_time'], last['id'])
+        self.assertEqual(self.keys(db, line.page(2, before=cursor)),
+            ['3', '2'])
+        self.assertEqual(self.keys(db, line.page(2, after=cursor)),
+            ['5'])
+        self.assertEqual(self.keys(db, line.page(10, date=(2015, 12, 2))),
+            ['3', '2'])
+        self.assertEqual(len(line.page(10, date=(2015, 12))), 6)
+        self.assertEqual(line.page(10, date=(2016,)), [])
+        self.assertEqual(self.keys(db, line.page(2, 1, tags=['odd'])),
+            ['3', '1'])
+        self.assertEqual(line.page(10, tags=['odd', 'even']), [])
+        self.assertEqual(len(line.page(10, tags=['odd', 'even'],
+            mode=timeline.ANY)), 6)
+        self.assertEqual(line.nav(last['taken_time'], last['id']),
+            ('3', '5'))
+        undated = db.pictures.by_key('undated')['id']
+        self.assertEqual(self.keys(db, line.page(2, after=(None, undated))),
+            ['1', '0'])
+        self.assertEqual(line.page(2, before=(None, undated)), [])
+        # Tags left without a bit are for SQLite to filter
+        with mock.patch.object(timeline, 'TAG_BITS', 1):
+            line = Timeline(db)
+            pages = [line.page(10, tags=[t]) for t in ('odd', 'even')]
+        self.assertEqual(pages.count(None), 1)
+
+    def test_refresh(self):
+        db = self.get_db('test_timeline_refresh.db')
+        for n in range(3):
+            db.add_picture(picture(str(n), 2015, 12, 1 + n), [])
+        line = Timeline(db)
+        loaded = line.current()
+        db.add_picture(picture('new', 2015, 12, 2, 13), ['a'])
+        db.pictures.change_date('0', dict(picture('0', 2015, 12, 31),
+            date_taken='2015-12-31'))
+        db.tags.change_for_keys(['1'], ['a'])
+        with mock.patch.object(line, '_load') as load:
+            self.assertEqual(self.keys(db, line.page(10, tags=['a'])),
+                ['new', '1'])
+            self.assertFalse(load.called)
+        self.assertIsNot(line.current(), loaded)
+        self.assertEqual(self.keys(db, line.page(10)), ['0', '2', 'new', '1'])
+        self.assertEqual(self.keys(db, line.page(10, date=(2015, 12, 2))),
+            ['new', '1'])
+        self.assertEqual(line.page(10, date=(2015, 12, 1)), [])
+        # Date columns that don't agree with taken_time are left to SQLite
+        db.pictures.update('2', 'day', 30)
+        self.assertIsNone(line.page(10, date=(2015, 12, 30)))
+        with mock.patch.object(timeline, 'RELOAD_AFTER', 0):
+            db.pictures.update('2', 'day', 3)
+            self.assertEqual(self.keys(db, line.page(10, date=(2015, 12, 3))),
+                ['2'])